@@ -0,0 +1,349 @@
+"""Headless rendering benchmark.
+
+Renders the panel() layout, and grids of graphs, into an in memory framebuffer
+fed with synthetic or replayed counters (see sources.py) and prints the
+results as JSON, so runs from two commits can be compared::
+
+    python3 bench.py --output before.json
+    python3 bench.py --compare before.json
+
+Each case runs in a fresh interpreter so its peak RSS isn't inflated by the
+cases before it. Run it from the directory holding inconsolata.ttf
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Optional, Tuple, Union
+import PIL
+from fb import MemoryFB
+from instrument import timings, startup
+from local_types import Dimension, Point
+from network import IfSampler, SeriesGraph, SeriesGraphDecorator
+from panel import panel, MAX_SAMPLES
+from sources import SyntheticHub, ReplayHub, LineRate
+from widgets import Screen, Widget, TitleDecorator, BorderDecorator
+
+# Resolutions and grid sizes run by default
+SIZES: tuple[Dimension, ...] = (Dimension(800, 480), Dimension(1280, 800), Dimension(1920, 1080))
+GRAPHS: tuple[int, ...] = (1, 4, 9)
+
+# Space around the grid and between the cells, in pixels
+MARGIN: int = 16
+BORDER_WIDTH: int = 24
+
+# Traffic the samplers are fed, by name. A case without one uses bursty, as runs from before it could be chosen did
+TRAFFIC: dict[str, dict] = {
+    "bursty": {},
+    "10g": {"traffic": LineRate(10e9, utilisation=0.9, jitter=0.1)},
+    "10g-wrap32": {"traffic": LineRate(10e9, utilisation=0.9, jitter=0.1), "counter_bits": 32},
+}
+
+
+Hub = Union[SyntheticHub, ReplayHub]
+
+
+def make_hub(case: dict) -> Hub:
+    """Get the hub feeding a case, the trace it replays or its synthetic traffic."""
+    if case.get("replay"):
+        return ReplayHub(case["replay"], loop=True)
+    return SyntheticHub(seed=case.get("seed", 0), **TRAFFIC[case.get("traffic", "bursty")])
+
+
+def graph(sampler: IfSampler, size: Dimension, title: str) -> Widget:
+    """Decorate a graph the way panel() does."""
+    return TitleDecorator(
+        BorderDecorator(SeriesGraphDecorator(SeriesGraph(sampler, size=size)), border_width=BORDER_WIDTH),
+        title)
+
+
+def grid_layout(hub: Hub, size: Dimension, graphs: int) -> Tuple[list[Tuple[Widget, Point]], int]:
+    """Tile the screen with graphs of sent bytes, returning the widgets and the samples needed to fill them."""
+    ifname = next(iter(hub.counters))
+    columns = math.ceil(math.sqrt(graphs))
+    rows = math.ceil(graphs / columns)
+    (cell_w, cell_h) = ((size[0] - MARGIN) // columns, (size[1] - MARGIN) // rows)
+    # Find out how much the decorations add around a graph
+    sampler = IfSampler(ifname, "bytes_sent", 1, hub=hub)
+    probe = graph(sampler, Dimension(100, 100), "probe")
+    (extra_w, extra_h) = (probe.size[0] - 100, probe.size[1] - 100)
+    graph_size = Dimension(max(cell_w - MARGIN - extra_w, SeriesGraph.COLUMN_WIDTH),
+                           max(cell_h - MARGIN - extra_h, 1))
+    samples = graph_size[0] // SeriesGraph.COLUMN_WIDTH
+    widgets: list[Tuple[Widget, Point]] = []
+    for i in range(graphs):
+        sampler = IfSampler(ifname, "bytes_sent", samples, hub=hub)
+        widgets.append((graph(sampler, graph_size, f"graph{i}"),
+                        Point(MARGIN + (i % columns)*cell_w, MARGIN + (i // columns)*cell_h)))
+    return (widgets, samples)
+
+
+def panel_layout(hub: Hub) -> Tuple[list[Tuple[Widget, Point]], int]:
+    """Build the panel() layout, returning the widgets and the samples needed to fill them."""
+    ifname = next(iter(hub.counters))
+    sent = IfSampler(ifname, "bytes_sent", MAX_SAMPLES, hub=hub)
+    recv = IfSampler(ifname, "bytes_recv", MAX_SAMPLES, hub=hub)
+    return (panel(sent, recv), MAX_SAMPLES)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Get the value p percent of values are at or below."""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+def run_case(case: dict, frames: int, warmup: int, alloc_frames: int, stages: bool) -> dict:
+    """Render frames of one case and measure them.
+
+    Every frame is preceded by a tick of the counters so each graph scrolls by
+    one sample, the steady state of the real display. The time taken by the
+    samplers to take the tick is reported separately from the frame
+    """
+    size = Dimension(*case["size"])
+    hub = make_hub(case)
+    if case["layout"] == "panel":
+        (widgets, samples) = panel_layout(hub)
+    else:
+        (widgets, samples) = grid_layout(hub, size, case["graphs"])
+    # Fill the history so the graphs start full width
+    for _ in range(samples):
+        hub.tick()
+    with MemoryFB(size, case.get("rawmode", "BGRA")) as display:
+        started = time.perf_counter()
+        screen = Screen(display, widgets)
+        first_ms = (time.perf_counter() - started) * 1e3
+        for _ in range(warmup):
+            hub.tick()
+            screen._draw()
+
+        (wall, cpu, sample) = ([], [], [])
+        for _ in range(frames):
+            t0 = time.perf_counter()
+            hub.tick()
+            t1 = time.perf_counter()
+            c1 = time.process_time()
+            screen._draw()
+            wall.append(time.perf_counter() - t1)
+            cpu.append(time.process_time() - c1)
+            sample.append(t1 - t0)
+
+        # Allocations are traced in a pass of their own as tracing slows everything down.
+        # Only allocations made through Python's allocator are seen, not PIL's image memory
+        (alloc, retained) = ([], 0)
+        if alloc_frames:
+            tracemalloc.start()
+            (baseline, _) = tracemalloc.get_traced_memory()
+            for _ in range(alloc_frames):
+                hub.tick()
+                (before, _) = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                screen._draw()
+                (_, peak) = tracemalloc.get_traced_memory()
+                alloc.append(peak - before)
+            (current, _) = tracemalloc.get_traced_memory()
+            retained = current - baseline
+            tracemalloc.stop()
+
+        stage_ms = {}
+        if stages:
+            timings.enabled = True
+            for _ in range(frames):
+                hub.tick()
+                screen._draw()
+            timings.enabled = False
+            stage_ms = {name: round(h.mean * 1e3, 4) for (name, h) in timings.slowest()}
+            timings.reset()
+
+    total = sum(wall)
+    result = dict(case)
+    result.update({
+        "frames": frames,
+        "fps": round(frames / total, 2) if total else None,
+        "first_frame_ms": round(first_ms, 3),
+        "wall_ms": {"mean": round(total / frames * 1e3, 4),
+                    "p50": round(percentile(wall, 50) * 1e3, 4),
+                    "p99": round(percentile(wall, 99) * 1e3, 4),
+                    "max": round(max(wall) * 1e3, 4)},
+        "cpu_ms": round(sum(cpu) / frames * 1e3, 4),
+        "sample_ms": round(sum(sample) / frames * 1e3, 4),
+        "alloc_bytes": {"mean": int(sum(alloc) / len(alloc)), "max": max(alloc), "retained": retained}
+        if alloc else None,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+    if stages:
+        result["stages_ms"] = stage_ms
+    return result
+
+
+def run_startup(size: Dimension) -> dict:
+    """Build the panel and render its first frame, returning the milliseconds from launch to each step."""
+    startup.enabled = True
+    startup.mark("imported")
+    (widgets, _) = panel_layout(SyntheticHub())
+    startup.mark("widgets built")
+    with MemoryFB(size) as display:
+        Screen(display, widgets)._draw()
+    return {name: round(at * 1e3, 2) for (name, at) in startup.marks()}
+
+
+def measure_startup(size: Dimension, runs: int) -> dict:
+    """Time runs cold starts, each in a fresh interpreter, and get the median milliseconds to each step."""
+    command = [sys.executable, os.path.abspath(__file__), "--startup-child", f"{size[0]}x{size[1]}"]
+    steps: dict[str, list[float]] = {}
+    for _ in range(runs):
+        # The screen reports the milestones on stderr as well, which isn't wanted here
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        for (name, ms) in json.loads(output).items():
+            steps.setdefault(name, []).append(ms)
+    return {name: percentile(ms, 50) for (name, ms) in steps.items()}
+
+
+def case_name(case: dict) -> str:
+    """Get the name results are matched by when comparing runs."""
+    (w, h) = case["size"]
+    layout = "panel" if case["layout"] == "panel" else f"graphs{case['graphs']}"
+    name = f"{layout}@{w}x{h}:{case.get('rawmode', 'BGRA')}"
+    if case.get("replay"):
+        return f"{name}/replay"
+    if case.get("traffic", "bursty") != "bursty":
+        return f"{name}/{case['traffic']}"
+    return name
+
+
+def cases(sizes: list[Dimension], graphs: list[int], rawmode: str, with_panel: bool,
+          traffic: str = "bursty", replay: Optional[str] = None) -> list[dict]:
+    """Get the cases to run, the panel layout and each grid at each size, fed with traffic or a replayed trace."""
+    found = []
+    for size in sizes:
+        if with_panel:
+            found.append({"layout": "panel", "size": list(size), "rawmode": rawmode})
+        for n in graphs:
+            found.append({"layout": "grid", "graphs": n, "size": list(size), "rawmode": rawmode})
+    for case in found:
+        if replay:
+            case["replay"] = os.path.abspath(replay)
+        else:
+            case["traffic"] = traffic
+        case["name"] = case_name(case)
+    return found
+
+
+def run_isolated(case: dict, args: argparse.Namespace) -> dict:
+    """Run one case in a child interpreter and collect its result."""
+    command = [sys.executable, os.path.abspath(__file__), "--case", json.dumps(case),
+               "--frames", str(args.frames), "--warmup", str(args.warmup), "--alloc-frames", str(args.alloc_frames)]
+    if args.stages:
+        command.append("--stages")
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output)
+
+
+def commit() -> Optional[str]:
+    """Get the commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True, text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Print how each case changed against baseline, returning True if any got slower than threshold allows."""
+    before = {case["name"]: case for case in baseline["cases"]}
+    regressed = False
+    print(f"{'case':36} {'fps':>9} {'before':>9} {'change':>8}", file=sys.stderr)
+    for case in current["cases"]:
+        old = before.get(case["name"])
+        if old is None or not old["fps"] or not case["fps"]:
+            continue
+        change = case["fps"] / old["fps"] - 1
+        flag = ""
+        if change < -threshold:
+            (regressed, flag) = (True, " REGRESSED")
+        print(f"{case['name']:36} {case['fps']:9.1f} {old['fps']:9.1f} {change:+8.1%}{flag}", file=sys.stderr)
+    return regressed
+
+
+def parse_size(text: str) -> Dimension:
+    (w, h) = text.lower().split("x")
+    return Dimension(int(w), int(h))
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark rendering into an in memory framebuffer")
+    parser.add_argument("--sizes", default=",".join(f"{w}x{h}" for (w, h) in SIZES),
+                        help="comma separated resolutions, WxH")
+    parser.add_argument("--graphs", default=",".join(str(n) for n in GRAPHS),
+                        help="comma separated numbers of graphs in the grid layouts")
+    parser.add_argument("--no-panel", action="store_true", help="skip the panel() layout")
+    parser.add_argument("--rawmode", default="BGRA", help="pixel layout of the framebuffer")
+    parser.add_argument("--traffic", choices=TRAFFIC, default="bursty", help="synthetic traffic fed to the graphs")
+    parser.add_argument("--replay", metavar="TRACE", help="feed the graphs a trace recorded by sources.py instead")
+    parser.add_argument("--frames", type=int, default=200, help="frames timed per case")
+    parser.add_argument("--warmup", type=int, default=10, help="frames rendered before timing")
+    parser.add_argument("--alloc-frames", type=int, default=20, help="frames traced for allocations, 0 to skip")
+    parser.add_argument("--stages", action="store_true", help="also time the stages of a frame")
+    parser.add_argument("--inline", action="store_true", help="run every case in this process")
+    parser.add_argument("--output", help="write the results here rather than stdout")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fractional drop in fps reported as a regression")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="instead time RUNS launches of the panel to its first frame, at the first size")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--startup-child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case), args.frames, args.warmup, args.alloc_frames, args.stages)))
+        return 0
+    if args.startup_child:
+        print(json.dumps(run_startup(parse_size(args.startup_child))))
+        return 0
+
+    results = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "cases": [],
+    }
+    sizes = [parse_size(size) for size in args.sizes.split(",") if size]
+    graphs = [int(n) for n in args.graphs.split(",") if n]
+    if args.startup:
+        results["startup_ms"] = measure_startup(sizes[0], args.startup)
+        print(json.dumps(results, indent=2))
+        return 0
+    for case in cases(sizes, graphs, args.rawmode, not args.no_panel, args.traffic, args.replay):
+        if args.inline:
+            result = run_case(case, args.frames, args.warmup, args.alloc_frames, args.stages)
+        else:
+            result = run_isolated(case, args)
+        results["cases"].append(result)
+        print(f"{case['name']}: {result['fps']} fps", file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            if compare(json.load(baseline), results, args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Tracking of damaged (changed) rectangles on a widget or screen."""
+from __future__ import annotations
+from typing import Iterable, Iterator, Optional
+from local_types import Dimension, Point, Rect
+
+# Above this many separate rectangles it is cheaper to push their bounding box
+MAX_RECTS: int = 16
+
+
+def offset_rect(rect: Rect, origin: Point) -> Rect:
+    """Translate a rectangle by origin."""
+    (ox, oy) = origin
+    return Rect(rect.x0 + ox, rect.y0 + oy, rect.x1 + ox, rect.y1 + oy)
+
+
+def intersect(a: Rect, b: Rect) -> Optional[Rect]:
+    """Return the intersection of two rectangles or None if they don't overlap."""
+    x0 = max(a.x0, b.x0)
+    y0 = max(a.y0, b.y0)
+    x1 = min(a.x1, b.x1)
+    y1 = min(a.y1, b.y1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return Rect(x0, y0, x1, y1)
+
+
+def union(a: Rect, b: Rect) -> Rect:
+    """Return the bounding box of two rectangles."""
+    return Rect(min(a.x0, b.x0), min(a.y0, b.y0), max(a.x1, b.x1), max(a.y1, b.y1))
+
+
+def touches(a: Rect, b: Rect) -> bool:
+    """Check if two rectangles overlap or share an edge."""
+    return a.x0 <= b.x1 and b.x0 <= a.x1 and a.y0 <= b.y1 and b.y0 <= a.y1
+
+
+def area(rect: Rect) -> int:
+    """Get the area of a rectangle in pixels."""
+    return (rect.x1 - rect.x0) * (rect.y1 - rect.y0)
+
+
+class Damage:
+    """A list of damaged rectangles.
+
+    Rectangles use the PIL box convention (x0, y0, x1, y1) where x1 and y1 are exclusive.
+    Overlapping or adjacent rectangles are merged as they are added so the list stays short.
+    """
+
+    def __init__(self, size: Dimension):
+        """Create an empty damage list clipped to an area of size."""
+        self._bounds = Rect(0, 0, size[0], size[1])
+        self._rects: list[Rect] = []
+
+    @property
+    def bounds(self) -> Rect:
+        """Get the rectangle all damage is clipped to."""
+        return self._bounds
+
+    def add(self, rect: Optional[Rect] = None) -> None:
+        """Mark rect as damaged, or everything if rect is None."""
+        clipped = self._bounds if rect is None else intersect(Rect(*rect), self._bounds)
+        if clipped is None:
+            return
+        # Merge with everything it touches, which may cascade
+        merged = True
+        while merged:
+            merged = False
+            for existing in self._rects:
+                if touches(existing, clipped):
+                    self._rects.remove(existing)
+                    clipped = union(existing, clipped)
+                    merged = True
+                    break
+        self._rects.append(clipped)
+        if len(self._rects) > MAX_RECTS:
+            bbox = self._rects[0]
+            for r in self._rects[1:]:
+                bbox = union(bbox, r)
+            self._rects = [bbox]
+
+    def add_all(self, rects: Iterable[Rect], origin: Point = Point(0, 0)) -> None:
+        """Mark a set of rectangles as damaged after translating them by origin."""
+        for rect in rects:
+            self.add(offset_rect(rect, origin))
+
+    def take(self) -> list[Rect]:
+        """Return the damaged rectangles and reset the list."""
+        rects = self._rects
+        self._rects = []
+        return rects
+
+    def __bool__(self) -> bool:
+        return len(self._rects) > 0
+
+    def __len__(self) -> int:
+        return len(self._rects)
+
+    def __iter__(self) -> Iterator[Rect]:
+        return iter(self._rects)
@@ -2,52 +2,214 @@
 from __future__ import annotations
 import os
 import mmap
+import fcntl
+import struct
+import tempfile
+from collections import namedtuple
 from typing import Optional, Any
-from local_types import Dimension, Color
-from framebuffer import Framebuffer
+from PIL import Image
+from local_types import Dimension, Color, Rect
+from framebuffer import Framebuffer, Frame
+from pixelformat import PixelFormat
+
+# ioctls from linux/fb.h
+FBIOGET_VSCREENINFO = 0x4600
+FBIOPUT_VSCREENINFO = 0x4601
+FBIOGET_FSCREENINFO = 0x4602
+FBIOPAN_DISPLAY = 0x4606
+
+# struct fb_var_screeninfo, each fb_bitfield is flattened into offset, length and msb_right
+VarScreenInfo = namedtuple("VarScreenInfo", [
+    "xres", "yres", "xres_virtual", "yres_virtual", "xoffset", "yoffset",
+    "bits_per_pixel", "grayscale",
+    "red_offset", "red_length", "red_msb_right",
+    "green_offset", "green_length", "green_msb_right",
+    "blue_offset", "blue_length", "blue_msb_right",
+    "transp_offset", "transp_length", "transp_msb_right",
+    "nonstd", "activate", "height", "width", "accel_flags", "pixclock",
+    "left_margin", "right_margin", "upper_margin", "lower_margin",
+    "hsync_len", "vsync_len", "sync", "vmode", "rotate", "colorspace",
+    "reserved0", "reserved1", "reserved2", "reserved3"])
+VAR_SCREENINFO_FORMAT = "=40I"
+
+# struct fb_fix_screeninfo, the trailing 0L pads it to the size the kernel uses
+FixScreenInfo = namedtuple("FixScreenInfo", [
+    "id", "smem_start", "smem_len", "type", "type_aux", "visual",
+    "xpanstep", "ypanstep", "ywrapstep", "line_length",
+    "mmio_start", "mmio_len", "accel", "capabilities", "reserved0", "reserved1"])
+FIX_SCREENINFO_FORMAT = "@16sLIIIIHHHILIIHHH0L"
 
 
 class DirectFB(Framebuffer):
-    """Framebuffer using directfb as a backend."""
+    """Framebuffer using directfb as a backend.
+
+    With double_buffer set the virtual resolution is doubled so frames are written
+    into the hidden page and shown with FBIOPAN_DISPLAY by flip(). If the driver
+    can't pan, writes go straight to the visible screen as before
+    """
 
-    def __init__(self, fbdev: str = "fb0"):
-        """Create a new framebuffer using directfb as a backend."""
+    def __init__(self,
+                 fbdev: str = "fb0",
+                 double_buffer: bool = False,
+                 sysfs: str = "/sys/class/graphics",
+                 devfs: str = "/dev"):
+        """Create a new framebuffer using directfb as a backend.
+
+        Parameters
+        ----------
+        fbdev: str
+            name of the framebuffer device, e.g. fb0
+        double_buffer: bool
+            render into a hidden page and pan to it rather than drawing on the visible screen
+        sysfs: str
+            directory containing the sysfs entry for fbdev
+        devfs: str
+            directory containing the device node for fbdev
+        """
         super().__init__("", mode="BGRA", bpp=0, size=Dimension(0, 0))
         self._fbdev = fbdev
+        self._sysfs = sysfs
+        self._devfs = devfs
         self._fb: Optional[int] = None
         self._fb_bytes: Optional[Any] = None
+        self._double_buffer = double_buffer
+        self._var_info: Optional[VarScreenInfo] = None
+        # The mode before double buffering changed it, put back on exit
+        self._saved_var_info: Optional[VarScreenInfo] = None
+        # Index of the page being drawn into and the rectangles which went to the other page last frame
+        self._page = 0
+        self._page_size = 0
+        self._stale: list[Rect] = []
+        self._written: list[Rect] = []
 
-        with open(f"/sys/class/graphics/{fbdev}/name", "r") as fb_data:
+        with open(f"{sysfs}/{fbdev}/name", "r") as fb_data:
             data = fb_data.read()
             self._name = data
 
         # Get screen size
-        with open(f"/sys/class/graphics/{fbdev}/virtual_size", "r") as fb_data:
+        with open(f"{sysfs}/{fbdev}/virtual_size", "r") as fb_data:
             data = fb_data.read()
             (size_x, size_y) = data.split(",")
             self._size = Dimension(int(size_x), int(size_y))
 
         # Get bit per pixel
-        with open(f"/sys/class/graphics/{fbdev}/bits_per_pixel", "r") as fb_data:
+        with open(f"{sysfs}/{fbdev}/bits_per_pixel", "r") as fb_data:
             self._bpp = int(fb_data.read())
 
+        # Get the length of a row in bytes, which may be padded. Old kernels don't export it,
+        # in which case it is asked for once the device is open
+        try:
+            with open(f"{sysfs}/{fbdev}/stride", "r") as fb_data:
+                self._line_length = int(fb_data.read())
+        except (OSError, ValueError):
+            self._line_length = 0
+
+        # Until the device is opened assume the byte order of the Intel drivers
+        self._pixel_format = PixelFormat.from_bpp(self._bpp, self._size, self._line_length)
+        self._mode = self._pixel_format.rawmode
+
     @property
     def fbdev(self) -> str:
         """Get the name of the directfb device."""
         return self._fbdev
 
+    @property
+    def double_buffered(self) -> bool:
+        """Check if frames are being drawn off screen and flipped."""
+        return self._page_size > 0
+
+    def _ioctl(self, request: int, buf: bytearray) -> None:
+        """Issue an ioctl on the framebuffer device, raising OSError if it fails."""
+        fcntl.ioctl(self._fb, request, buf)
+
+    def _get_var_screeninfo(self) -> Optional[VarScreenInfo]:
+        """Ask the driver for the current mode, or None if the device doesn't support it."""
+        buf = bytearray(struct.calcsize(VAR_SCREENINFO_FORMAT))
+        try:
+            self._ioctl(FBIOGET_VSCREENINFO, buf)
+        except OSError:
+            return None
+        return VarScreenInfo(*struct.unpack(VAR_SCREENINFO_FORMAT, buf))
+
+    def _get_fix_screeninfo(self) -> Optional[FixScreenInfo]:
+        """Ask the driver for the memory layout, or None if the device doesn't support it."""
+        buf = bytearray(struct.calcsize(FIX_SCREENINFO_FORMAT))
+        try:
+            self._ioctl(FBIOGET_FSCREENINFO, buf)
+        except OSError:
+            return None
+        return FixScreenInfo(*struct.unpack(FIX_SCREENINFO_FORMAT, buf))
+
+    def _put_var_screeninfo(self, request: int, info: VarScreenInfo) -> bool:
+        """Send a mode to the driver with FBIOPUT_VSCREENINFO or FBIOPAN_DISPLAY."""
+        buf = bytearray(struct.pack(VAR_SCREENINFO_FORMAT, *info))
+        try:
+            self._ioctl(request, buf)
+        except OSError:
+            return False
+        return True
+
+    def _setup_double_buffer(self, info: VarScreenInfo) -> bool:
+        """Make the virtual screen two pages high and check the driver can pan between them."""
+        if info.yres_virtual < info.yres*2:
+            wanted = info._replace(xres_virtual=info.xres, yres_virtual=info.yres*2, xoffset=0, yoffset=0)
+            if not self._put_var_screeninfo(FBIOPUT_VSCREENINFO, wanted):
+                return False
+            new_info = self._get_var_screeninfo()
+            if new_info is None or new_info.yres_virtual < info.yres*2:
+                return False
+            info = new_info
+        fix = self._get_fix_screeninfo()
+        if fix is None or fix.ypanstep == 0:
+            return False
+        if fix.smem_len < fix.line_length*info.yres*2:
+            return False
+        self._line_length = fix.line_length
+        self._var_info = info
+        # Show the first page and draw into the second
+        if not self._put_var_screeninfo(FBIOPAN_DISPLAY, info._replace(xoffset=0, yoffset=0)):
+            return False
+        self._page = 1
+        return True
+
     def __enter__(self) -> Framebuffer:
         """Support python 'with' statement entry."""
         # Open the framebuffer device
-        self._fb = os.open(f"/dev/{self._fbdev}", os.O_RDWR)
+        self._fb = os.open(f"{self._devfs}/{self._fbdev}", os.O_RDWR)
+
+        if not self._line_length:
+            fix = self._get_fix_screeninfo()
+            if fix is not None:
+                self._line_length = fix.line_length
+
+        # Pick the conversion for the real channel layout and visible resolution
+        info = self._get_var_screeninfo()
+        pages = 1
+        if info is not None:
+            if self._double_buffer:
+                self._saved_var_info = info
+                if self._setup_double_buffer(info):
+                    pages = 2
+            self._size = Dimension(info.xres, info.yres)
+            self._bpp = info.bits_per_pixel
+            self._pixel_format = PixelFormat.from_bitfields(info.bits_per_pixel,
+                                                            info.red_offset,
+                                                            info.blue_offset,
+                                                            self._size,
+                                                            self._line_length)
+            self._mode = self._pixel_format.rawmode
+        else:
+            self._pixel_format = PixelFormat.from_bpp(self._bpp, self._size, self._line_length)
 
         # Map framebuffer to memory
-        (size_x, size_y) = self.size
+        (_, size_y) = self.size
+        page_size = self.pixel_format.line_length*size_y
         self._fb_bytes = mmap.mmap(self._fb,
-                                   size_x*size_y*self.bpp//8,
+                                   page_size*pages,
                                    mmap.MAP_SHARED,
                                    mmap.PROT_WRITE | mmap.PROT_READ,
                                    offset=0)
+        self._page_size = page_size if pages == 2 else 0
         return self
 
     def __exit__(self, exc_type, exc_value, tb) -> None:
@@ -56,22 +218,234 @@ class DirectFB(Framebuffer):
         if self._fb_bytes is not None:
             self._fb_bytes.close()
         if self._fb is not None:
+            # Put the virtual size and pan back, or the console may be left drawing on a hidden page
+            if self._saved_var_info is not None:
+                self._put_var_screeninfo(FBIOPUT_VSCREENINFO, self._saved_var_info)
             os.close(self._fb)
 
     def clear(self, fill: Color) -> None:
         """Clear this Framebuffer."""
-        # Map colors as Intel use a weird byte order
-        (c_r, c_g, c_b, c_a) = fill
-        mapped = (c_b, c_g, c_r, c_a)
-        (size_x, size_y) = self.size
-        screen = bytearray(bytes(mapped))*size_x*size_y
-        if self._fb_bytes is not None:
-            self._fb_bytes.write(screen)
+        self.present(Image.new("RGBA", self.size, fill))
 
     def write_screen(self, some_bytes: list[bytes]) -> None:
         if self._fb_bytes is not None:
-            self._fb_bytes.seek(0)
-            self._fb_bytes.write(some_bytes)
+            (size_x, size_y) = self.size
+            self._prepare_page(Rect(0, 0, size_x, size_y))
+            base = self._page*self._page_size
+            self._fb_bytes[base:base + len(some_bytes)] = some_bytes
+
+    def write_region(self, some_bytes: bytes, rect: Rect) -> None:
+        """Write the pixels in rect, packed by pixel_format, leaving the rest of the screen alone."""
+        if self._fb_bytes is None:
+            return
+        self._prepare_page(rect)
+        self.pixel_format.copy_rows(some_bytes, rect, self._fb_bytes, self._page*self._page_size)
+
+    def present(self, frame: Frame, regions: Optional[list[Rect]] = None) -> None:
+        """Copy regions of frame straight into the mapped page being drawn and flip.
+
+        An image is packed into the mapping as it is encoded, with no copy of it made on the way
+        """
+        if self._fb_bytes is None:
+            return
+        for rect in self._regions(regions):
+            self._prepare_page(rect)
+            self._put(frame, rect, self._fb_bytes, self._page*self._page_size)
+        self.flip()
+
+    def _prepare_page(self, rect: Rect) -> None:
+        """Record rect is about to be written to the hidden page, first bringing it up to date.
+
+        The hidden page last showed the frame before the visible one, so whatever
+        changed in the visible one is copied across before the new frame is drawn
+        """
+        if not self.double_buffered:
+            return
+        self._written.append(rect)
+        if not self._stale:
+            return
+        line = self.pixel_format.line_length
+        pixel = self.pixel_format.bytes_per_pixel
+        front = (1 - self._page)*self._page_size
+        back = self._page*self._page_size
+        for stale in self._stale:
+            start = stale.y0*line + stale.x0*pixel
+            if self.pixel_format.is_full_width(stale):
+                self._fb_bytes.move(back + start, front + start, (stale.y1 - stale.y0)*line)
+                continue
+            row = (stale.x1 - stale.x0)*pixel
+            for y in range(stale.y1 - stale.y0):
+                offset = start + y*line
+                self._fb_bytes.move(back + offset, front + offset, row)
+        self._stale = []
+
+    def flip(self) -> None:
+        """Show the page everything since the last flip was written to."""
+        if not self.double_buffered or not self._written:
+            return
+        (_, size_y) = self.size
+        if not self._put_var_screeninfo(FBIOPAN_DISPLAY,
+                                        self._var_info._replace(xoffset=0, yoffset=self._page*size_y)):
+            # The driver has stopped panning, fall back to drawing on the visible page
+            self._page_size = 0
+            self._page = 0
+            self._stale = []
+            self._written = []
+            return
+        self._page = 1 - self._page
+        self._stale = self._written
+        self._written = []
+
+
+class FileFB(DirectFB):
+    """File backed stand-in for a framebuffer device, for development and testing without hardware.
+
+    A fake sysfs entry and device node are created in a temporary directory and the
+    framebuffer ioctls are emulated, including panning unless can_pan is False
+    """
+
+    def __init__(self,
+                 size: Dimension = Dimension(1280, 720),
+                 bpp: int = 32,
+                 line_length: int = 0,
+                 can_pan: bool = True,
+                 sysfs_stride: bool = True,
+                 **kwargs):
+        """Create a new file backed framebuffer.
+
+        Parameters
+        ----------
+        size: Dimension
+            visible resolution of the fake screen
+        bpp: int
+            bits per pixel, 16, 24 or 32
+        line_length: int
+            bytes per row, or 0 for unpadded rows
+        can_pan: bool
+            whether the fake driver supports a double height virtual screen and FBIOPAN_DISPLAY
+        sysfs_stride: bool
+            whether the fake sysfs entry exports the stride, which old kernels don't
+        **kwargs: map of arguments
+            Passed to the superclass (DirectFB)
+        """
+        self._dir = tempfile.TemporaryDirectory(prefix="filefb")
+        line_length = line_length or size[0]*bpp//8
+        (w, h) = size
+        os.mkdir(f"{self._dir.name}/fb0")
+        for (entry, value) in (("name", "filefb"),
+                               ("virtual_size", f"{w},{h}"),
+                               ("bits_per_pixel", f"{bpp}"),
+                               ("stride", f"{line_length}")):
+            if entry == "stride" and not sysfs_stride:
+                continue
+            with open(f"{self._dir.name}/fb0/{entry}", "w") as fb_data:
+                fb_data.write(value)
+        os.mkdir(f"{self._dir.name}/dev")
+        with open(f"{self._dir.name}/dev/fb0", "wb") as dev:
+            dev.truncate(line_length*h*2)
+        self._can_pan = can_pan
+        red_offset = 11 if bpp == 16 else 16
+        self._fake_var = VarScreenInfo(*([w, h, w, h, 0, 0, bpp, 0,
+                                          red_offset, 5 if bpp == 16 else 8, 0,
+                                          5 if bpp == 16 else 8, 6 if bpp == 16 else 8, 0,
+                                          0, 5 if bpp == 16 else 8, 0,
+                                          24 if bpp == 32 else 0, 8 if bpp == 32 else 0, 0] + [0]*20))
+        self._fake_fix = FixScreenInfo(b"filefb", 0, line_length*h*2, 0, 0, 2,
+                                       0, 1 if can_pan else 0, 0, line_length, 0, 0, 0, 0, 0, 0)
+        self.pans = 0
+        super().__init__("fb0", sysfs=self._dir.name, devfs=f"{self._dir.name}/dev", **kwargs)
+
+    def _ioctl(self, request: int, buf: bytearray) -> None:
+        """Emulate the framebuffer ioctls against the fake mode."""
+        if request == FBIOGET_VSCREENINFO:
+            buf[:] = struct.pack(VAR_SCREENINFO_FORMAT, *self._fake_var)
+        elif request == FBIOGET_FSCREENINFO:
+            buf[:] = struct.pack(FIX_SCREENINFO_FORMAT, *self._fake_fix)
+        elif request in (FBIOPUT_VSCREENINFO, FBIOPAN_DISPLAY):
+            info = VarScreenInfo(*struct.unpack(VAR_SCREENINFO_FORMAT, buf))
+            if not self._can_pan and (info.yres_virtual > self._fake_var.yres or info.yoffset > 0):
+                raise OSError(22, "Invalid argument")
+            if request == FBIOPAN_DISPLAY:
+                self.pans += 1
+                self._fake_var = self._fake_var._replace(yoffset=info.yoffset)
+            else:
+                self._fake_var = info
+        else:
+            raise OSError(25, "Inappropriate ioctl for device")
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        """Support python 'with' statement exit."""
+        super().__exit__(exc_type, exc_value, tb)
+        self._dir.cleanup()
+
+    def visible(self) -> Image:
+        """Get the page the fake display is currently scanning out as an RGBA image."""
+        (w, h) = self.size
+        line = self.pixel_format.line_length
+        start = self._fake_var.yoffset*line
+        with open(f"{self._dir.name}/dev/fb0", "rb") as dev:
+            dev.seek(start)
+            data = dev.read(line*h)
+        if self.pixel_format.rawmode in ("RGB565", "BGR565"):
+            rawmode = "BGR;16" if self.pixel_format.rawmode == "RGB565" else "RGB;16"
+            return Image.frombytes("RGB", self.size, data, "raw", (rawmode, line)).convert("RGBA")
+        mode = "RGBA" if self.pixel_format.bytes_per_pixel == 4 else "RGB"
+        return Image.frombytes(mode, self.size, data, "raw", (self.pixel_format.rawmode, line)).convert("RGBA")
+
+
+class MemoryFB(Framebuffer):
+    """Framebuffer held in a bytearray, for rendering with no device at all.
+
+    Writes are copied into the buffer exactly as DirectFB copies them into the
+    mapped device, so the cost of a frame is the same apart from the kernel
+    """
+
+    def __init__(self,
+                 size: Dimension = Dimension(1280, 720),
+                 rawmode: str = "BGRA",
+                 line_length: int = 0):
+        """Create a new in memory framebuffer.
+
+        Parameters
+        ----------
+        size: Dimension
+            resolution of the screen
+        rawmode: str
+            byte layout of a pixel, any PixelFormat supports
+        line_length: int
+            bytes per row, or 0 for unpadded rows
+        """
+        pixel_format = PixelFormat(rawmode, size, line_length)
+        super().__init__("memory", rawmode, pixel_format.bytes_per_pixel*8, size)
+        self._pixel_format = pixel_format
+        self._fb_bytes = bytearray(pixel_format.line_length*size[1])
+        self.flips = 0
+
+    @property
+    def buffer(self) -> bytearray:
+        """Get the pixels, in the layout given by pixel_format."""
+        return self._fb_bytes
+
+    def clear(self, fill: Color) -> None:
+        """Clear this Framebuffer."""
+        self.present(Image.new("RGBA", self.size, fill))
+
+    def write_screen(self, some_bytes: list[bytes]) -> None:
+        self._fb_bytes[:len(some_bytes)] = some_bytes
+
+    def write_region(self, some_bytes: bytes, rect: Rect) -> None:
+        """Write the pixels in rect, packed by pixel_format, leaving the rest of the screen alone."""
+        self.pixel_format.copy_rows(some_bytes, rect, self._fb_bytes)
+
+    def present(self, frame: Frame, regions: Optional[list[Rect]] = None) -> None:
+        """Copy regions of frame straight into the buffer and flip."""
+        for rect in self._regions(regions):
+            self._put(frame, rect, self._fb_bytes)
+        self.flip()
+
+    def flip(self) -> None:
+        """Count the frames presented."""
+        self.flips += 1
 
 
 if __name__ == "__main__":
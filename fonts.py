@@ -0,0 +1,52 @@
+"""Fonts shared by the widgets, loaded the first time they are asked for."""
+from __future__ import annotations
+import threading
+from typing import Optional
+from PIL import ImageFont
+
+# Face used when none is given, looked for in the working directory like the rest of the data files
+DEFAULT_FACE: str = "inconsolata.ttf"
+DEFAULT_SIZE: int = 24
+
+
+class FontRegistry:
+    """Truetype fonts keyed by (face, size), each loaded once on first use.
+
+    Nothing is read from disk until a font is asked for, so importing the
+    widgets costs no flash reads. Every widget asking for the same face and
+    size gets the same font object, which the text caches key on
+    """
+
+    def __init__(self, face: str = DEFAULT_FACE):
+        """Create an empty registry whose default face is face."""
+        self._face = face
+        self._fonts: dict[tuple[str, int], ImageFont.FreeTypeFont] = {}
+        # Widgets are built on the loop but fonts may be asked for by the render thread too
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._fonts)
+
+    def get(self, size: int = DEFAULT_SIZE, face: Optional[str] = None) -> ImageFont.FreeTypeFont:
+        """Get face, or the default face, at size, loading it the first time."""
+        key = (face or self._face, size)
+        found = self._fonts.get(key)
+        if found is not None:
+            return found
+        with self._lock:
+            found = self._fonts.get(key)
+            if found is None:
+                found = self._fonts[key] = self._load(*key)
+        return found
+
+    @staticmethod
+    def _load(face: str, size: int) -> ImageFont.FreeTypeFont:
+        try:
+            return ImageFont.truetype(face, size)
+        except ImportError as e:
+            # Pillow raises ImportError for truetype fonts when it was built without freetype2
+            raise RuntimeError("freetype2 isn't available, install a Pillow built with it") from e
+
+
+# Shared by everything drawing text
+fonts = FontRegistry()
@@ -1,15 +1,26 @@
 from __future__ import annotations
 import traceback
-from typing import Optional, Any
-from local_types import Dimension, Color
+from typing import Optional, Any, Union
+from PIL import Image
+from local_types import Dimension, Color, Rect
+from pixelformat import PixelFormat
+
+# What present() shows, the RGBA screen or the screen already packed by the pixel format into a buffer
+Frame = Union[Image.Image, bytes, bytearray, memoryview]
+
 
 class Framebuffer():
 
+    # Whether present() has to be called on the event loop. Displays which only
+    # copy into memory are presented from the thread which rendered the frame
+    present_on_loop: bool = False
+
     def __init__(self, name: str, mode: str, bpp: int, size: Dimension):
         self._mode = mode
         self._name = name
         self._bpp = bpp
         self._size = size
+        self._pixel_format = PixelFormat(mode, size) if bpp else None
 
     @property
     def mode(self) -> str:
@@ -27,6 +38,10 @@ class Framebuffer():
     def bpp(self) -> int:
         return self._bpp
 
+    @property
+    def pixel_format(self) -> PixelFormat:
+        return self._pixel_format
+
     def __enter__(self) -> Framebuffer:
         return self
 
@@ -39,3 +54,35 @@ class Framebuffer():
 
     def write_screen(self, some_bytes: list[bytes]) -> None:
         pass
+
+    def write_region(self, some_bytes: bytes, rect: Rect) -> None:
+        pass
+
+    def present(self, frame: Frame, regions: Optional[list[Rect]] = None) -> None:
+        """Show regions of frame, or all of it if regions is None, and flip.
+
+        frame is the whole screen, either an RGBA image or any buffer, such as a
+        bytearray or memoryview, holding it packed by pixel_format. Backends copy
+        each region straight to where it is shown, so this fallback which goes
+        through write_region() is only for those which don't
+        """
+        for rect in self._regions(regions):
+            if isinstance(frame, Image.Image):
+                self.write_region(self._pixel_format.pack(frame.crop(rect), rect), rect)
+            else:
+                self.write_region(self._pixel_format.extract(frame, rect), rect)
+        self.flip()
+
+    def _regions(self, regions: Optional[list[Rect]]) -> list[Rect]:
+        """Get the regions to present, the whole screen if there are none."""
+        return [Rect(0, 0, self._size[0], self._size[1])] if regions is None else regions
+
+    def _put(self, frame: Frame, rect: Rect, target: Any, base: int = 0) -> None:
+        """Put rect of frame into target, laid out like the framebuffer from base onwards."""
+        if isinstance(frame, Image.Image):
+            self._pixel_format.pack_into(frame, rect, target, base)
+        else:
+            self._pixel_format.copy_into(frame, rect, target, base)
+
+    def flip(self) -> None:
+        pass
@@ -0,0 +1,232 @@
+"""Timing histograms for the rendering and sampling hot paths, and startup milestones."""
+from __future__ import annotations
+import os
+import signal
+import sys
+import time
+from typing import Mapping, Optional
+
+# Bucket n of a histogram holds durations below 2**n microseconds, the last bucket holds everything longer
+BUCKETS: int = 25
+
+
+class Histogram:
+    """Histogram of durations in power of two buckets of microseconds."""
+
+    def __init__(self):
+        """Create an empty histogram."""
+        self._buckets = [0] * BUCKETS
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    @property
+    def count(self) -> int:
+        """Get the number of durations recorded."""
+        return self._count
+
+    @property
+    def mean(self) -> float:
+        """Get the mean duration in seconds."""
+        return self._total / self._count if self._count else 0.0
+
+    @property
+    def max(self) -> float:
+        """Get the longest duration in seconds."""
+        return self._max
+
+    def add(self, seconds: float) -> None:
+        """Record a duration."""
+        self._buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self._count += 1
+        self._total += seconds
+        if seconds > self._max:
+            self._max = seconds
+
+    def percentile(self, p: float) -> float:
+        """Get an upper bound in seconds for the duration p percent of the samples are below."""
+        wanted = self._count * p / 100
+        seen = 0
+        for (bucket, n) in enumerate(self._buckets):
+            seen += n
+            if n and seen >= wanted:
+                return min((1 << bucket) / 1e6, self._max)
+        return self._max
+
+
+class _Timer:
+    """Context manager recording how long its body took."""
+
+    __slots__ = ("_timings", "_name", "_start")
+
+    def __init__(self, timings: Timings, name: str):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        self._timings.record(self._name, time.perf_counter() - self._start)
+
+
+class _NullTimer:
+    """Context manager which does nothing, used while timing is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class Timings:
+    """Named timing histograms.
+
+    Timing is off by default, when time() hands out a shared do nothing
+    context manager so instrumented code costs a method call
+    """
+
+    def __init__(self):
+        """Create an empty, disabled, set of timings."""
+        self.enabled = False
+        self._histograms: dict[str, Histogram] = {}
+
+    def time(self, name: str):
+        """Get a context manager which records how long its body takes under name."""
+        if self.enabled:
+            return _Timer(self, name)
+        return _null_timer
+
+    def record(self, name: str, seconds: float) -> None:
+        """Record a duration measured elsewhere under name."""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def histograms(self) -> dict[str, Histogram]:
+        """Get the histograms recorded so far, keyed by name."""
+        return self._histograms
+
+    def reset(self) -> None:
+        """Throw away everything recorded."""
+        self._histograms = {}
+
+    def slowest(self, limit: Optional[int] = None) -> list[tuple[str, Histogram]]:
+        """Get (name, histogram) pairs, the largest total time first."""
+        rows = sorted(self._histograms.items(), key=lambda item: item[1].mean * item[1].count, reverse=True)
+        return rows[:limit]
+
+    def report(self, limit: Optional[int] = None) -> list[str]:
+        """Format the histograms as lines of a table in milliseconds, the largest total first."""
+        lines = [f"{'stage':32} {'count':>7} {'mean':>7} {'p50':>7} {'p99':>7} {'max':>7}"]
+        for (name, h) in self.slowest(limit):
+            lines.append(f"{name[:32]:32} {h.count:7} {h.mean*1e3:7.2f} {h.percentile(50)*1e3:7.2f} "
+                         f"{h.percentile(99)*1e3:7.2f} {h.max*1e3:7.2f}")
+        return lines
+
+    def dump(self, path: Optional[str] = None) -> None:
+        """Write the report to stderr, or append it to the file at path."""
+        text = "\n".join(self.report()) + "\n"
+        if path is None:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            return
+        with open(path, "a") as out:
+            out.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            out.write(text)
+
+
+def _launched() -> float:
+    """Get the perf_counter() reading when this process was started, as near as it can be told."""
+    try:
+        with open("/proc/self/stat") as stat:
+            # The fields after the command name, which may hold spaces, start at the third
+            started = int(stat.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as uptime:
+            return time.perf_counter() - (float(uptime.read().split()[0]) - started)
+    except (OSError, ValueError, IndexError):
+        return _imported
+
+
+def process_age() -> float:
+    """Get the seconds since this process was started.
+
+    The start is read from /proc, to the resolution of the kernel's clock tick,
+    so the interpreter starting and the imports are counted. Elsewhere it is
+    measured from this module being imported
+    """
+    global _launch
+    if _launch is None:
+        _launch = _launched()
+    return time.perf_counter() - _launch
+
+
+class Startup:
+    """Seconds from the process starting to each milestone on the way to the first frame.
+
+    Off by default, when mark() does nothing
+    """
+
+    def __init__(self):
+        """Create a disabled recorder with no milestones."""
+        self.enabled = False
+        self._marks: list[tuple[str, float]] = []
+
+    def marks(self) -> list[tuple[str, float]]:
+        """Get the (milestone, seconds since the process started) pairs, in the order they were reached."""
+        return self._marks
+
+    def mark(self, name: str) -> None:
+        """Record reaching the milestone name."""
+        if self.enabled:
+            self._marks.append((name, process_age()))
+
+    def report(self) -> list[str]:
+        """Format the milestones as lines of a table in milliseconds, with the time since the one before."""
+        lines = [f"{'milestone':32} {'at':>8} {'step':>8}"]
+        last = 0.0
+        for (name, at) in self._marks:
+            lines.append(f"{name[:32]:32} {at*1e3:8.1f} {(at - last)*1e3:8.1f}")
+            last = at
+        return lines
+
+    def dump(self) -> None:
+        """Write the report to stderr."""
+        sys.stderr.write("\n".join(self.report()) + "\n")
+        sys.stderr.flush()
+
+
+_imported = time.perf_counter()
+_launch: Optional[float] = None
+
+# Shared by everything which is instrumented
+timings = Timings()
+startup = Startup()
+
+
+def enable(dump_path: Optional[str] = None, signum: int = signal.SIGUSR1) -> None:
+    """Turn timing on and dump the report to stderr, or dump_path, when the process gets signum."""
+    timings.enabled = True
+    signal.signal(signum, lambda _signum, _frame: timings.dump(dump_path))
+
+
+def from_environ(environ: Mapping[str, str] = os.environ) -> bool:
+    """Turn on what the environment asks for, returning whether timing is on so a caller can show the overlay.
+
+    Call it from an entry point once its imports are done. FB_STARTUP prints how
+    long each step from launch to the first frame took. FB_TIMINGS turns timing
+    on, and kill -USR1 dumps it to stderr, or appends it to $FB_TIMINGS_FILE
+    """
+    if environ.get("FB_STARTUP"):
+        startup.enabled = True
+    startup.mark("imported")
+    if environ.get("FB_TIMINGS"):
+        enable(environ.get("FB_TIMINGS_FILE"))
+    return timings.enabled
@@ -4,3 +4,4 @@ from collections import namedtuple
 Point = namedtuple("Point", "x y")
 Dimension = namedtuple("Dimension", "w h")
 Color = namedtuple("Color", "r g b a")
+Rect = namedtuple("Rect", "x0 y0 x1 y1")
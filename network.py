@@ -1,9 +1,8 @@
 import logging
 import psutil
 import datetime
-from PIL import ImageFont
+from PIL import Image, ImageFont
 from PIL.ImageColor import getrgb
-from collections import deque
 from widgets import (
     Widget,
     TitleDecorator,
@@ -11,66 +10,216 @@ from widgets import (
     Screen,
     Point,
     Dimension,
-    WidgetDecorator
+    WidgetDecorator,
+    TimingOverlayWidget
     )
 from periodic import Periodic
+from instrument import timings
+from textcache import glyph_atlas
+from fonts import fonts
+import instrument
+from samplers import Sampler, counter_delta
 import asyncio
-from typing import cast, Tuple
+from array import array
+from typing import cast, Tuple, Callable, Optional
 from math import floor
-from local_types import Color, Dimension
+from local_types import Color, Dimension, Rect
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 white: Color = getrgb("white")
 black: Color = getrgb("black")
 blue: Color  = getrgb("blue")
 
 MAX_SAMPLES: int = 400
-graph_font = ImageFont.truetype("inconsolata.ttf", 24)
 
+# Up to this many new columns are drawn as rectangles, more are rasterised into a mask in one go
+FEW_COLUMNS: int = 8
 
-class IfSampler:
-    """Class to sample some statistics from an ether interface."""
+# Units of 1024 the axis labels step through, so a label never needs more than four characters
+LABEL_UNITS: str = "KMGTPE"
 
-    def __init__(self, ifname, attribute, sample_len):
-        """Create a new sampler for a specific interface."""
-        self._ifname = ifname
-        self._attribute = attribute
-        self._sample_len = sample_len
-        self._buffer = deque(maxlen=sample_len)
-        self._last_sample_ts = datetime.datetime.now()
-        sample = psutil.net_io_counters(pernic=True)[self._ifname]
-        self._last_sample = getattr(sample, attribute)
-        self._scrape = Periodic(self._do_scrape, 1)
+# The widest labels axis_label() can produce, which the space for them is measured from
+WIDEST_LABELS: tuple[str, ...] = ("999",) + tuple(f"{digits}{unit}" for unit in LABEL_UNITS for digits in ("999", "9.9"))
+
+
+def axis_label(value: float) -> str:
+    """Format a number of bytes in at most four characters, e.g. 512, 1.5K, 97K or 512M."""
+    unit = ""
+    for next_unit in LABEL_UNITS:
+        if value < 999.5:
+            break
+        (value, unit) = (value / 1024, next_unit)
+    return f"{value:.1f}{unit}" if unit and value < 9.95 else f"{value:.0f}{unit}"
+
+
+class CounterHub:
+    """Class to read the counters for every interface once per tick and share them.
+
+    However many samplers subscribe, /proc/net/dev is only parsed once per tick
+    and every subscriber sees the same counters and timestamp. A subscriber
+    which raises is logged and the rest are still called
+    """
+
+    _default: Optional["CounterHub"] = None
+
+    def __init__(self, interval: int = 1):
+        """Create a new hub reading the counters every interval seconds."""
+        self._subscribers: list[Callable[[dict, datetime.datetime], None]] = []
+        self._counters = psutil.net_io_counters(pernic=True)
+        self._counters_ts = datetime.datetime.now()
+        self._interval = interval
+        self._scrape = Periodic(self._do_scrape, interval)
+
+    @classmethod
+    def default(cls) -> "CounterHub":
+        """Get the hub shared by samplers which aren't given one."""
+        if cls._default is None:
+            cls._default = CounterHub()
+        return cls._default
+
+    @property
+    def interval(self) -> int:
+        """Get the seconds between reads."""
+        return self._interval
+
+    @property
+    def counters(self) -> dict:
+        """Get the most recent counters for all interfaces, keyed by interface name."""
+        return self._counters
+
+    @property
+    def counter_bits(self) -> Optional[int]:
+        """Get the width the counters wrap at, None as /proc/net/dev doesn't say."""
+        return None
+
+    def subscribe(self, callback: Callable[[dict, datetime.datetime], None]) -> None:
+        """Call callback(counters, timestamp) with the counters for all interfaces every tick."""
+        self._subscribers.append(callback)
 
     async def start(self):
         return await self._scrape.start()
 
     def _do_scrape(self):
-        sample = psutil.net_io_counters(pernic=True)[self._ifname]
+        with timings.time("sampler.scrape"):
+            self._counters = psutil.net_io_counters(pernic=True)
+        self._counters_ts = datetime.datetime.now()
+        with timings.time("sampler.fanout"):
+            for callback in self._subscribers:
+                try:
+                    callback(self._counters, self._counters_ts)
+                except Exception:
+                    logger.exception("%r failed on the counters", callback)
+
+
+class IfSampler(Sampler):
+    """Class to sample some statistics from an ether interface."""
+
+    def __init__(self, ifname, attribute, sample_len, hub: Optional[CounterHub] = None, tiers=(),
+                 history: Optional[str] = None, counter_bits: Optional[int] = None):
+        """Create a new sampler for a specific interface, fed by hub or the shared default hub.
+
+        As well as the last sample_len samples, the samples can be rolled up into
+        tiers, a list of (seconds per slot, number of slots) such as
+        rollup.DEFAULT_TIERS, for graphs of a longer span. If history is a path
+        prefix, ideally on tmpfs, all of them are kept in memory mapped files there
+        and graphs pick up where they left off after a restart.
+
+        counter_bits is the width the counter wraps at, the hub's if not given.
+        Where neither knows, a counter going backwards is taken as a reset unless
+        it has been above 32 bits, see samplers.counter_delta()
+        """
+        super().__init__(hub if hub is not None else CounterHub.default(), sample_len, tiers=tiers, history=history)
+        self._ifname = ifname
+        self._attribute = attribute
+        self._counter_bits = counter_bits if counter_bits is not None else self._hub.counter_bits
+        sample = self._hub.counters[self._ifname]
+        self._last_sample = getattr(sample, attribute)
+        self._hub.subscribe(self._on_counters)
+
+    def _on_counters(self, counters, timestamp):
+        sample = counters.get(self._ifname)
+        if sample is None:
+            # Interface has gone away, possibly only for now
+            return
         val = getattr(sample, self._attribute)
         last_val = self._last_sample
-        delta = val - last_val
+        # Counters wrap, e.g. at 32 bits after 4 GiB which takes 3.4s at 10 Gbit/s
+        delta = counter_delta(val, last_val, self._counter_bits)
         self._last_sample = val
-        self._last_sample_ts = datetime.datetime.now()
-        self._buffer.append(delta)
-
-    @property
-    def last_sample(self):
-        return self._last_sample
-
-    def copy(self):
-        return self._buffer.copy()
+        self._append(delta, timestamp)
+
+
+def column_mask(spans, height: int, column_width: int, rows: Optional[list] = None) -> Image.Image:
+    """Rasterise columns into a mode "1" mask in one go.
+
+    spans holds a (top, bottom) pair of heights above the bottom edge for each
+    column, filled between the two. Each column is built as a row of a mask
+    lying on its side with one bytes join for the lot, then the mask is turned
+    upright and widened to column_width in C. rows, if given, holds the bytes
+    for every top with a bottom of 0
+    """
+    clear = bytes(height)
+    solid = b"\xff" * height
+    if rows is not None:
+        data = b"".join([rows[top] if bottom == 0 else clear[:height - top] + solid[:top - bottom] + clear[:bottom]
+                         for (top, bottom) in spans])
+    else:
+        data = b"".join([clear[:height - top] + solid[:top - bottom] + clear[:bottom] for (top, bottom) in spans])
+    mask = Image.frombytes("L", (height, len(spans)), data).transpose(Image.Transpose.TRANSPOSE)
+    if column_width != 1:
+        mask = mask.resize((len(spans) * column_width, height), Image.Resampling.NEAREST)
+    # Pasting through a bilevel mask copies pixels where an L mask would blend them
+    return mask.convert("1", dither=Image.Dither.NONE)
 
 
 class SeriesGraph(Widget):
-
-    def __init__(self, sampler, size: Dimension, background=black,  **kwargs):
-        super().__init__(size, background=background, **kwargs)
-        self._sampler = sampler
+    """Scrolling bar graph of a sampler's history, one 2px column per sample.
+
+    Only the newly arrived samples are drawn each frame; the existing graph is
+    scrolled left to make room for them. Everything is redrawn when the y-axis
+    scale changes.
+
+    tier selects the sampler's raw samples (0) or one of its rollup tiers, and
+    stat which aggregate of a rollup tier to plot: sum, max or min. With filled
+    False only the top of each column is drawn, tracing the series as a line
+
+    The samples are copied out of the sampler by update(), so drawing can
+    happen on another thread while the sampler carries on appending. The
+    columns are rasterised into a mask and drawn with one composite per series
+    rather than a line per sample
+    """
+
+    COLUMN_WIDTH: int = 2
+
+    def __init__(self, sampler, size: Dimension, background=black, tier=0, stat="sum", color: Color = white,
+                 filled: bool = True, **kwargs):
+        self._init_graph([sampler], [color], size, background, tier, stat, False, filled, **kwargs)
+
+    def _init_graph(self, samplers, colors, size, background, tier, stat, stacked, filled, **kwargs):
+        # One color only needs to know which pixels are covered
+        kwargs.setdefault("mode", "1" if len(colors) == 1 else "P")
+        super().__init__(size, background=background, ink=colors[0], **kwargs)
+        self._series = [sampler.series(tier, stat) for sampler in samplers]
+        self._inks = [self._surface_color(color) for color in colors]
+        self._stacked = stacked
+        self._filled = filled
+        self._interval = samplers[0].interval(tier)
         self._max = 1
         self._current = 0
+        self._drawn_count = self._series[0].count
+        # Series count and number of columns the backing image was rendered with, None until the first render
+        self._rendered_count = self._drawn_count
+        self._rendered_len: Optional[int] = None
+        # Mask column for every height with nothing below it, the common case
+        clear = bytes(size[1])
+        solid = b"\xff" * size[1]
+        self._rows = [clear[:size[1] - top] + solid[:top] for top in range(size[1] + 1)]
+        self._samples = self._copy_samples()
         super().draw()
+        # Redraw as soon as there is a new sample rather than polling for it
+        for sampler in samplers:
+            sampler.listen(self.wake)
 
     @property
     def current(self):
@@ -80,30 +229,166 @@ class SeriesGraph(Widget):
     def max(self):
         return self._max
 
+    @property
+    def interval(self):
+        """Get the seconds covered by each column."""
+        return self._interval
+
+    def _copy_samples(self) -> list[memoryview]:
+        """Copy as many samples of each series as there are columns, oldest first, into arrays unaffected by later appends.
+
+        Series which hold different numbers of samples are cut to the shortest so they line up on the right
+        """
+        # A rollup tier can hold more samples than there are columns, only those which fit are copied
+        columns = self._size[0] // SeriesGraph.COLUMN_WIDTH
+        copies = []
+        for series in self._series:
+            views = series.views(columns)
+            samples = array(views[0].format)
+            for view in views:
+                samples.frombytes(view.cast("B"))
+            copies.append(memoryview(samples))
+        length = min(len(samples) for samples in copies)
+        return [samples[len(samples) - length:] for samples in copies]
+
+    def _totals(self, views) -> list:
+        """Get the values the scale has to fit for the columns in views, the sum of the series when stacked."""
+        if self._stacked:
+            return [sum(column) for column in zip(*views)]
+        return [value for view in views for value in view]
+
+    def update(self):
+        if self._series[0].count != self._drawn_count:
+            # ddraw() works out which columns changed
+            self._drawn_count = self._series[0].count
+            self._samples = self._copy_samples()
+            self._set_dirty()
+
     def ddraw(self, drawable):
+        count = self._drawn_count
+        new = count - self._rendered_count
+        self._rendered_count = count
+        views = self._samples
+        length = len(views[0])
+        latest = [view[length - min(new, length):] for view in views]
+        old_max = self._max
+        totals = self._totals(latest)
+        if totals:
+            self._max = max(self._max, max(totals))
+            self._current = totals[-1] if self._stacked else latest[0][-1]
+        if (self._rendered_len is None or self._max != old_max or new >= length
+                or (self._rendered_len + new - length)*SeriesGraph.COLUMN_WIDTH >= self._size[0]):
+            self._draw_all(drawable, views)
+        else:
+            self._scroll(drawable, new, length, latest)
+        self._rendered_len = length
+
+    def _draw_all(self, drawable, views):
+        """Redraw every column, e.g. after the scale changed."""
         super().ddraw(drawable)
+        totals = self._totals(views)
+        if totals:
+            self._max = max(self._max, max(totals))
+        self._draw_columns(drawable, 0, views)
+        self.damage()
+
+    def _scroll(self, drawable, new, length, latest):
+        """Shift the graph left for the samples which dropped off and draw the new ones on the right."""
         (w, h) = self._size
-        series = self._sampler.copy()
-        self._max = max([*series, self._max])
-        # normalize
-        scaled_samples = [x/self._max for x in series]
-        heights = [floor(x*h) for x in scaled_samples]
-        #drawable.rectangle([0, 0, w, h], fill=self._background)
-        s_x = 0
-        for sample in heights:
-            drawable.line([s_x, h, s_x, h-sample], fill=white, width=2)
-            s_x = s_x + 2
-        if len(series) > 0:
-            self._current = series[-1]
+        col = SeriesGraph.COLUMN_WIDTH
+        dropped = self._rendered_len + new - length
+        first = length - new  # Column of the oldest new sample
+        # Columns cover one pixel left of their x, as the width 2 lines they replaced did
+        clear_x = max(first*col - 1, 0)
+        if dropped > 0:
+            dx = dropped*col
+            self._img.paste(self._img.crop((dx, 0, w, h)), (0, 0))
+            clear_x = min(clear_x, w - dx)
+            self.damage()
+        else:
+            self.damage(Rect(clear_x, 0, w, h))
+        if clear_x < w:
+            drawable.rectangle([clear_x, 0, w, h], fill=self._surface_color(self._background))
+        self._draw_columns(drawable, first, latest)
+
+    def _heights(self, view) -> list[int]:
+        """Scale a view of samples to column heights in pixels."""
+        (top, scale) = (self._size[1], self._max)
+        # Nothing is above the max, but a sample can be negative
+        return [floor(x/scale*top) if x > 0 else 0 for x in view]
+
+    def _draw_columns(self, drawable, first, views):
+        """Draw the samples in views as columns starting at column first."""
+        if len(views[0]) == 0:
+            return
+        h = self._size[1]
+        line = SeriesGraph.COLUMN_WIDTH
+        below = [0] * len(views[0])
+        running = [0] * len(views[0]) if self._stacked else None
+        for (view, ink) in zip(views, self._inks):
+            if running is None:
+                tops = self._heights(view)
+            else:
+                # Each series sits on the ones before it
+                running = [total + x for (total, x) in zip(running, view)]
+                tops = self._heights(running)
+            if self._filled:
+                spans = [(top, bottom if bottom < top else top) for (top, bottom) in zip(tops, below)]
+            else:
+                # Just the top of each column, as thick as a column is wide even where the series is 0
+                spans = []
+                for (top, bottom) in zip(tops, below):
+                    top = min(max(top, bottom + line), h)
+                    spans.append((top, max(top - line, 0)))
+            self._fill_spans(drawable, first, spans, ink)
+            if running is not None:
+                below = tops
+
+    def _fill_spans(self, drawable, first, spans, ink):
+        """Fill the (top, bottom) spans of columns starting at column first with ink, a value for the surface."""
+        (h, col) = (self._size[1], SeriesGraph.COLUMN_WIDTH)
+        # Columns cover one pixel left of their x, as the width 2 lines they replaced did
+        x = first*col - 1
+        if len(spans) > FEW_COLUMNS:
+            self._img.paste(ink, (x, 0), column_mask(spans, h, col, self._rows))
+            return
+        for (top, bottom) in spans:
+            if top > bottom:
+                drawable.rectangle([x, h - top, x + col - 1, h - bottom - 1], fill=ink)
+            x += col
+
+
+class MultiSeriesGraph(SeriesGraph):
+    """Several samplers on one scale, each in its own colour, drawn as SeriesGraph draws one.
+
+    The series are overlaid, later ones in front, or stacked with each on top
+    of the ones before it. With filled False only the top of each series is drawn
+    """
+
+    def __init__(self, samplers, size: Dimension, colors: list[Color], stacked: bool = False, filled: bool = True,
+                 background=black, tier=0, stat="sum", **kwargs):
+        self._init_graph(list(samplers), list(colors), size, background, tier, stat, stacked, filled, **kwargs)
 
 
 class SeriesGraphDecorator(WidgetDecorator):
 
+    @classmethod
+    def _max_label_box(cls, font: ImageFont) -> Rect:
+        """Get the box covering any upper left axis tag, drawn at (0, 0)."""
+        atlas = glyph_atlas(font)
+        boxes = [atlas.bbox(label, anchor="la") for label in WIDEST_LABELS]
+        return Rect(0, 0, max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+    @classmethod
+    def _span_label(cls, widget: SeriesGraph) -> str:
+        """Get the lower left axis tag, the minutes of history the graph spans."""
+        return f"-{(widget.size[0]//2)*widget.interval//60}"
+
     @classmethod
     def _get_loc(cls, font: ImageFont) -> Point:
         # origin of the graph is 1px right of left axis and 1/2 way down upper left label
         # Upper Left axis tag
-        (_, _, ul_fw, fh) = font.getbbox("9999", anchor="la")  # MiB/s
+        (_, _, ul_fw, fh) = cls._max_label_box(font)
         oy = fh//2
         ox = 5 + ul_fw
         return Point(ox, oy)
@@ -120,60 +405,82 @@ class SeriesGraphDecorator(WidgetDecorator):
         dh = h + 5
 
         # Lower Left axis tag
-        (_, _, ll_fw, fh) = font.getbbox(f"-{(w//2)//60}", anchor="la")
+        atlas = glyph_atlas(font)
+        (_, _, ll_fw, fh) = atlas.bbox(cls._span_label(widget), anchor="la")
         dh = dh + fh
 
         # Lower right axis tag
-        (_, _, fw, _) = font.getbbox("now", anchor="la")
+        (_, _, fw, _) = atlas.bbox("now", anchor="la")
         dw = dw + fw/2
 
         # Upper Left axis tag
-        (_, _, ul_fw, fh) = font.getbbox("9999", anchor="la")  # MiB/s
+        (_, _, ul_fw, fh) = cls._max_label_box(font)
         dw = dw + max(ul_fw, ll_fw//2)
         dh = dh + fh//2
 
         return Dimension(int(dw), int(dh))
 
-    def __init__(self, widget: SeriesGraph, font: ImageFont, **kwargs):
+    def __init__(self, widget: SeriesGraph, font: Optional[ImageFont] = None, **kwargs):
+        font = font or fonts.get()
         super().__init__(widget,
                          size=SeriesGraphDecorator._get_size(widget, font),
                          origin=SeriesGraphDecorator._get_loc(font),
                          **kwargs)
         self._font = font
         self._origin = self._get_loc(font)
+        self._max_label = self._get_max_label()
+
+    def _get_max_label(self) -> str:
+        return axis_label(self._widget.max)
+
+    def _update_chrome(self):
+        # The upper left axis tag follows the scale of the graph
+        label = self._get_max_label()
+        if label != self._max_label:
+            atlas = glyph_atlas(self._font)
+            self._invalidate_chrome(Rect(*atlas.bbox(self._max_label)))
+            self._invalidate_chrome(Rect(*atlas.bbox(label)))
+            self._max_label = label
 
     def _decorate(self, drawable):
         (ox, oy) = self._origin
         (ww, wh) = self._widget.size
         drawable.line([ox-2, oy, ox-2, oy+wh+1], fill=blue, width=2)  # Y axis
         drawable.line([ox-1, oy+wh+1, ox-1+ww, oy+wh+1], fill=blue, width=2)  # X axis
+        atlas = glyph_atlas(self._font)
         # Upper left axis tag
-        maxInKiB = self._widget.max//1024
-        drawable.text((0, 0), f"{maxInKiB}")
-        # Bottom left axix label
-        (_, _, fw, fh) = self._font.getbbox(f"-{(ww/2)//60}", anchor="la")
-        drawable.text((ox-1-fw/2, oy+4+wh), f"-{(ww/2)//60}", anchor="la")
+        atlas.draw(drawable, (0, 0), self._max_label, fill=white, anchor="la")
+        # Bottom left axix label, in minutes of history
+        span = self._span_label(self._widget)
+        (_, _, fw, fh) = atlas.bbox(span, anchor="la")
+        atlas.draw(drawable, (ox-1-fw/2, oy+4+wh), span, fill=white, anchor="la")
 
 
 if __name__ == "__main__":
     from fb import DirectFB
+    logging.basicConfig(level=logging.INFO)
+    timing = instrument.from_environ()
     fb = DirectFB()
-    sent_sampler = IfSampler("eth0.2", "bytes_sent", MAX_SAMPLES)
-    recv_sampler = IfSampler("eth0.2", "bytes_recv", MAX_SAMPLES)
+    # /tmp is tmpfs on OpenWRT so keeping history there costs no flash writes
+    sent_sampler = IfSampler("eth0.2", "bytes_sent", MAX_SAMPLES, history="/tmp/openwrt-fb/eth0.2.bytes_sent")
+    recv_sampler = IfSampler("eth0.2", "bytes_recv", MAX_SAMPLES, history="/tmp/openwrt-fb/eth0.2.bytes_recv")
     with fb as display:
         display.clear(Color(128, 128, 128, 255))
 
         ssg = SeriesGraph(sent_sampler, size=Dimension(MAX_SAMPLES*2, 80))
-        ssgd = SeriesGraphDecorator(ssg, graph_font)
+        ssgd = SeriesGraphDecorator(ssg)
         sent = TitleDecorator(BorderDecorator(ssgd, border_width=24), "eth0.2:sent")
         recv = TitleDecorator(
             BorderDecorator(
                 SeriesGraphDecorator(
-                    SeriesGraph(recv_sampler, size=Dimension(MAX_SAMPLES*2, 80)),
-                    graph_font),
+                    SeriesGraph(recv_sampler, size=Dimension(MAX_SAMPLES*2, 80))),
                 border_width=24),
             "eth0.2:recv")
         widgets: list[Tuple[Widget, Point]] = [(sent, Point(40, 40)), (recv, Point(40, 200))]
+        if timing:
+            widgets.append((TimingOverlayWidget(Dimension(560, 120), font=fonts.get(14)),
+                            Point(40, 360)))
+        instrument.startup.mark("widgets built")
         screen = Screen(display, widgets)
 
         loop = asyncio.get_event_loop()
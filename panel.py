@@ -2,25 +2,21 @@ from widgets import BorderDecorator, TitleDecorator,  Widget, BarGaugeWidget
 from network import IfSampler, SeriesGraph, SeriesGraphDecorator
 from local_types import Color, Dimension, Point
 from typing import Tuple
-from PIL import ImageFont
 
 MAX_SAMPLES: int = 400
 
 GiB: int = 1024*1024*1024
 
-graph_font = ImageFont.truetype("inconsolata.ttf", 24)
-
 
 def panel(sent_sampler, recv_sampler) -> list[Tuple[Widget, Point]]:
     """Create a panel of statistics"""
     ssg = SeriesGraph(sent_sampler, size=Dimension(MAX_SAMPLES * 2, 80))
-    ssgd = SeriesGraphDecorator(ssg, graph_font)
+    ssgd = SeriesGraphDecorator(ssg)
     sent = TitleDecorator(BorderDecorator(ssgd, border_width=24), "eth0:sent")
     recv = TitleDecorator(
         BorderDecorator(
             SeriesGraphDecorator(
-                SeriesGraph(recv_sampler, size=Dimension(MAX_SAMPLES*2, 80)),
-                graph_font),
+                SeriesGraph(recv_sampler, size=Dimension(MAX_SAMPLES*2, 80))),
             border_width=24),
         "eth0:recv")
     sent_bar = BarGaugeWidget(lambda : sent_sampler.last_sample/GiB, size=Dimension(40, 80))
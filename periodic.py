@@ -1,37 +1,145 @@
 import asyncio
 from asyncio import Task
 from contextlib import suppress
+import logging
+import math
 import traceback
 from typing import Any, cast, Optional
+from instrument import timings
+
+logger = logging.getLogger(__name__)
+
+# Jobs due within this many seconds of each other run in the same wakeup
+TICK_SLACK: float = 0.002
+
+
+class Scheduler:
+    """Run every Periodic from one task, aligned to a grid on the loop's monotonic clock.
+
+    A job with an interval of n seconds runs at the multiples of n, so jobs with
+    the same interval share a wakeup and their timestamps line up. The runtime of
+    a job doesn't push later runs back. A job which takes longer than its
+    interval is reported as an overrun, and any ticks missed while the loop was
+    busy are coalesced into the next tick on the grid rather than queued
+    """
+
+    _default: Optional["Scheduler"] = None
+
+    def __init__(self):
+        self._jobs: list[Periodic] = []
+        self._task: Optional[Task[Any]] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    @classmethod
+    def default(cls) -> "Scheduler":
+        if cls._default is None:
+            cls._default = Scheduler()
+        return cls._default
+
+    def add(self, job: "Periodic") -> None:
+        loop = asyncio.get_event_loop()
+        job._due = math.floor(loop.time() / job.interval + 1) * job.interval
+        self._jobs.append(job)
+        if self._task is None or self._task.done():
+            self._changed = asyncio.Event()
+            self._task = cast(Task[Any], asyncio.ensure_future(self._run()))
+        elif self._changed is not None:
+            self._changed.set()
+
+    def remove(self, job: "Periodic") -> None:
+        if job in self._jobs:
+            self._jobs.remove(job)
+        if self._changed is not None:
+            self._changed.set()
+
+    async def stop(self) -> None:
+        self._jobs = []
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._jobs:
+            delay = min(job._due for job in self._jobs) - loop.time()
+            if delay > 0:
+                # Sleep until the next tick, waking early if the jobs change
+                self._changed.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                continue
+            now = loop.time()
+            due = [job for job in self._jobs if job._due <= now + TICK_SLACK]
+            if timings.enabled:
+                # How late the loop woke us for the earliest job
+                timings.record("scheduler.late", max(now - min(job._due for job in due), 0.0))
+            for job in due:
+                started = loop.time()
+                job._run_once()
+                runtime = loop.time() - started
+                if runtime > job.interval:
+                    job._overruns += 1
+                    logger.warning("%s overran, took %.3fs", job, runtime)
+            self._reschedule(due, loop.time())
+
+    def _reschedule(self, jobs: list["Periodic"], now: float) -> None:
+        for job in jobs:
+            next_due = job._due + job.interval
+            if next_due <= now:
+                # Coalesce the ticks we slept through into the next one on the grid
+                missed = math.floor((now - job._due) / job.interval)
+                job._missed += missed
+                logger.debug("%s missed %d tick(s)", job, missed)
+                next_due = job._due + (missed + 1) * job.interval
+            job._due = next_due
 
 
 class Periodic:
 
-    def __init__(self, func, time: int):
+    def __init__(self, func, time: int, scheduler: Optional[Scheduler] = None):
         self._func = func
         self._time = time
         self._is_started = False
-        self.__task: Optional[Task[Any]] = None
+        self._scheduler = scheduler
+        self._due: float = 0
+        self._overruns = 0
+        self._missed = 0
+
+    def __repr__(self) -> str:
+        return f"Periodic({getattr(self._func, '__qualname__', self._func)}, {self._time})"
+
+    @property
+    def interval(self) -> int:
+        return self._time
+
+    @property
+    def overruns(self) -> int:
+        """Number of runs which took longer than the interval."""
+        return self._overruns
+
+    @property
+    def missed(self) -> int:
+        """Number of ticks skipped because the loop was busy."""
+        return self._missed
 
     async def start(self) -> None:
         if not self._is_started:
             self._is_started = True
-            # Start task to call func periodically:
-            self.__task = cast(Task[Any], asyncio.ensure_future(self._run()))
+            # Have the scheduler call func periodically:
+            if self._scheduler is None:
+                self._scheduler = Scheduler.default()
+            self._scheduler.add(self)
 
     async def stop(self) -> None:
         if self._is_started:
             self._is_started = False
-            # Stop task and await it stopped:
-            if self.__task is not None:
-                self.__task.cancel()
-                with suppress(asyncio.CancelledError):
-                    await self.__task
+            if self._scheduler is not None:
+                self._scheduler.remove(self)
 
-    async def _run(self) -> None:
-        while True:
-            await asyncio.sleep(self._time)
-            try:
-                self._func()
-            except Exception as e:
-                traceback.print_tb(e.__traceback__)
+    def _run_once(self) -> None:
+        try:
+            self._func()
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
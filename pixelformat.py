@@ -0,0 +1,206 @@
+"""Conversion of RGBA images into the native pixel layout of a framebuffer."""
+from __future__ import annotations
+from PIL import Image, ImageChops
+from local_types import Dimension, Rect
+
+# Layouts PIL can pack an RGBA image into directly, and their size in bytes per pixel
+_PIL_RAWMODES: dict[str, int] = {
+    "BGRA": 4,
+    "RGBA": 4,
+    "BGR": 3,
+    "RGB": 3,
+}
+
+# 16bpp layouts which have to be assembled from the bands, stored little endian
+_PACKED_RAWMODES: dict[str, int] = {
+    "RGB565": 2,  # red in the top 5 bits
+    "BGR565": 2,  # blue in the top 5 bits
+}
+
+# Bytes of pixels encoded at a time when packing straight into a buffer, in whole rows
+PACK_BYTES: int = 65536
+
+# Lookup tables for the two bytes of a 5-6-5 pixel
+_HI_5 = [v & 0xf8 for v in range(256)]
+_HI_6 = [v >> 5 for v in range(256)]
+_LO_6 = [(v << 3) & 0xe0 for v in range(256)]
+_LO_5 = [v >> 3 for v in range(256)]
+
+
+def _can_encode_into() -> bool:
+    """Check PIL still has the encoder interface pack_into() drives, which isn't public."""
+    getencoder = getattr(Image, "_getencoder", None)
+    if getencoder is None:
+        return False
+    try:
+        encoder = getencoder("RGBA", "raw", ("RGBA", 0))
+    except Exception:
+        return False
+    return hasattr(encoder, "setimage") and hasattr(encoder, "encode")
+
+
+class PixelFormat:
+    """Layout of pixels in a framebuffer's memory.
+
+    Rows are line_length bytes apart, which may be more than the visible width
+    when the driver pads them. The conversion is chosen once when the format is
+    created so the per frame path is a single encode straight into the device layout
+    """
+
+    def __init__(self, rawmode: str, size: Dimension, line_length: int = 0):
+        """Create a pixel format.
+
+        Parameters
+        ----------
+        rawmode: str
+            byte layout of a pixel, one of BGRA, RGBA, BGR, RGB, RGB565 or BGR565
+        size: Dimension
+            visible size of the framebuffer in pixels
+        line_length: int
+            bytes from the start of one row to the next, or 0 if rows are not padded
+        """
+        if rawmode in _PIL_RAWMODES:
+            self._bytes_per_pixel = _PIL_RAWMODES[rawmode]
+            self._packer = self._pack_pil
+        elif rawmode in _PACKED_RAWMODES:
+            self._bytes_per_pixel = _PACKED_RAWMODES[rawmode]
+            self._packer = self._pack_565
+        else:
+            raise ValueError(f"Unsupported framebuffer pixel format {rawmode}")
+        self._rawmode = rawmode
+        self._size = size
+        self._line_length = max(line_length, size[0] * self._bytes_per_pixel)
+        # Encoding into the target needs PIL's encoder, without it the rect is packed and copied
+        self._encode_into = self._packer == self._pack_pil and _can_encode_into()
+
+    @classmethod
+    def from_bitfields(cls, bpp: int, red_offset: int, blue_offset: int,
+                       size: Dimension, line_length: int = 0) -> PixelFormat:
+        """Choose the format matching the channel offsets reported by the framebuffer driver."""
+        red_first = red_offset < blue_offset
+        if bpp == 32:
+            rawmode = "RGBA" if red_first else "BGRA"
+        elif bpp == 24:
+            rawmode = "RGB" if red_first else "BGR"
+        elif bpp == 16:
+            rawmode = "BGR565" if red_first else "RGB565"
+        else:
+            raise ValueError(f"Unsupported framebuffer depth {bpp}bpp")
+        return cls(rawmode, size, line_length)
+
+    @classmethod
+    def from_bpp(cls, bpp: int, size: Dimension, line_length: int = 0) -> PixelFormat:
+        """Guess the format when the driver can't tell us, assuming the common little endian layouts."""
+        return cls.from_bitfields(bpp, 11 if bpp == 16 else 16, 0, size, line_length)
+
+    @property
+    def rawmode(self) -> str:
+        """Get the byte layout of a pixel."""
+        return self._rawmode
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        """Get the size of a pixel in bytes."""
+        return self._bytes_per_pixel
+
+    @property
+    def line_length(self) -> int:
+        """Get the distance between the start of two rows in bytes."""
+        return self._line_length
+
+    def is_full_width(self, rect: Rect) -> bool:
+        """Check if rect covers whole rows, which are packed with their padding."""
+        return rect.x0 == 0 and rect.x1 == self._size[0]
+
+    def pack(self, img: Image, rect: Rect) -> bytes:
+        """Convert img, the RGBA contents of rect, to the device layout.
+
+        Rows spanning the whole screen are padded to line_length so they can be
+        copied to the framebuffer in one go, other rows are packed tightly
+        """
+        stride = self._line_length if self.is_full_width(rect) else 0
+        return self._packer(img, stride)
+
+    def pack_into(self, img: Image, rect: Rect, target, base: int = 0) -> None:
+        """Convert rect of img, the whole RGBA screen, to the device layout in its place in target.
+
+        target is any writable buffer laid out like the framebuffer from base on,
+        such as the mapped device. PIL encodes a block of rows at a time which is
+        copied straight to where it goes, so neither the rect nor its packed pixels
+        are copied whole on the way
+        """
+        if not self._encode_into:
+            # The 5-6-5 bytes are assembled from bands of the rect alone, as are the rest without the encoder
+            self.copy_rows(self.pack(img.crop(rect), rect), rect, target, base)
+            return
+        full = self.is_full_width(rect)
+        row = self._line_length if full else (rect.x1 - rect.x0)*self._bytes_per_pixel
+        # The encoder tobytes() uses, but handed the rect and emptied a block at a time
+        encoder = Image._getencoder("RGBA", "raw", (self._rawmode, self._line_length if full else 0))
+        img.load()
+        encoder.setimage(img.im, rect)
+        offset = base + self._offset(rect)
+        block = max(PACK_BYTES // row, 1)*row
+        status = 0
+        while not status:
+            (_, status, rows) = encoder.encode(block)
+            if status < 0:
+                raise RuntimeError(f"Encoder error {status} packing {rect}")
+            if full:
+                target[offset:offset + len(rows)] = rows
+            else:
+                self._copy_tight(memoryview(rows), row, target, offset)
+            offset += len(rows) // row*self._line_length
+
+    def copy_into(self, source, rect: Rect, target, base: int = 0) -> None:
+        """Copy rect from source, a buffer holding the whole screen in this layout, to the same place in target from base on."""
+        source = memoryview(source).cast("B")
+        start = self._offset(rect)
+        if self.is_full_width(rect):
+            length = (rect.y1 - rect.y0)*self._line_length
+            target[base + start:base + start + length] = source[start:start + length]
+            return
+        row = (rect.x1 - rect.x0)*self._bytes_per_pixel
+        for offset in range(start, start + (rect.y1 - rect.y0)*self._line_length, self._line_length):
+            target[base + offset:base + offset + row] = source[offset:offset + row]
+
+    def copy_rows(self, packed, rect: Rect, target, base: int = 0) -> None:
+        """Copy rect, packed as pack() packs it, to its place in target from base on."""
+        offset = base + self._offset(rect)
+        if self.is_full_width(rect):
+            target[offset:offset + len(packed)] = packed
+            return
+        self._copy_tight(memoryview(packed), (rect.x1 - rect.x0)*self._bytes_per_pixel, target, offset)
+
+    def extract(self, source, rect: Rect):
+        """Get rect from source, a buffer holding the whole screen in this layout, packed as pack() packs it."""
+        source = memoryview(source).cast("B")
+        start = self._offset(rect)
+        if self.is_full_width(rect):
+            return source[start:start + (rect.y1 - rect.y0)*self._line_length]
+        row = (rect.x1 - rect.x0)*self._bytes_per_pixel
+        return b"".join(source[offset:offset + row]
+                        for offset in range(start, start + (rect.y1 - rect.y0)*self._line_length, self._line_length))
+
+    def _offset(self, rect: Rect) -> int:
+        """Get the offset of the top left pixel of rect."""
+        return rect.y0*self._line_length + rect.x0*self._bytes_per_pixel
+
+    def _copy_tight(self, packed: memoryview, row: int, target, offset: int) -> None:
+        """Copy rows of row bytes packed one after another to rows line_length apart in target from offset on."""
+        for start in range(0, len(packed), row):
+            target[offset:offset + row] = packed[start:start + row]
+            offset += self._line_length
+
+    def _pack_pil(self, img: Image, stride: int) -> bytes:
+        """Let PIL reorder the channels as it encodes."""
+        return img.tobytes("raw", (self._rawmode, stride))
+
+    def _pack_565(self, img: Image, stride: int) -> bytes:
+        """Build the high and low bytes of each pixel as bands and interleave them."""
+        (r, g, b, _) = img.split()
+        if self._rawmode == "BGR565":
+            (r, b) = (b, r)
+        hi = ImageChops.add(r.point(_HI_5), g.point(_HI_6))
+        lo = ImageChops.add(g.point(_LO_6), b.point(_LO_5))
+        return Image.merge("LA", (lo, hi)).tobytes("raw", ("LA", stride))
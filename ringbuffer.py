@@ -0,0 +1,151 @@
+"""Fixed capacity ring buffer for sample history."""
+from __future__ import annotations
+import os
+import mmap
+import struct
+from array import array
+from typing import Iterator, Optional, Tuple
+
+# Header of a mapped ring buffer file: magic, version, typecode, capacity, head, length, count
+HEADER_FORMAT = "<4sBc2xIIIQ4x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = b"FBRB"
+VERSION = 1
+
+
+class RingBuffer:
+    """Ring buffer of numbers stored unboxed in an array.
+
+    Consumers read the contents through views() which returns read-only memoryviews
+    of the backing array, so nothing is copied or boxed until a value is used
+    """
+
+    def __init__(self, capacity: int, typecode: str = "q", data=None):
+        """Create an empty ring buffer.
+
+        Parameters
+        ----------
+        capacity: int
+            number of samples kept before the oldest are overwritten
+        typecode: str
+            array typecode for the samples, signed 64 bit integers by default
+        data: buffer
+            writable storage for capacity samples of typecode, a new array if None
+        """
+        self._data = data if data is not None else array(typecode, bytes(array(typecode).itemsize * capacity))
+        self._view = memoryview(self._data).toreadonly()
+        self._capacity = capacity
+        self._head = 0  # Index the next sample is written to
+        self._len = 0
+        self._count = 0
+
+    @property
+    def capacity(self) -> int:
+        """Get the maximum number of samples held."""
+        return self._capacity
+
+    @property
+    def count(self) -> int:
+        """Get the total number of samples ever appended, so consumers can tell when there is new data."""
+        return self._count
+
+    def append(self, value) -> None:
+        """Add a sample, overwriting the oldest if the buffer is full."""
+        self._data[self._head] = value
+        self._head = (self._head + 1) % self._capacity
+        if self._len < self._capacity:
+            self._len += 1
+        self._count += 1
+        self._save_state()
+
+    def _save_state(self) -> None:
+        """Persist the position of the ring after an append, for buffers with persistent storage."""
+        pass
+
+    def views(self, last: Optional[int] = None) -> Tuple[memoryview, memoryview]:
+        """Get the samples, oldest first, as two read-only slices split where the buffer wraps.
+
+        If last is given only that many of the most recent samples are included
+        """
+        if self._len < self._capacity:
+            (older, newer) = (self._view[:0], self._view[:self._len])
+        else:
+            (older, newer) = (self._view[self._head:], self._view[:self._head])
+        if last is None or last >= self._len:
+            return (older, newer)
+        if last <= len(newer):
+            return (newer[:0], newer[len(newer) - last:])
+        return (older[len(older) - (last - len(newer)):], newer)
+
+    def last(self) -> Optional[float]:
+        """Get the most recent sample, or None if there aren't any."""
+        if self._len == 0:
+            return None
+        return self._data[self._head - 1]
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator:
+        for view in self.views():
+            yield from view
+
+    def copy(self) -> list:
+        """Get the samples, oldest first, as a new list."""
+        return list(self)
+
+
+class MappedRingBuffer(RingBuffer):
+    """Ring buffer kept in a memory mapped file so the history survives a restart.
+
+    The file is a small fixed header followed by capacity samples in native byte
+    order. Appends write straight into the mapping and never fsync, so on tmpfs
+    nothing touches flash and elsewhere the kernel writes pages back at its own
+    pace. A file with a different capacity or typecode is started afresh
+    """
+
+    def __init__(self, path: str, capacity: int, typecode: str = "q"):
+        """Map, or create, the ring buffer at path."""
+        itemsize = array(typecode).itemsize
+        size = HEADER_SIZE + itemsize*capacity
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER_SIZE, 0)
+            state = None
+            if len(header) == HEADER_SIZE and os.fstat(fd).st_size == size:
+                (magic, version, stored_typecode, stored_capacity, head, length, count) = \
+                    struct.unpack(HEADER_FORMAT, header)
+                if (magic, version, stored_typecode, stored_capacity) == (MAGIC, VERSION, typecode.encode(), capacity) \
+                        and head < capacity and length <= capacity:
+                    state = (head, length, count)
+            if state is None:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._path = path
+        self._typecode = typecode
+        super().__init__(capacity, typecode, memoryview(self._mmap)[HEADER_SIZE:].cast(typecode))
+        if state is not None:
+            (self._head, self._len, self._count) = state
+        self._save_state()
+
+    @property
+    def path(self) -> str:
+        """Get the file backing this buffer."""
+        return self._path
+
+    def _save_state(self) -> None:
+        """Record the position of the ring in the file header."""
+        struct.pack_into(HEADER_FORMAT, self._mmap, 0,
+                         MAGIC, VERSION, self._typecode.encode(), self._capacity, self._head, self._len, self._count)
+
+    def close(self) -> None:
+        """Unmap the file. Views handed out must have been released."""
+        self._view.release()
+        self._data.release()
+        self._mmap.close()
@@ -0,0 +1,81 @@
+"""Downsampled history tiers for long horizon graphs."""
+from __future__ import annotations
+from typing import Optional
+from ringbuffer import RingBuffer, MappedRingBuffer
+
+# (seconds per slot, number of slots) for samplers to keep on top of the raw samples: a day of minutes and a month of hours.
+# Samplers keep none unless asked, as each tier costs three ring buffers
+DEFAULT_TIERS: tuple[tuple[int, int], ...] = ((60, 1440), (3600, 720))
+
+STATS: tuple[str, ...] = ("sum", "max", "min")
+
+
+class RollupTier:
+    """Ring buffers of the sum, max and min of the samples falling in each interval.
+
+    Samples are aggregated as they arrive and a slot is appended once a sample
+    from a later interval shows up, so only completed intervals are visible.
+    Intervals without a sample, e.g. while the sampler was stalled or stopped,
+    get a slot of zeros so every slot covers one interval.
+    With a history path the completed slots are kept in mapped files; the
+    partially aggregated interval is not and starts again after a restart
+    """
+
+    def __init__(self, interval: int, capacity: int, typecode: str = "q", history: Optional[str] = None):
+        """Create an empty tier.
+
+        Parameters
+        ----------
+        interval: int
+            seconds covered by each slot, slots are aligned to multiples of it
+        capacity: int
+            number of slots kept
+        typecode: str
+            array typecode for the aggregates
+        history: str
+            path prefix for memory mapped files holding the slots, or None to keep them in memory
+        """
+        self._interval = interval
+        if history is None:
+            self._series: dict[str, RingBuffer] = {stat: RingBuffer(capacity, typecode) for stat in STATS}
+        else:
+            self._series = {stat: MappedRingBuffer(f"{history}.{interval}s.{stat}", capacity, typecode) for stat in STATS}
+        self._slot: Optional[int] = None
+        self._sum = 0
+        self._max = 0
+        self._min = 0
+
+    @property
+    def interval(self) -> int:
+        """Get the seconds covered by each slot."""
+        return self._interval
+
+    @property
+    def capacity(self) -> int:
+        """Get the number of slots kept."""
+        return self._series["sum"].capacity
+
+    def series(self, stat: str = "sum") -> RingBuffer:
+        """Get the completed slots for one of the aggregates sum, max or min."""
+        return self._series[stat]
+
+    def add(self, value, timestamp: float) -> None:
+        """Aggregate a sample taken at timestamp (seconds since the epoch)."""
+        slot = int(timestamp // self._interval)
+        if slot != self._slot:
+            if self._slot is not None:
+                self._series["sum"].append(self._sum)
+                self._series["max"].append(self._max)
+                self._series["min"].append(self._min)
+                # More empty slots than the tier holds would only push each other out
+                for _ in range(min(slot - self._slot - 1, self.capacity)):
+                    for series in self._series.values():
+                        series.append(0)
+            self._slot = slot
+            self._sum = self._max = self._min = value
+            return
+        self._sum += value
+        if value > self._max:
+            self._max = value
+        if value < self._min:
+            self._min = value
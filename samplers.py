@@ -0,0 +1,411 @@
+"""Samplers for system metrics read straight from /proc and /sys.
+
+Each file is opened once and read again from offset 0 with preadv into a
+buffer which is reused, so a tick costs one system call per file and the
+numbers are picked out of the bytes without building a line or object per
+field. Files read by several samplers, such as /proc/stat for each core, are
+read once a tick by a shared SourceHub and handed to all of them
+"""
+from __future__ import annotations
+import datetime
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+from instrument import timings
+from periodic import Periodic
+from ringbuffer import RingBuffer, MappedRingBuffer
+from rollup import RollupTier
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a file at first, doubled whenever a read fills the buffer
+READ_SIZE: int = 4096
+
+
+class ProcFile:
+    """File under /proc or /sys kept open and read whole from the start on each read()."""
+
+    def __init__(self, path: str):
+        """Open the file at path, raising OSError if it can't be."""
+        self._path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(READ_SIZE)
+
+    def __repr__(self) -> str:
+        return f"ProcFile({self._path!r})"
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def read(self) -> int:
+        """Read the file into buffer, returning the number of bytes in it."""
+        while True:
+            n = os.preadv(self._fd, [self.buffer], 0)
+            if n < len(self.buffer):
+                return n
+            # Possibly cut short, so read again with room to spare
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class ProcDir:
+    """Directory kept open whose entries are listed again on each read()."""
+
+    def __init__(self, path: str):
+        """Open the directory at path, raising OSError if it can't be."""
+        self._path = path
+        self._fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        self.entries: list[str] = []
+
+    def __repr__(self) -> str:
+        return f"ProcDir({self._path!r})"
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def read(self) -> int:
+        """List the directory into entries, returning how many there are."""
+        # listdir() rewinds a copy of the descriptor, so the directory isn't opened again
+        self.entries = os.listdir(self._fd)
+        return len(self.entries)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def find_line(data: bytearray, end: int, key: bytes) -> int:
+    """Get the offset just past key in data[:end] where key starts a line, or -1 if no line starts with it."""
+    if end >= len(key) and data.startswith(key):
+        return len(key)
+    i = data.find(b"\n" + key, 0, end)
+    return i + 1 + len(key) if i >= 0 else -1
+
+
+def find_int(data: bytearray, end: int, key: bytes) -> Optional[int]:
+    """Get the integer following key at the start of a line of data[:end], or None if there isn't one."""
+    i = find_line(data, end, key)
+    if i < 0:
+        return None
+    while i < end and data[i] == 0x20:
+        i += 1
+    j = i
+    while j < end and 0x30 <= data[j] <= 0x39:
+        j += 1
+    return int(data[i:j]) if j > i else None
+
+
+def counter_delta(value: int, last: int, bits: Optional[int] = None) -> int:
+    """Get how far a counter moved from last to value, allowing for it wrapping at bits.
+
+    A counter which went backwards either wrapped or was reset, e.g. by the
+    interface going down and up. bits is the width the counter wraps at, or
+    None if it isn't known, in which case a counter which has been above 32
+    bits is known to be 64 bits wide and any other going backwards was reset.
+    A wrap which would mean the counter moved by more than half its range is
+    taken to be a reset too. A reset counter counted up from 0 to value
+    """
+    if value >= last:
+        return value - last
+    if bits is None:
+        if last < 1 << 32:
+            return value
+        bits = 64
+    wrapped = value + (1 << bits) - last
+    return wrapped if wrapped < 1 << (bits - 1) else value
+
+
+class SourceHub:
+    """Reads one file or directory every interval and shares it with every subscriber.
+
+    The counterpart of network.CounterHub for sources under /proc and /sys.
+    The source is read as the hub is created, so samplers have a first reading
+    to work from, and then every tick. If a read fails the tick is skipped, the
+    file may be back next time. A subscriber which raises is logged and the
+    rest are still called
+    """
+
+    _shared: dict[tuple[str, int], "SourceHub"] = {}
+
+    def __init__(self, source, interval: int = 1):
+        """Create a hub reading source, a ProcFile or ProcDir, every interval seconds."""
+        self._source = source
+        self._interval = interval
+        self._subscribers: list[Callable[[object, int, datetime.datetime], None]] = []
+        self._length = source.read()
+        self._read_ts = datetime.datetime.now()
+        self._scrape = Periodic(self._do_read, interval)
+
+    @classmethod
+    def shared(cls, path: str, interval: int = 1) -> "SourceHub":
+        """Get the hub shared by samplers reading the file or directory at path every interval seconds."""
+        hub = cls._shared.get((path, interval))
+        if hub is None:
+            source = ProcDir(path) if os.path.isdir(path) else ProcFile(path)
+            hub = cls._shared[(path, interval)] = SourceHub(source, interval)
+        return hub
+
+    @property
+    def interval(self) -> int:
+        """Get the seconds between reads."""
+        return self._interval
+
+    @property
+    def source(self):
+        """Get the ProcFile or ProcDir read."""
+        return self._source
+
+    @property
+    def length(self) -> int:
+        """Get the number of bytes, or entries, from the last read."""
+        return self._length
+
+    def subscribe(self, callback: Callable[[object, int, datetime.datetime], None]) -> None:
+        """Call callback(source, length, timestamp) every tick, the data is only valid during the call."""
+        self._subscribers.append(callback)
+
+    async def start(self):
+        return await self._scrape.start()
+
+    def _do_read(self):
+        try:
+            with timings.time("sampler.read"):
+                self._length = self._source.read()
+        except OSError:
+            return
+        self._read_ts = datetime.datetime.now()
+        with timings.time("sampler.fanout"):
+            for callback in self._subscribers:
+                try:
+                    callback(self._source, self._length, self._read_ts)
+                except Exception:
+                    logger.exception("%r failed on a reading of %r", callback, self._source)
+
+
+class Sampler:
+    """History of one metric, as raw samples and rollup tiers, with the interface the graphs read.
+
+    Subclasses call _append() with each new sample and keep last_sample up to
+    date with the latest reading, which for a counter is the counter itself
+    rather than the difference appended
+    """
+
+    def __init__(self, hub, sample_len: int, tiers=(), history: Optional[str] = None, typecode: str = "q"):
+        """Create an empty history of sample_len samples taken every tick of hub.
+
+        As well as the last sample_len samples, the samples can be rolled up into
+        tiers, a list of (seconds per slot, number of slots) such as
+        rollup.DEFAULT_TIERS, for graphs of a longer span. If history is a path
+        prefix, ideally on tmpfs, all of them are kept in memory mapped files there
+        and graphs pick up where they left off after a restart
+        """
+        self._hub = hub
+        self._sample_len = sample_len
+        if history is None:
+            self._buffer = RingBuffer(sample_len, typecode)
+        else:
+            self._buffer = MappedRingBuffer(f"{history}.raw", sample_len, typecode)
+        self._tiers = [RollupTier(interval, capacity, typecode, history=history) for (interval, capacity) in tiers]
+        self._listeners: list[Callable[[], None]] = []
+        self._last_sample = None
+        self._last_sample_ts = datetime.datetime.now()
+
+    async def start(self):
+        return await self._hub.start()
+
+    def listen(self, callback: Callable[[], None]) -> None:
+        """Call callback() after every new sample."""
+        self._listeners.append(callback)
+
+    def _append(self, value, timestamp: datetime.datetime) -> None:
+        """Add a sample to the history and tell the listeners."""
+        self._last_sample_ts = timestamp
+        self._buffer.append(value)
+        ts = timestamp.timestamp()
+        for tier in self._tiers:
+            tier.add(value, ts)
+        for callback in self._listeners:
+            callback()
+
+    @property
+    def last_sample(self):
+        return self._last_sample
+
+    @property
+    def last_sample_ts(self):
+        return self._last_sample_ts
+
+    @property
+    def count(self):
+        """Total number of samples taken, so consumers can tell when there is new data."""
+        return self._buffer.count
+
+    @property
+    def tiers(self):
+        """Get the rollup tiers, not including the raw samples."""
+        return self._tiers
+
+    def series(self, tier=0, stat="sum"):
+        """Get the raw samples for tier 0, or the sum, max or min for a rollup tier counting from 1."""
+        if tier == 0:
+            return self._buffer
+        return self._tiers[tier - 1].series(stat)
+
+    def interval(self, tier=0):
+        """Get the seconds per sample in a tier."""
+        if tier == 0:
+            return self._hub.interval
+        return self._tiers[tier - 1].interval
+
+    def views(self, last=None):
+        """Get the samples, or the last few, oldest first, as two read-only views split where the ring buffer wraps."""
+        return self._buffer.views(last)
+
+    def copy(self):
+        return self._buffer.copy()
+
+
+class SourceSampler(Sampler, ABC):
+    """Sampler fed by a SourceHub, turning each reading into a sample with _sample()."""
+
+    def __init__(self, path: str, sample_len: int, interval: int = 1, hub: Optional[SourceHub] = None, **kwargs):
+        """Create a sampler of the file or directory at path, read by hub or the hub shared for path."""
+        hub = hub if hub is not None else SourceHub.shared(path, interval)
+        super().__init__(hub, sample_len, **kwargs)
+        self._last_sample = self._reading(hub.source, hub.length)
+        if self._last_sample is None:
+            raise ValueError(f"{self!r} found nothing in {path}")
+        hub.subscribe(self._on_read)
+
+    @abstractmethod
+    def _reading(self, source, length: int):
+        """Get the value read from the source, or None if it isn't there."""
+
+    def _sample(self, reading, last_reading):
+        """Get the sample appended for a reading, the reading itself unless it is a counter."""
+        return reading
+
+    def _on_read(self, source, length: int, timestamp: datetime.datetime) -> None:
+        reading = self._reading(source, length)
+        if reading is None:
+            # Gone away, possibly only for now
+            return
+        (last_reading, self._last_sample) = (self._last_sample, reading)
+        self._append(self._sample(reading, last_reading), timestamp)
+
+
+class CpuSampler(SourceSampler):
+    """Percentage of time a CPU was busy, from /proc/stat.
+
+    cpu is "cpu" for all of them together or "cpu0", "cpu1"... for one core.
+    last_sample is the (busy, total) jiffies the percentage is worked out from
+    """
+
+    def __init__(self, sample_len: int, cpu: str = "cpu", path: str = "/proc/stat", **kwargs):
+        # A space after the name so cpu1 doesn't match cpu10
+        self._key = cpu.encode() + b" "
+        kwargs.setdefault("typecode", "d")
+        super().__init__(path, sample_len, **kwargs)
+
+    def _reading(self, source, length):
+        data = source.buffer
+        start = find_line(data, length, self._key)
+        if start < 0:
+            return None
+        end = data.find(b"\n", start, length)
+        fields = data[start:end if end >= 0 else length].split()
+        if len(fields) < 5:
+            return None
+        # user nice system idle iowait irq softirq steal, guest time is already counted in user and nice
+        total = 0
+        for field in fields[:8]:
+            total += int(field)
+        return (total - int(fields[3]) - int(fields[4]), total)
+
+    def _sample(self, reading, last_reading):
+        (busy, total) = reading
+        (last_busy, last_total) = last_reading
+        if total <= last_total:
+            return 0.0
+        return 100.0 * max(busy - last_busy, 0) / (total - last_total)
+
+
+class MemorySampler(SourceSampler):
+    """A field of /proc/meminfo, such as MemAvailable, in KiB."""
+
+    def __init__(self, sample_len: int, field: str = "MemAvailable", path: str = "/proc/meminfo", **kwargs):
+        self._key = field.encode() + b":"
+        super().__init__(path, sample_len, **kwargs)
+
+    def _reading(self, source, length):
+        return find_int(source.buffer, length, self._key)
+
+
+class LoadSampler(SourceSampler):
+    """Load average over 1, 5 or 15 minutes, from /proc/loadavg."""
+
+    def __init__(self, sample_len: int, minutes: int = 1, path: str = "/proc/loadavg", **kwargs):
+        self._field = (1, 5, 15).index(minutes)
+        kwargs.setdefault("typecode", "d")
+        super().__init__(path, sample_len, **kwargs)
+
+    def _reading(self, source, length):
+        fields = source.buffer[:length].split(None, 3)
+        return float(fields[self._field]) if len(fields) > self._field else None
+
+
+class ValueSampler(SourceSampler):
+    """A file holding a single integer, such as a /sys attribute, optionally scaled."""
+
+    def __init__(self, path: str, sample_len: int, scale: float = 1, **kwargs):
+        self._scale = scale
+        if scale != 1:
+            kwargs.setdefault("typecode", "d")
+        super().__init__(path, sample_len, **kwargs)
+
+    def _reading(self, source, length):
+        value = source.buffer[:length].strip()
+        if not value:
+            return None
+        return int(value) * self._scale if self._scale != 1 else int(value)
+
+
+class ThermalSampler(ValueSampler):
+    """Temperature of a thermal zone in degrees Celsius."""
+
+    def __init__(self, sample_len: int, zone: int = 0, **kwargs):
+        # The kernel reports millidegrees
+        super().__init__(f"/sys/class/thermal/thermal_zone{zone}/temp", sample_len, scale=0.001, **kwargs)
+
+
+class ConntrackSampler(ValueSampler):
+    """Number of connections tracked by netfilter."""
+
+    def __init__(self, sample_len: int, **kwargs):
+        super().__init__("/proc/sys/net/netfilter/nf_conntrack_count", sample_len, **kwargs)
+
+
+class StationSampler(SourceSampler):
+    """Number of Wi-Fi stations associated with an interface.
+
+    Read from the directory of stations mac80211 keeps in debugfs, which
+    OpenWRT mounts, so no netlink query is needed. The phy is looked up in
+    /sys when not given
+    """
+
+    def __init__(self, sample_len: int, ifname: str, phy: Optional[str] = None, **kwargs):
+        if phy is None:
+            with open(f"/sys/class/net/{ifname}/phy80211/name") as name:
+                phy = name.read().strip()
+        super().__init__(f"/sys/kernel/debug/ieee80211/{phy}/netdev:{ifname}/stations", sample_len, **kwargs)
+
+    def _reading(self, source, length):
+        return length
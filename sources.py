@@ -0,0 +1,319 @@
+"""Stand-ins for network.CounterHub which make up or replay interface counters.
+
+Either can be handed to an IfSampler as its hub, so the graphs can be driven
+on a machine without the interfaces, through traffic which is hard to come by
+on a dev machine, or through a recording of a real router.
+
+SyntheticHub draws the bytes each interface moves from a seeded Traffic
+pattern: bursty traffic around a mean, or a link running at line rate.
+Counters can be made to wrap at 32 bits as they do on older kernels.
+
+ReplayHub plays back a trace recorded with record(), or by running this
+module on the router, "python3 sources.py trace.jsonl". The trace is one JSON
+object per line holding the time and the counters of every interface:
+
+    {"t": 1700000000.0, "counters": {"eth0": {"bytes_sent": 1234, "bytes_recv": 5678}}}
+
+Both publish their own timestamps, the trace's or a fixed clock moving by the
+interval per tick, so the samples and rollup tiers come out the same on every
+run. Time moves when tick() is called, or at speed times real time once started.
+A replay keeps to the gaps between the records, so records the recorder made
+late, which cover several intervals, come out late too. A tick which comes late
+publishes everything it missed rather than skipping it
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import random
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from typing import Callable, Mapping, Optional, Tuple, Union
+from periodic import Periodic
+
+# The counters psutil.net_io_counters() reports for an interface, which a trace may hold some of
+COUNTER_FIELDS: tuple[str, ...] = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                                   "errin", "errout", "dropin", "dropout")
+
+# Counters for one interface, read by IfSampler with getattr like psutil's snetio
+Counters = namedtuple("Counters", COUNTER_FIELDS, defaults=(0,) * len(COUNTER_FIELDS))
+
+# Fastest a hub will replay or make up counters, as a multiple of real time
+MAX_SPEED: float = 1000
+
+# Where a synthetic clock starts
+EPOCH: datetime.datetime = datetime.datetime(2024, 1, 1)
+
+
+class Traffic(ABC):
+    """Pattern of the bytes an interface moves each interval."""
+
+    @abstractmethod
+    def bytes(self, rng: random.Random, interval: float) -> int:
+        """Draw the bytes moved in one interval from rng."""
+
+
+class Bursty(Traffic):
+    """Traffic around a mean rate which now and then bursts to a multiple of it."""
+
+    def __init__(self, mean_rate: float = 2e6, burst_chance: float = 0.05, burst_factor: float = 10):
+        """Move mean_rate bytes per second on average, burst_factor times that in a burst_chance of intervals."""
+        self._mean_rate = mean_rate
+        self._burst_chance = burst_chance
+        self._burst_factor = burst_factor
+
+    def bytes(self, rng: random.Random, interval: float) -> int:
+        burst = self._burst_factor if rng.random() < self._burst_chance else 1
+        return int(rng.expovariate(1 / (self._mean_rate*interval)) * burst)
+
+
+class LineRate(Traffic):
+    """A link kept busy at a fraction of its line rate, 10 Gbit/s flat out unless told otherwise."""
+
+    def __init__(self, bits_per_second: float = 10e9, utilisation: float = 1.0, jitter: float = 0.01):
+        """Move utilisation of bits_per_second, give or take a jitter fraction, never more than the line rate."""
+        self._bits_per_second = bits_per_second
+        self._utilisation = utilisation
+        self._jitter = jitter
+
+    def bytes(self, rng: random.Random, interval: float) -> int:
+        line = self._bits_per_second / 8 * interval
+        return int(min(line * self._utilisation * (1 + rng.uniform(-self._jitter, self._jitter)), line))
+
+
+class _PacedHub(ABC):
+    """The CounterHub interface for hubs which publish counters when ticked, and tick themselves once started."""
+
+    def __init__(self, interval: float, speed: float):
+        if not 0 < speed <= MAX_SPEED:
+            raise ValueError(f"speed must be more than 0 and at most {MAX_SPEED}")
+        self._interval = interval
+        self._speed = speed
+        self._counters: dict[str, Counters] = {}
+        self._counters_ts = EPOCH
+        self._subscribers: list[Callable[[dict, datetime.datetime], None]] = []
+        # Seconds on the hub's clock from the first counters to the current ones
+        self._elapsed = 0.0
+        self._started: Optional[float] = None
+        self._pace = Periodic(self._catch_up, interval / speed)
+
+    @property
+    def interval(self) -> float:
+        """Get the seconds between ticks on the hub's clock."""
+        return self._interval
+
+    @property
+    def counters(self) -> dict:
+        """Get the current counters for all interfaces, keyed by interface name."""
+        return self._counters
+
+    @property
+    def counter_bits(self) -> Optional[int]:
+        """Get the width the counters wrap at, or None if it isn't known."""
+        return None
+
+    @property
+    def timestamp(self) -> datetime.datetime:
+        """Get the time on the hub's clock of the current counters."""
+        return self._counters_ts
+
+    def subscribe(self, callback: Callable[[dict, datetime.datetime], None]) -> None:
+        """Call callback(counters, timestamp) every tick."""
+        self._subscribers.append(callback)
+
+    async def start(self):
+        """Tick at speed times real time from now on."""
+        if self._started is None:
+            self._started = asyncio.get_event_loop().time() - self._elapsed / self._speed
+        return await self._pace.start()
+
+    async def stop(self):
+        await self._pace.stop()
+
+    def _catch_up(self) -> None:
+        """Tick as many times as real time at speed says should have happened by now."""
+        now = (asyncio.get_event_loop().time() - self._started) * self._speed
+        while self._elapsed + self._due_in() <= now and self.tick():
+            pass
+
+    def tick(self) -> bool:
+        """Move the clock on to the next counters and publish them, returning False if there are no more."""
+        due_in = self._due_in()
+        if not self._advance():
+            return False
+        self._elapsed += due_in
+        for callback in self._subscribers:
+            callback(self._counters, self._counters_ts)
+        return True
+
+    @abstractmethod
+    def _due_in(self) -> float:
+        """Get the seconds on the hub's clock until the next counters, inf if there are none."""
+
+    @abstractmethod
+    def _advance(self) -> bool:
+        """Set the next counters and timestamp, or return False if there are none."""
+
+
+class SyntheticHub(_PacedHub):
+    """Counters for made up interfaces which move by seeded Traffic each tick."""
+
+    def __init__(self,
+                 ifnames: Tuple[str, ...] = ("eth0",),
+                 traffic: Union[Traffic, Mapping[str, Traffic], None] = None,
+                 interval: float = 1,
+                 seed: int = 0,
+                 counter_bits: int = 64,
+                 start: int = 0,
+                 speed: float = 1):
+        """Create a hub for ifnames whose counters move with traffic.
+
+        Parameters
+        ----------
+        ifnames: Tuple[str, ...]
+            the interfaces to make counters for
+        traffic: Traffic
+            the pattern both directions of every interface follow, or a pattern for
+            each interface name. Bursty around 2 MB/s by default
+        interval: float
+            seconds on the hub's clock between ticks
+        seed: int
+            seed for the patterns, the same seed gives the same counters
+        counter_bits: int
+            width of the counters, which wrap back to 0 when they overflow it
+        start: int
+            value the counters start from, e.g. close to the wrap
+        speed: float
+            multiple of real time to tick at once started
+        """
+        super().__init__(interval, speed)
+        self._random = random.Random(seed)
+        traffic = traffic if traffic is not None else Bursty()
+        self._traffic = {ifname: traffic[ifname] if isinstance(traffic, Mapping) else traffic for ifname in ifnames}
+        self._counter_bits = counter_bits
+        self._modulus = 1 << counter_bits
+        self._counters = {ifname: Counters(start % self._modulus, start % self._modulus) for ifname in ifnames}
+
+    @property
+    def counter_bits(self) -> Optional[int]:
+        return self._counter_bits
+
+    def _due_in(self) -> float:
+        return self._interval
+
+    def _advance(self) -> bool:
+        self._counters_ts += datetime.timedelta(seconds=self._interval)
+        counters = {}
+        for (ifname, c) in self._counters.items():
+            traffic = self._traffic[ifname]
+            sent = traffic.bytes(self._random, self._interval)
+            recv = traffic.bytes(self._random, self._interval)
+            counters[ifname] = c._replace(bytes_sent=(c.bytes_sent + sent) % self._modulus,
+                                          bytes_recv=(c.bytes_recv + recv) % self._modulus)
+        self._counters = counters
+        return True
+
+
+class ReplayHub(_PacedHub):
+    """Counters played back from a trace, each record in turn, with the times they were recorded."""
+
+    def __init__(self, path: str, speed: float = 1, loop: bool = False):
+        """Load the trace at path, starting on its first record.
+
+        With loop set the trace starts again when it runs out, carrying on from
+        where the counters and clock got to, so it can be replayed for as long
+        as needed. The first record stands in for the last, so going round
+        adds no interval that wasn't recorded. Otherwise the counters stay on
+        the last record. The interval is the shortest gap between two records
+        """
+        self._records: list[Tuple[float, dict[str, Counters]]] = []
+        with open(path) as trace:
+            for line in trace:
+                if line.strip():
+                    record = json.loads(line)
+                    self._records.append((record["t"], {ifname: Counters(**fields)
+                                                        for (ifname, fields) in record["counters"].items()}))
+        gaps = [t1 - t0 for ((t0, _), (t1, _)) in zip(self._records, self._records[1:]) if t1 > t0]
+        if not gaps:
+            raise ValueError(f"{path} needs at least two records at different times to replay")
+        super().__init__(min(gaps), speed)
+        self._loop = loop
+        self._next = 0
+        # Added to the counters and the clock for each time round the loop
+        self._offsets: dict[str, Counters] = {}
+        self._shift = 0.0
+        self._advance()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _due_in(self) -> float:
+        if self._next == len(self._records):
+            if not self._loop:
+                return math.inf
+            return self._records[1][0] - self._records[0][0]
+        return self._records[self._next][0] - self._records[self._next - 1][0]
+
+    def _advance(self) -> bool:
+        if self._next == len(self._records):
+            if not self._loop:
+                return False
+            # Go round again from the second record, with the first standing for where the last left off
+            (first_t, first) = self._records[0]
+            (last_t, _) = self._records[-1]
+            self._shift += last_t - first_t
+            self._offsets = {ifname: Counters(*(now - start for (now, start) in zip(self._counters[ifname], first[ifname])))
+                             for ifname in first if ifname in self._counters}
+            self._next = 1
+        (t, counters) = self._records[self._next]
+        self._next += 1
+        if self._offsets:
+            counters = {ifname: Counters(*(value + offset for (value, offset) in zip(c, self._offsets[ifname])))
+                        if ifname in self._offsets else c
+                        for (ifname, c) in counters.items()}
+        self._counters = counters
+        self._counters_ts = datetime.datetime.fromtimestamp(t + self._shift)
+        return True
+
+
+def record(path: str, hub, ticks: Optional[int] = None, done: Optional[Callable[[], None]] = None) -> None:
+    """Append the counters hub publishes each tick to the trace at path.
+
+    With ticks set, recording stops after that many records and done() is called
+    """
+    trace = open(path, "a")
+    remaining = [ticks]
+
+    def write(counters: dict, timestamp: datetime.datetime) -> None:
+        if trace.closed:
+            return
+        line = {"t": timestamp.timestamp(),
+                "counters": {ifname: {field: getattr(c, field) for field in COUNTER_FIELDS}
+                             for (ifname, c) in counters.items()}}
+        trace.write(json.dumps(line, separators=(",", ":")) + "\n")
+        trace.flush()
+        if remaining[0] is not None:
+            remaining[0] -= 1
+            if remaining[0] <= 0:
+                trace.close()
+                if done is not None:
+                    done()
+
+    hub.subscribe(write)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the interface counters into a trace ReplayHub can play back")
+    parser.add_argument("trace", help="file to append the records to")
+    parser.add_argument("--ticks", type=int, help="stop after this many records")
+    parser.add_argument("--interval", type=int, default=1, help="seconds between records")
+    args = parser.parse_args()
+    from network import CounterHub
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    hub = CounterHub(args.interval)
+    record(args.trace, hub, args.ticks, loop.stop)
+    loop.create_task(hub.start())
+    loop.run_forever()
@@ -0,0 +1,410 @@
+"""Framebuffer which streams the screen to viewers over a socket.
+
+The screen is cut into square tiles. When a frame is presented only the tiles it
+wrote to are looked at, tiles whose pixels didn't change are dropped and the
+rest are sent XORed with what the viewers already have, which is mostly zeros
+and compresses very well. A viewer gets every tile once, as a keyframe, when it
+connects, so the cost of streaming follows how much of the screen changes
+rather than its resolution.
+
+Frames can be presented from any thread. The tiles are packed and compressed
+on the presenting thread, under the same lock as the pixels are written so a
+viewer connecting in between can't see pixels the others are never sent, and
+only written to the viewers on the event loop
+
+Every message is a header of type and payload length followed by the payload:
+
+    HELLO  width, height, rawmode of the pixels
+    FRAME  sequence number, tile count, then per tile its box, encoding,
+           length and the zlib compressed pixels or XOR delta
+
+Addresses are "unix:/path/to/socket", or "host:port" for TCP
+"""
+from __future__ import annotations
+import asyncio
+import struct
+import threading
+import zlib
+from contextlib import suppress
+from typing import Optional, Tuple
+from PIL import Image
+from local_types import Dimension, Color, Rect
+from framebuffer import Framebuffer, Frame
+from instrument import timings
+from pixelformat import PixelFormat
+
+MESSAGE_HEADER = struct.Struct("<BI")
+HELLO = struct.Struct("<HH8s")
+FRAME = struct.Struct("<IH")
+TILE = struct.Struct("<HHHHBI")
+
+MSG_HELLO = 0
+MSG_FRAME = 1
+
+# Tile encodings
+TILE_RAW = 0  # zlib compressed pixels
+TILE_XOR = 1  # zlib compressed XOR of the pixels with the tile the viewer has
+
+# Pixels are sent without alpha, the screen is opaque
+RAWMODE = "RGB"
+
+TILE_SIZE: int = 64
+
+# A viewer with more than this many bytes waiting to be sent is skipped and resynchronised with a keyframe
+MAX_BUFFERED: int = 4*1024*1024
+
+
+def parse_address(address: str) -> Tuple[Optional[str], Optional[str], Optional[int]]:
+    """Split an address into (unix socket path, host, port)."""
+    if address.startswith("unix:"):
+        return (address[len("unix:"):], None, None)
+    if address.startswith("/"):
+        return (address, None, None)
+    (host, _, port) = address.rpartition(":")
+    return (None, host or None, int(port))
+
+
+class _Viewer:
+    """A connected viewer, whether it fell behind and needs a keyframe, and the last frame it was sent."""
+
+    __slots__ = ("writer", "stale", "seq")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.stale = True
+        self.seq = 0
+
+
+class StreamFB(Framebuffer):
+    """Framebuffer held in memory and published to viewers as compressed changed tiles."""
+
+    def __init__(self,
+                 size: Dimension = Dimension(1280, 720),
+                 tile_size: int = TILE_SIZE,
+                 level: int = 1):
+        """Create a new streaming framebuffer.
+
+        Parameters
+        ----------
+        size: Dimension
+            resolution of the screen
+        tile_size: int
+            width and height of the tiles the screen is sent in
+        level: int
+            zlib compression level, 1 is fastest
+        """
+        pixel_format = PixelFormat(RAWMODE, size)
+        super().__init__("stream", RAWMODE, pixel_format.bytes_per_pixel*8, size)
+        self._pixel_format = pixel_format
+        self._frame = bytearray(pixel_format.line_length*size[1])
+        self._tile_size = tile_size
+        self._level = level
+        # The pixels of each tile as the viewers last saw them
+        self._sent: dict[Tuple[int, int], bytes] = {}
+        self._dirty: set[Tuple[int, int]] = set()
+        self._viewers: list[_Viewer] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._seq = 0
+        # Held while the frame, the tiles and the sequence number change, as frames may be presented off the loop
+        self._lock = threading.Lock()
+        self.bytes_sent = 0
+
+    @property
+    def viewers(self) -> int:
+        """Get the number of connected viewers."""
+        return len(self._viewers)
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        """Support python 'with' statement exit."""
+        super().__exit__(exc_type, exc_value, tb)
+        self.close()
+
+    def clear(self, fill: Color) -> None:
+        """Clear this Framebuffer."""
+        self.present(Image.new("RGBA", self.size, fill))
+
+    def write_screen(self, some_bytes: list[bytes]) -> None:
+        with self._lock:
+            self._frame[:len(some_bytes)] = some_bytes
+            self._damage_tiles(Rect(0, 0, self.size[0], self.size[1]))
+            self._send_changes()
+
+    def write_region(self, some_bytes: bytes, rect: Rect) -> None:
+        """Write the pixels in rect, packed by pixel_format, leaving the rest of the screen alone, and send them."""
+        with self._lock:
+            self.pixel_format.copy_rows(some_bytes, rect, self._frame)
+            self._damage_tiles(rect)
+            self._send_changes()
+
+    def present(self, frame: Frame, regions: Optional[list[Rect]] = None) -> None:
+        """Copy regions of frame straight into the frame the tiles are cut from and send the changes."""
+        with self._lock:
+            for rect in self._regions(regions):
+                self._put(frame, rect, self._frame)
+                self._damage_tiles(rect)
+            self._send_changes()
+
+    def _damage_tiles(self, rect: Rect) -> None:
+        """Record which tiles rect overlaps."""
+        if not self._viewers:
+            return
+        t = self._tile_size
+        for ty in range(rect.y0 // t, (rect.y1 - 1) // t + 1):
+            for tx in range(rect.x0 // t, (rect.x1 - 1) // t + 1):
+                self._dirty.add((tx, ty))
+
+    def _tile_box(self, tile: Tuple[int, int]) -> Rect:
+        """Get the pixels covered by a tile, the tiles on the right and bottom edges may be smaller."""
+        (w, h) = self.size
+        (x0, y0) = (tile[0]*self._tile_size, tile[1]*self._tile_size)
+        return Rect(x0, y0, min(x0 + self._tile_size, w), min(y0 + self._tile_size, h))
+
+    def _tile_pixels(self, box: Rect) -> bytes:
+        """Get the current pixels of a tile, packed row after row."""
+        line = self.pixel_format.line_length
+        bpp = self.pixel_format.bytes_per_pixel
+        frame = memoryview(self._frame)
+        start = box.y0*line + box.x0*bpp
+        row = (box.x1 - box.x0)*bpp
+        return b"".join(frame[offset:offset + row] for offset in range(start, start + (box.y1 - box.y0)*line, line))
+
+    def _encode(self, tiles: list[Tuple[Rect, int, bytes]]) -> bytes:
+        """Build a FRAME message from (box, encoding, uncompressed data) tiles."""
+        parts = [b"", FRAME.pack(self._seq, len(tiles))]
+        for (box, encoding, data) in tiles:
+            compressed = zlib.compress(data, self._level)
+            parts.append(TILE.pack(box.x0, box.y0, box.x1 - box.x0, box.y1 - box.y0, encoding, len(compressed)))
+            parts.append(compressed)
+        payload_len = sum(len(part) for part in parts)
+        parts[0] = MESSAGE_HEADER.pack(MSG_FRAME, payload_len)
+        return b"".join(parts)
+
+    def _keyframe(self) -> bytes:
+        """Build a FRAME message with every tile of the screen, which also becomes what the viewers have.
+
+        Only call this with the lock held
+        """
+        (w, h) = self.size
+        tiles = []
+        for ty in range((h + self._tile_size - 1) // self._tile_size):
+            for tx in range((w + self._tile_size - 1) // self._tile_size):
+                box = self._tile_box((tx, ty))
+                pixels = self._tile_pixels(box)
+                self._sent[(tx, ty)] = pixels
+                tiles.append((box, TILE_RAW, pixels))
+        return self._encode(tiles)
+
+    def _delta(self) -> Optional[bytes]:
+        """Build a FRAME message with the tiles which changed since the last one, or None if none did.
+
+        Only call this with the lock held
+        """
+        tiles = []
+        for tile in sorted(self._dirty):
+            box = self._tile_box(tile)
+            pixels = self._tile_pixels(box)
+            previous = self._sent.get(tile)
+            if previous == pixels:
+                continue
+            self._sent[tile] = pixels
+            if previous is None:
+                tiles.append((box, TILE_RAW, pixels))
+                continue
+            delta = (int.from_bytes(pixels, "little") ^ int.from_bytes(previous, "little")).to_bytes(len(pixels), "little")
+            tiles.append((box, TILE_XOR, delta))
+        self._dirty.clear()
+        if not tiles:
+            return None
+        return self._encode(tiles)
+
+    def _send_changes(self) -> None:
+        """Send the tiles changed since they were last sent to the viewers which are keeping up.
+
+        The changes are encoded on the calling thread and written to the viewers
+        on the event loop. Only call this with the lock held, in the same section
+        as the pixels were written, as a keyframe taken in between would leave
+        what the viewers have out of step with the tiles sent
+        """
+        if not self._viewers:
+            return
+        self._seq += 1
+        with timings.time("stream.encode"):
+            message = self._delta()
+        self._loop.call_soon_threadsafe(self._deliver, self._seq, message)
+
+    def flip(self) -> None:
+        """Do nothing, the changes were sent as they were written."""
+
+    def _deliver(self, seq: int, message: Optional[bytes]) -> None:
+        """Send frame seq, or a keyframe to the viewers which fell behind. Runs on the event loop."""
+        keyframe = None
+        for viewer in self._viewers:
+            if viewer.seq >= seq:
+                # A keyframe taken since seq was encoded already has it
+                continue
+            buffered = viewer.writer.transport.get_write_buffer_size()
+            if buffered > MAX_BUFFERED:
+                # Don't queue deltas for a viewer which isn't reading, catch it up once it drains
+                viewer.stale = True
+                continue
+            if viewer.stale:
+                if keyframe is None:
+                    with self._lock:
+                        keyframe = (self._seq, self._keyframe())
+                self._send(viewer, keyframe[1])
+                viewer.seq = keyframe[0]
+                viewer.stale = False
+                continue
+            if message is not None:
+                self._send(viewer, message)
+            viewer.seq = seq
+
+    def _send(self, viewer: _Viewer, message: bytes) -> None:
+        viewer.writer.write(message)
+        self.bytes_sent += len(message)
+
+    async def serve(self, address: str) -> asyncio.AbstractServer:
+        """Start accepting viewers on address."""
+        (path, host, port) = parse_address(address)
+        self._loop = asyncio.get_running_loop()
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._on_connect, path=path)
+        else:
+            self._server = await asyncio.start_server(self._on_connect, host=host, port=port)
+        return self._server
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        (w, h) = self.size
+        hello = HELLO.pack(w, h, RAWMODE.encode())
+        writer.write(MESSAGE_HEADER.pack(MSG_HELLO, len(hello)) + hello)
+        viewer = _Viewer(writer)
+        with self._lock:
+            if not self._viewers:
+                # Nothing has been tracked while nobody was watching
+                self._sent.clear()
+                self._dirty.clear()
+            self._viewers.append(viewer)
+            # The whole screen goes out now rather than waiting for the next frame
+            keyframe = self._keyframe()
+            viewer.seq = self._seq
+        self._send(viewer, keyframe)
+        viewer.stale = False
+        try:
+            # Viewers don't send anything, this just waits for them to go away
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self._viewers.remove(viewer)
+            writer.close()
+
+    def close(self) -> None:
+        """Stop accepting viewers and disconnect the ones connected."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for viewer in self._viewers:
+            viewer.writer.close()
+
+
+class StreamViewer:
+    """Client for StreamFB keeping a copy of the remote screen."""
+
+    def __init__(self):
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._image: Optional[Image.Image] = None
+
+    @property
+    def size(self) -> Dimension:
+        """Get the size of the remote screen."""
+        return Dimension(*self._image.size)
+
+    @property
+    def image(self) -> Image.Image:
+        """Get the copy of the remote screen, as of the last frame read."""
+        return self._image
+
+    async def connect(self, address: str) -> None:
+        """Connect to a StreamFB and read its HELLO."""
+        (path, host, port) = parse_address(address)
+        if path is not None:
+            (self._reader, self._writer) = await asyncio.open_unix_connection(path)
+        else:
+            (self._reader, self._writer) = await asyncio.open_connection(host, port)
+        (kind, payload) = await self._read_message()
+        if kind != MSG_HELLO:
+            raise ValueError(f"Expected HELLO from {address}, got message type {kind}")
+        (w, h, rawmode) = HELLO.unpack(payload)
+        if rawmode.rstrip(b"\0").decode() != RAWMODE:
+            raise ValueError(f"Unsupported pixel format {rawmode!r}")
+        self._image = Image.new(RAWMODE, (w, h))
+
+    async def _read_message(self) -> Tuple[int, bytes]:
+        (kind, length) = MESSAGE_HEADER.unpack(await self._reader.readexactly(MESSAGE_HEADER.size))
+        return (kind, await self._reader.readexactly(length))
+
+    async def next_frame(self) -> list[Rect]:
+        """Read the next frame and apply it to image, returning the rectangles which changed.
+
+        Raises asyncio.IncompleteReadError when the server goes away
+        """
+        while True:
+            (kind, payload) = await self._read_message()
+            if kind == MSG_FRAME:
+                return self._apply(payload)
+
+    def _apply(self, payload: bytes) -> list[Rect]:
+        (_, count) = FRAME.unpack_from(payload)
+        offset = FRAME.size
+        rects = []
+        for _ in range(count):
+            (x, y, w, h, encoding, length) = TILE.unpack_from(payload, offset)
+            offset += TILE.size
+            data = zlib.decompress(payload[offset:offset + length])
+            offset += length
+            box = Rect(x, y, x + w, y + h)
+            if encoding == TILE_XOR:
+                current = self._image.crop(box).tobytes()
+                data = (int.from_bytes(data, "little") ^ int.from_bytes(current, "little")).to_bytes(len(data), "little")
+            self._image.paste(Image.frombytes(RAWMODE, (w, h), data), (x, y))
+            rects.append(box)
+        return rects
+
+    def close(self) -> None:
+        """Disconnect from the server."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+    import instrument
+    from network import IfSampler
+    from panel import panel, MAX_SAMPLES
+    from widgets import Screen
+
+    parser = argparse.ArgumentParser(description="Render the panel headless and stream it to viewers")
+    parser.add_argument("--listen", default="unix:/tmp/openwrt-fb.sock", help="unix:/path or host:port")
+    parser.add_argument("--ifname", default="eth0.2", help="interface to graph")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    instrument.from_environ()
+
+    sent_sampler = IfSampler(args.ifname, "bytes_sent", MAX_SAMPLES)
+    recv_sampler = IfSampler(args.ifname, "bytes_recv", MAX_SAMPLES)
+    with StreamFB() as display:
+        widgets = panel(sent_sampler, recv_sampler)
+        instrument.startup.mark("widgets built")
+        screen = Screen(display, widgets)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(display.serve(args.listen))
+        loop.create_task(sent_sampler.start())
+        loop.create_task(recv_sampler.start())
+        loop.create_task(screen.start())
+        with suppress(KeyboardInterrupt):
+            loop.run_forever()
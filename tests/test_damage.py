@@ -0,0 +1,62 @@
+from damage import Damage, MAX_RECTS, intersect, union
+from local_types import Dimension, Point, Rect
+
+
+def test_clips_to_bounds():
+    damage = Damage(Dimension(100, 50))
+    damage.add(Rect(-10, -10, 20, 20))
+    damage.add(Rect(200, 0, 300, 10))
+    assert damage.take() == [Rect(0, 0, 20, 20)]
+
+
+def test_none_damages_everything():
+    damage = Damage(Dimension(100, 50))
+    damage.add(Rect(10, 10, 20, 20))
+    damage.add()
+    assert damage.take() == [Rect(0, 0, 100, 50)]
+
+
+def test_merges_overlapping_and_adjacent():
+    damage = Damage(Dimension(100, 100))
+    damage.add(Rect(0, 0, 10, 10))
+    damage.add(Rect(5, 5, 15, 15))
+    damage.add(Rect(15, 0, 20, 5))
+    assert damage.take() == [Rect(0, 0, 20, 15)]
+
+
+def test_keeps_separate_rects_apart():
+    damage = Damage(Dimension(100, 100))
+    damage.add(Rect(0, 0, 10, 10))
+    damage.add(Rect(50, 50, 60, 60))
+    assert sorted(damage.take()) == [Rect(0, 0, 10, 10), Rect(50, 50, 60, 60)]
+
+
+def test_merge_cascades():
+    damage = Damage(Dimension(100, 100))
+    damage.add(Rect(0, 0, 10, 10))
+    damage.add(Rect(30, 0, 40, 10))
+    # Bridges the two, and the merged box then has to absorb both
+    damage.add(Rect(9, 0, 31, 5))
+    assert damage.take() == [Rect(0, 0, 40, 10)]
+
+
+def test_too_many_rects_become_their_bounding_box():
+    damage = Damage(Dimension(1000, 100))
+    for i in range(MAX_RECTS):
+        damage.add(Rect(i*20, 10, i*20 + 5, 20))
+    assert len(damage) == MAX_RECTS
+    damage.add(Rect(900, 50, 910, 60))
+    assert damage.take() == [Rect(0, 10, 910, 60)]
+
+
+def test_add_all_offsets_by_origin():
+    damage = Damage(Dimension(100, 100))
+    damage.add_all([Rect(0, 0, 5, 5)], Point(10, 20))
+    assert damage.take() == [Rect(10, 20, 15, 25)]
+    assert not damage
+
+
+def test_helpers():
+    assert intersect(Rect(0, 0, 10, 10), Rect(10, 0, 20, 10)) is None
+    assert intersect(Rect(0, 0, 10, 10), Rect(5, 5, 20, 20)) == Rect(5, 5, 10, 10)
+    assert union(Rect(0, 0, 1, 1), Rect(5, 5, 6, 6)) == Rect(0, 0, 6, 6)
@@ -0,0 +1,56 @@
+from PIL import Image
+from fb import FileFB
+from local_types import Dimension, Rect
+
+SIZE = Dimension(32, 16)
+
+
+def frame(color) -> Image.Image:
+    return Image.new("RGBA", SIZE, color)
+
+
+def test_flip_shows_each_frame_presented():
+    with FileFB(SIZE, double_buffer=True) as display:
+        assert display.double_buffered
+        display.present(frame((255, 0, 0, 255)))
+        assert display.visible().tobytes() == frame((255, 0, 0, 255)).tobytes()
+        display.present(frame((0, 0, 255, 255)))
+        assert display.visible().tobytes() == frame((0, 0, 255, 255)).tobytes()
+        assert display.pans == 3
+
+
+def test_flip_brings_the_hidden_page_up_to_date():
+    with FileFB(SIZE, double_buffer=True) as display:
+        first = frame((255, 0, 0, 255))
+        display.present(first)
+        second = first.copy()
+        second.paste((0, 255, 0, 255), (0, 0, 8, 8))
+        display.present(second, [Rect(0, 0, 8, 8)])
+        third = second.copy()
+        third.paste((0, 0, 255, 255), (8, 8, 16, 16))
+        display.present(third, [Rect(8, 8, 16, 16)])
+        assert display.visible().tobytes() == third.tobytes()
+
+
+def test_exit_restores_the_mode():
+    display = FileFB(SIZE, double_buffer=True)
+    before = display._fake_var
+    with display:
+        display.present(frame((255, 0, 0, 255)))
+        display.present(frame((0, 0, 255, 255)))
+        assert display._fake_var.yres_virtual == SIZE[1]*2
+    assert display._fake_var == before
+
+
+def test_single_buffered_without_pan():
+    with FileFB(SIZE, double_buffer=True, can_pan=False) as display:
+        assert not display.double_buffered
+        display.present(frame((0, 255, 0, 255)))
+        assert display.visible().tobytes() == frame((0, 255, 0, 255)).tobytes()
+
+
+def test_stride_from_the_driver_without_sysfs():
+    with FileFB(SIZE, bpp=24, line_length=SIZE[0]*3 + 8, sysfs_stride=False) as display:
+        assert display.pixel_format.line_length == SIZE[0]*3 + 8
+        display.present(frame((10, 20, 30, 255)))
+        assert display.visible().tobytes() == frame((10, 20, 30, 255)).tobytes()
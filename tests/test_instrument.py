@@ -0,0 +1,35 @@
+import signal
+import pytest
+import instrument
+
+
+@pytest.fixture
+def restored(monkeypatch):
+    """Put the shared timings and startup back as they were afterwards."""
+    monkeypatch.setattr(instrument.timings, "enabled", False)
+    monkeypatch.setattr(instrument.timings, "_histograms", {})
+    monkeypatch.setattr(instrument.startup, "enabled", False)
+    monkeypatch.setattr(instrument.startup, "_marks", [])
+    handler = signal.getsignal(signal.SIGUSR1)
+    yield
+    signal.signal(signal.SIGUSR1, handler)
+
+
+def test_nothing_asked_for(restored):
+    assert not instrument.from_environ({})
+    assert not instrument.timings.enabled
+    assert instrument.startup.marks() == []
+
+
+def test_startup_marks_the_imports(restored):
+    assert not instrument.from_environ({"FB_STARTUP": "1"})
+    assert [name for (name, _) in instrument.startup.marks()] == ["imported"]
+
+
+def test_timings_dump_on_signal(restored, tmp_path):
+    path = str(tmp_path / "timings")
+    assert instrument.from_environ({"FB_TIMINGS": "1", "FB_TIMINGS_FILE": path})
+    instrument.timings.record("stage", 0.002)
+    signal.getsignal(signal.SIGUSR1)(signal.SIGUSR1, None)
+    with open(path) as dumped:
+        assert "stage" in dumped.read()
@@ -0,0 +1,61 @@
+import pytest
+from PIL import ImageChops
+import network
+from local_types import Dimension
+from network import IfSampler, SeriesGraph, MultiSeriesGraph
+from sources import SyntheticHub, LineRate
+
+SIZE = Dimension(40, 30)
+COLUMNS = SIZE[0] // SeriesGraph.COLUMN_WIDTH
+
+
+def graph(mode: str, **kwargs) -> SeriesGraph:
+    hub = SyntheticHub(seed=2)
+    return SeriesGraph(IfSampler("eth0", "bytes_sent", COLUMNS, hub=hub), SIZE, mode=mode, **kwargs)
+
+
+def filled(graph: SeriesGraph, first: int, spans, few_columns: int, monkeypatch) -> bytes:
+    """Get the graph's surface after filling spans from column first with few_columns drawn as rectangles."""
+    monkeypatch.setattr(network, "FEW_COLUMNS", few_columns)
+    graph.drawable.rectangle([0, 0, SIZE[0], SIZE[1]], fill=graph._surface_color(graph._background))
+    graph._fill_spans(graph.drawable, first, spans, graph._surface_color(network.white))
+    return graph.img.tobytes()
+
+
+# Heights of (top, bottom) per column, from empty to full height, and sitting on others as stacked series do
+SPANS = [(0, 0), (30, 0), (1, 0), (29, 0), (15, 5), (30, 29), (7, 7), (12, 0), (30, 0), (2, 1), (20, 10)]
+
+
+@pytest.mark.parametrize("mode", ("1", "P", "RGBA"))
+@pytest.mark.parametrize("first", (0, 3, COLUMNS - len(SPANS)))
+def test_mask_fills_as_rectangles(mode, first, monkeypatch):
+    # The first column covers a pixel off the left edge, the last reaches the right one
+    widget = graph(mode)
+    assert filled(widget, first, SPANS, 0, monkeypatch) == filled(widget, first, SPANS, len(SPANS), monkeypatch)
+
+
+def test_whole_column_span(monkeypatch):
+    widget = graph("1")
+    spans = [(30 - i % 30, i % 4) for i in range(COLUMNS)]
+    assert filled(widget, 0, spans, 0, monkeypatch) == filled(widget, 0, spans, COLUMNS, monkeypatch)
+
+
+@pytest.mark.parametrize("stacked", (False, True))
+@pytest.mark.parametrize("is_filled", (False, True))
+def test_graphs_draw_the_same_either_way(stacked, is_filled, monkeypatch):
+    images = []
+    for few_columns in (0, COLUMNS + 1):
+        monkeypatch.setattr(network, "FEW_COLUMNS", few_columns)
+        hub = SyntheticHub(ifnames=("eth0", "eth1"), traffic=LineRate(1e9, jitter=0.5), seed=4)
+        samplers = [IfSampler(ifname, "bytes_sent", COLUMNS, hub=hub) for ifname in ("eth0", "eth1")]
+        widget = MultiSeriesGraph(samplers, SIZE, [(255, 0, 0, 255), (0, 255, 0, 255)], stacked=stacked, filled=is_filled)
+        frames = []
+        # Scrolled one sample at a time, then many at once
+        for ticks in (1, 1, 1, COLUMNS // 2, COLUMNS * 2):
+            for _ in range(ticks):
+                hub.tick()
+            widget.update()
+            frames.append(widget.draw().convert("RGBA"))
+        images.append(frames)
+    for (mask, rectangles) in zip(*images):
+        assert ImageChops.difference(mask, rectangles).getbbox(alpha_only=False) is None
@@ -0,0 +1,57 @@
+import asyncio
+import math
+import time
+from periodic import Periodic, Scheduler
+
+
+def test_add_puts_the_first_run_on_the_grid():
+    async def check():
+        scheduler = Scheduler()
+        jobs = [Periodic(lambda: None, interval, scheduler) for interval in (1, 5, 0.25)]
+        now = asyncio.get_event_loop().time()
+        for job in jobs:
+            await job.start()
+        for job in jobs:
+            ticks = job._due / job.interval
+            assert math.isclose(ticks, round(ticks))
+            assert now < job._due <= now + job.interval + 0.01
+        await scheduler.stop()
+    asyncio.run(check())
+
+
+def test_reschedule_moves_one_interval_on():
+    scheduler = Scheduler()
+    job = Periodic(lambda: None, 2, scheduler)
+    job._due = 100
+    scheduler._reschedule([job], 100.5)
+    assert job._due == 102
+    assert job.missed == 0
+
+
+def test_reschedule_coalesces_missed_ticks():
+    scheduler = Scheduler()
+    job = Periodic(lambda: None, 2, scheduler)
+    job._due = 100
+    # Busy until just after 107, so the ticks at 102, 104 and 106 were missed
+    scheduler._reschedule([job], 107.1)
+    assert job._due == 108
+    assert job.missed == 3
+
+
+def test_slow_job_is_an_overrun_and_others_coalesce():
+    async def check():
+        scheduler = Scheduler()
+        runs = []
+        fast = Periodic(lambda: runs.append(asyncio.get_event_loop().time()), 0.01, scheduler)
+        slow = Periodic(lambda: time.sleep(0.045), 0.04, scheduler)
+        started = asyncio.get_event_loop().time()
+        await fast.start()
+        await slow.start()
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return (runs, fast, slow, asyncio.get_event_loop().time() - started)
+    (runs, fast, slow, elapsed) = asyncio.run(check())
+    assert slow.overruns > 0
+    assert fast.missed > 0
+    # Each tick on the grid either ran or was counted as missed, none were queued up and run late
+    assert len(runs) + fast.missed <= elapsed / 0.01 + 1
@@ -0,0 +1,105 @@
+import random
+import struct
+import pytest
+from PIL import Image
+import pixelformat
+from local_types import Dimension, Rect
+from pixelformat import PixelFormat
+
+SIZE = Dimension(7, 5)
+
+
+def screen() -> Image.Image:
+    rng = random.Random(1)
+    return Image.frombytes("RGBA", SIZE, bytes(rng.randrange(256) for _ in range(SIZE[0]*SIZE[1]*4)))
+
+
+def expected_pixel(rawmode: str, pixel) -> bytes:
+    """Pack one pixel the slow obvious way."""
+    (r, g, b, a) = pixel
+    if rawmode == "RGB565":
+        return struct.pack("<H", (r >> 3) << 11 | (g >> 2) << 5 | b >> 3)
+    if rawmode == "BGR565":
+        return struct.pack("<H", (b >> 3) << 11 | (g >> 2) << 5 | r >> 3)
+    return bytes({"R": r, "G": g, "B": b, "A": a}[channel] for channel in rawmode)
+
+
+def expected(rawmode: str, img: Image.Image, rect: Rect, row_length: int) -> bytes:
+    rows = []
+    for y in range(rect.y0, rect.y1):
+        row = b"".join(expected_pixel(rawmode, img.getpixel((x, y))) for x in range(rect.x0, rect.x1))
+        rows.append(row.ljust(row_length, b"\0"))
+    return b"".join(rows)
+
+
+RAWMODES = ("BGRA", "RGBA", "BGR", "RGB", "RGB565", "BGR565")
+
+
+@pytest.mark.parametrize("rawmode", RAWMODES)
+def test_pack_whole_screen(rawmode):
+    img = screen()
+    pixel_format = PixelFormat(rawmode, SIZE)
+    rect = Rect(0, 0, *SIZE)
+    assert pixel_format.pack(img, rect) == expected(rawmode, img, rect, pixel_format.line_length)
+
+
+@pytest.mark.parametrize("rawmode", RAWMODES)
+def test_pack_pads_full_width_rows(rawmode):
+    img = screen()
+    pixel_format = PixelFormat(rawmode, SIZE, line_length=SIZE[0]*4 + 4)
+    rect = Rect(0, 1, SIZE[0], 3)
+    packed = pixel_format.pack(img.crop(rect), rect)
+    assert packed == expected(rawmode, img, rect, pixel_format.line_length)
+
+
+@pytest.mark.parametrize("rawmode", RAWMODES)
+def test_pack_part_of_a_row_tightly(rawmode):
+    img = screen()
+    pixel_format = PixelFormat(rawmode, SIZE, line_length=SIZE[0]*4 + 4)
+    rect = Rect(2, 1, 5, 4)
+    assert pixel_format.pack(img.crop(rect), rect) == expected(rawmode, img, rect, 0)
+
+
+@pytest.mark.parametrize("rawmode", RAWMODES)
+@pytest.mark.parametrize("rect", (Rect(0, 0, 7, 5), Rect(0, 2, 7, 4), Rect(1, 1, 6, 4)))
+def test_pack_into_matches_pack(rawmode, rect):
+    img = screen()
+    pixel_format = PixelFormat(rawmode, SIZE, line_length=SIZE[0]*4 + 4)
+    target = bytearray(pixel_format.line_length*SIZE[1] + 8)
+    pixel_format.pack_into(img, rect, target, base=8)
+    reference = bytearray(len(target))
+    pixel_format.copy_rows(pixel_format.pack(img.crop(rect), rect), rect, reference, 8)
+    assert target == reference
+    assert pixel_format.extract(memoryview(target)[8:], rect) == pixel_format.pack(img.crop(rect), rect)
+
+
+def test_from_bitfields():
+    assert PixelFormat.from_bitfields(32, 16, 0, SIZE).rawmode == "BGRA"
+    assert PixelFormat.from_bitfields(24, 0, 16, SIZE).rawmode == "RGB"
+    assert PixelFormat.from_bitfields(16, 11, 0, SIZE).rawmode == "RGB565"
+    assert PixelFormat.from_bitfields(16, 0, 11, SIZE).rawmode == "BGR565"
+    with pytest.raises(ValueError):
+        PixelFormat.from_bitfields(8, 0, 0, SIZE)
+
+
+def test_encoder_check(monkeypatch):
+    assert pixelformat._can_encode_into()
+    with monkeypatch.context() as patch:
+        patch.setattr(Image, "_getencoder", lambda *args: object())
+        assert not pixelformat._can_encode_into()
+    monkeypatch.delattr(Image, "_getencoder")
+    assert not pixelformat._can_encode_into()
+
+
+@pytest.mark.parametrize("rawmode", ("BGRA", "RGBA", "BGR", "RGB"))
+def test_pack_into_without_the_encoder(rawmode, monkeypatch):
+    img = screen()
+    rect = Rect(1, 1, 6, 4)
+    encoded = bytearray(SIZE[1]*(SIZE[0]*4 + 4))
+    PixelFormat(rawmode, SIZE, line_length=SIZE[0]*4 + 4).pack_into(img, rect, encoded)
+    monkeypatch.setattr(pixelformat, "_can_encode_into", lambda: False)
+    pixel_format = PixelFormat(rawmode, SIZE, line_length=SIZE[0]*4 + 4)
+    target = bytearray(len(encoded))
+    pixel_format.pack_into(img, rect, target)
+    assert target == encoded
+    assert pixel_format.extract(target, rect) == expected(rawmode, img, rect, 0)
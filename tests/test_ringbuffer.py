@@ -0,0 +1,69 @@
+from ringbuffer import RingBuffer, MappedRingBuffer
+
+
+def contents(views) -> list:
+    (older, newer) = views
+    return list(older) + list(newer)
+
+
+def test_fills_then_wraps():
+    ring = RingBuffer(4)
+    for value in range(3):
+        ring.append(value)
+    assert list(ring) == [0, 1, 2]
+    for value in range(3, 7):
+        ring.append(value)
+    assert list(ring) == [3, 4, 5, 6]
+    assert len(ring) == 4
+    assert ring.count == 7
+    assert ring.last() == 6
+
+
+def test_views_split_where_it_wraps():
+    ring = RingBuffer(4)
+    for value in range(6):
+        ring.append(value)
+    (older, newer) = ring.views()
+    assert (list(older), list(newer)) == ([2, 3], [4, 5])
+    assert older.readonly and newer.readonly
+
+
+def test_views_last():
+    ring = RingBuffer(5)
+    for value in range(8):
+        ring.append(value)
+    # Stored as [5, 6, 7, 3, 4], oldest is 3
+    for last in range(6):
+        assert contents(ring.views(last)) == list(range(8))[8 - last:], last
+    assert contents(ring.views(10)) == [3, 4, 5, 6, 7]
+
+
+def test_views_last_before_full():
+    ring = RingBuffer(5)
+    for value in range(3):
+        ring.append(value)
+    assert contents(ring.views(2)) == [1, 2]
+    assert contents(ring.views(3)) == [0, 1, 2]
+
+
+def test_empty():
+    ring = RingBuffer(3)
+    assert ring.last() is None
+    assert list(ring) == []
+    assert contents(ring.views(2)) == []
+
+
+def test_mapped_survives_reopening(tmp_path):
+    path = str(tmp_path / "ring")
+    ring = MappedRingBuffer(path, 3)
+    for value in range(5):
+        ring.append(value)
+    ring.close()
+    ring = MappedRingBuffer(path, 3)
+    assert list(ring) == [2, 3, 4]
+    assert ring.count == 5
+    ring.close()
+    # A different capacity starts afresh
+    ring = MappedRingBuffer(path, 4)
+    assert list(ring) == []
+    ring.close()
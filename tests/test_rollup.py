@@ -0,0 +1,45 @@
+from rollup import RollupTier
+
+
+def test_aggregates_each_interval():
+    tier = RollupTier(60, 10)
+    for (value, t) in ((5, 0), (-2, 10), (9, 59), (4, 60), (1, 119), (3, 120)):
+        tier.add(value, t)
+    assert tier.series("sum").copy() == [12, 5]
+    assert tier.series("max").copy() == [9, 4]
+    assert tier.series("min").copy() == [-2, 1]
+
+
+def test_slots_are_aligned_to_the_interval():
+    tier = RollupTier(60, 10)
+    tier.add(1, 1000)
+    tier.add(2, 1019)
+    # 1020 starts the next minute
+    tier.add(3, 1020)
+    assert tier.series().copy() == [3]
+
+
+def test_partial_interval_is_not_visible():
+    tier = RollupTier(60, 10)
+    tier.add(1, 0)
+    tier.add(2, 30)
+    assert tier.series().count == 0
+
+
+def test_gap_gets_empty_slots():
+    tier = RollupTier(60, 10)
+    tier.add(5, 0)
+    # Nothing was sampled for three minutes
+    tier.add(7, 4*60)
+    tier.add(1, 5*60)
+    for stat in ("sum", "max", "min"):
+        assert tier.series(stat).copy() == [5, 0, 0, 0, 7]
+
+
+def test_gap_longer_than_the_tier():
+    tier = RollupTier(60, 4)
+    tier.add(5, 0)
+    tier.add(7, 1000*60)
+    tier.add(1, 1001*60)
+    assert tier.series().copy() == [0, 0, 0, 7]
+    assert tier.series().count == 6
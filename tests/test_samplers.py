@@ -0,0 +1,160 @@
+import pytest
+from samplers import (
+    counter_delta, find_line, find_int, ProcFile, ProcDir, SourceHub, CpuSampler, MemorySampler, LoadSampler,
+    ValueSampler, ThermalSampler, StationSampler
+)
+
+
+def test_counts_up():
+    assert counter_delta(150, 100) == 50
+    assert counter_delta(100, 100) == 0
+
+
+def test_wraps_at_32_bits():
+    assert counter_delta(5, (1 << 32) - 10, bits=32) == 15
+
+
+def test_wraps_at_64_bits():
+    assert counter_delta(5, (1 << 64) - 10, bits=64) == 15
+    assert counter_delta(1 << 32, (1 << 64) - 1, bits=64) == (1 << 32) + 1
+
+
+def test_counter_above_32_bits_wraps_at_64():
+    assert counter_delta(5, (1 << 64) - 10) == 15
+
+
+def test_reset_counts_from_zero():
+    # Going back from a small count can't be a wrap
+    assert counter_delta(20, 1000) == 20
+    assert counter_delta(20, 1000, bits=32) == 20
+    assert counter_delta(20, 1 << 40) == 20
+
+
+def test_reset_is_not_taken_for_a_wrap_without_the_width():
+    # An interface bounced after 3 GB, which a 32 bit wrap would read as 1.3 GB moved
+    assert counter_delta(1_000_000, 3_000_000_000) == 1_000_000
+    assert counter_delta(1_000_000, 3_000_000_000, bits=32) == 1_000_000 + (1 << 32) - 3_000_000_000
+
+
+def test_find_line_only_at_line_starts():
+    data = bytearray(b"cpu  1 2\ncpu1 3 4\nxcpu9 5\ncpu9 6\n")
+    assert find_line(data, len(data), b"cpu ") == 4
+    assert find_line(data, len(data), b"cpu1 ") == 14
+    assert find_line(data, len(data), b"cpu9 ") == 31
+    assert find_line(data, len(data), b"cpu2 ") == -1
+    # Only data[:end] is looked at
+    assert find_line(data, 20, b"cpu9 ") == -1
+
+
+def test_find_int():
+    data = bytearray(b"MemTotal:       1024 kB\nMemFree:   512 kB\nBad:  kB\n")
+    assert find_int(data, len(data), b"MemTotal:") == 1024
+    assert find_int(data, len(data), b"MemFree:") == 512
+    assert find_int(data, len(data), b"Bad:") is None
+    assert find_int(data, len(data), b"Missing:") is None
+
+
+def write(path, text: str) -> str:
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+STAT = """cpu  {0} 0 0 {1} 0 0 0 0 0 0
+cpu1 100 0 0 100 0 0 0 0 0 0
+cpu10 {0} 0 {0} 0 0 0 0 0 0 0
+intr 1 2 3
+"""
+
+
+def test_cpu_sampler_picks_its_line(tmp_path):
+    path = write(tmp_path / "stat", STAT.format(100, 100))
+    total = CpuSampler(10, path=path)
+    core1 = CpuSampler(10, cpu="cpu1", path=path)
+    core10 = CpuSampler(10, cpu="cpu10", path=path)
+    assert total.last_sample == (100, 200)
+    assert core1.last_sample == (100, 200)
+    assert core10.last_sample == (200, 200)
+    # 300 more jiffies, 100 of them busy
+    write(path, STAT.format(200, 300))
+    SourceHub.shared(path)._do_read()
+    assert total.copy() == [100 / 3]
+    assert core1.copy() == [0.0]
+    assert core10.copy() == [100.0]
+
+
+def test_cpu_sampler_needs_its_line(tmp_path):
+    with pytest.raises(ValueError):
+        CpuSampler(10, cpu="cpu2", path=write(tmp_path / "stat", STAT.format(1, 1)))
+
+
+def test_memory_sampler(tmp_path):
+    path = write(tmp_path / "meminfo", "MemTotal:  2048 kB\nMemAvailable:  1536 kB\n")
+    sampler = MemorySampler(10, path=path)
+    assert sampler.last_sample == 1536
+    write(path, "MemTotal:  2048 kB\nMemAvailable:  1024 kB\n")
+    SourceHub.shared(path)._do_read()
+    assert sampler.copy() == [1024]
+
+
+def test_load_sampler(tmp_path):
+    path = write(tmp_path / "loadavg", "0.50 1.25 2.00 1/123 4567\n")
+    assert LoadSampler(10, path=path).last_sample == 0.5
+    assert LoadSampler(10, minutes=5, path=path).last_sample == 1.25
+    assert LoadSampler(10, minutes=15, path=path).last_sample == 2.0
+
+
+def test_value_sampler_scales(tmp_path):
+    path = write(tmp_path / "value", "42\n")
+    assert ValueSampler(path, 10).last_sample == 42
+    assert ValueSampler(path, 10, scale=0.5).last_sample == 21.0
+
+
+def test_thermal_sampler_in_degrees(tmp_path):
+    hub = SourceHub(ProcFile(write(tmp_path / "temp", "45500\n")))
+    assert ThermalSampler(10, hub=hub).last_sample == 45.5
+
+
+def test_station_sampler_counts_stations(tmp_path):
+    for mac in ("aa:bb:cc:dd:ee:01", "aa:bb:cc:dd:ee:02"):
+        (tmp_path / mac).mkdir()
+    hub = SourceHub(ProcDir(str(tmp_path)))
+    sampler = StationSampler(10, "wlan0", phy="phy0", hub=hub)
+    assert sampler.last_sample == 2
+    (tmp_path / "aa:bb:cc:dd:ee:03").mkdir()
+    hub._do_read()
+    assert sampler.copy() == [3]
+
+
+class CountingFile(ProcFile):
+    reads = 0
+
+    def read(self) -> int:
+        self.reads += 1
+        return super().read()
+
+
+def test_hub_reads_once_for_every_subscriber(tmp_path):
+    path = write(tmp_path / "stat", STAT.format(100, 100))
+    assert SourceHub.shared(path) is SourceHub.shared(path)
+    assert SourceHub.shared(path) is not SourceHub.shared(path, interval=5)
+    hub = SourceHub(CountingFile(path))
+    samplers = [CpuSampler(10, cpu=cpu, path=path, hub=hub) for cpu in ("cpu", "cpu1", "cpu10")]
+    write(path, STAT.format(200, 300))
+    hub._do_read()
+    assert hub.source.reads == 2
+    assert [sampler.count for sampler in samplers] == [1, 1, 1]
+
+
+def test_failing_subscriber_doesnt_stop_the_rest(tmp_path):
+    path = write(tmp_path / "value", "7\n")
+    hub = SourceHub(ProcFile(path))
+    (first, second) = (ValueSampler(path, 10, hub=hub), ValueSampler(path, 10, hub=hub))
+    readings = []
+    hub.subscribe(lambda source, length, timestamp: readings.append(length))
+    write(path, "not a number\n")
+    hub._do_read()
+    write(path, "9\n")
+    hub._do_read()
+    assert first.copy() == second.copy() == [9]
+    assert readings == [13, 2]
@@ -0,0 +1,81 @@
+import asyncio
+import json
+import pytest
+from network import IfSampler
+from sources import ReplayHub, SyntheticHub, Traffic, LineRate, record
+
+
+def write_trace(path, times, step=100) -> str:
+    with open(path, "w") as trace:
+        for (i, t) in enumerate(times):
+            trace.write(json.dumps({"t": t, "counters": {"eth0": {"bytes_sent": 1000 + i*step}}}) + "\n")
+    return str(path)
+
+
+def test_loop_carries_on_without_a_gap(tmp_path):
+    hub = ReplayHub(write_trace(tmp_path / "trace", [0, 1, 2, 3, 4]), loop=True)
+    sampler = IfSampler("eth0", "bytes_sent", 20, hub=hub)
+    stamps = []
+    hub.subscribe(lambda counters, timestamp: stamps.append(timestamp.timestamp()))
+    for _ in range(14):
+        assert hub.tick()
+    assert sampler.copy() == [100]*14
+    assert [b - a for (a, b) in zip(stamps, stamps[1:])] == [1]*13
+
+
+def test_stops_at_the_end_without_loop(tmp_path):
+    hub = ReplayHub(write_trace(tmp_path / "trace", [0, 1, 2]))
+    assert hub.tick() and hub.tick()
+    assert not hub.tick()
+    assert hub.counters["eth0"].bytes_sent == 1200
+
+
+def test_interval_is_the_shortest_gap(tmp_path):
+    hub = ReplayHub(write_trace(tmp_path / "trace", [0, 3, 4, 5]))
+    assert hub.interval == 1
+
+
+def test_paced_by_the_trace_timestamps(tmp_path):
+    # The recorder missed two ticks between the first records
+    hub = ReplayHub(write_trace(tmp_path / "trace", [0, 3, 4, 5, 6]), speed=10)
+    ticks = []
+    hub.subscribe(lambda counters, timestamp: ticks.append(counters["eth0"].bytes_sent))
+
+    async def caught_up_after(seconds) -> int:
+        # As if started that long ago in real time
+        hub._started = asyncio.get_event_loop().time() - seconds
+        hub._catch_up()
+        return len(ticks)
+    assert [asyncio.run(caught_up_after(seconds)) for seconds in (0.1, 0.29, 0.31, 0.45, 1)] == [0, 0, 1, 2, 4]
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "trace")
+    synthetic = SyntheticHub(ifnames=("eth0", "wan"), seed=3)
+    record(path, synthetic, ticks=10)
+    published = []
+    synthetic.subscribe(lambda counters, timestamp: published.append((dict(counters), timestamp)))
+    for _ in range(12):
+        synthetic.tick()
+    replay = ReplayHub(path)
+    assert len(replay) == 10
+    replayed = [(dict(replay.counters), replay.timestamp)]
+    while replay.tick():
+        replayed.append((dict(replay.counters), replay.timestamp))
+    assert replayed == published[:10]
+
+
+def test_synthetic_counters_wrap():
+    hub = SyntheticHub(traffic=LineRate(10e9), counter_bits=32)
+    sampler = IfSampler("eth0", "bytes_sent", 10, hub=hub)
+    for _ in range(10):
+        hub.tick()
+    assert min(sampler.copy()) > 0
+    assert hub.counters["eth0"].bytes_sent < 1 << 32
+
+
+def test_traffic_must_say_how_many_bytes():
+    class Silent(Traffic):
+        pass
+    with pytest.raises(TypeError):
+        Silent()
@@ -0,0 +1,151 @@
+import asyncio
+from PIL import Image
+from local_types import Dimension, Rect
+from stream import StreamFB, StreamViewer, MSG_FRAME, FRAME, TILE, TILE_RAW, TILE_XOR
+
+SIZE = Dimension(100, 70)
+
+
+def frame(color) -> Image.Image:
+    return Image.new("RGBA", SIZE, color)
+
+
+async def read_frame(viewer: StreamViewer) -> list[int]:
+    """Read and apply the next frame, returning the encoding of each of its tiles."""
+    while True:
+        (kind, payload) = await asyncio.wait_for(viewer._read_message(), 2)
+        if kind == MSG_FRAME:
+            break
+    (_, count) = FRAME.unpack_from(payload)
+    (offset, encodings) = (FRAME.size, [])
+    for _ in range(count):
+        (_, _, _, _, encoding, length) = TILE.unpack_from(payload, offset)
+        encodings.append(encoding)
+        offset += TILE.size + length
+    viewer._apply(payload)
+    return encodings
+
+
+def shows(viewer: StreamViewer, image: Image.Image) -> bool:
+    return viewer.image.tobytes() == image.convert("RGB").tobytes()
+
+
+async def connect(path) -> StreamViewer:
+    viewer = StreamViewer()
+    await viewer.connect(f"unix:{path}")
+    return viewer
+
+
+async def present(display: StreamFB, image: Image.Image, regions=None) -> None:
+    """Present from another thread, as the render thread does."""
+    await asyncio.get_running_loop().run_in_executor(None, display.present, image, regions)
+
+
+def stream(tmp_path, scenario) -> None:
+    async def run():
+        with StreamFB(SIZE, tile_size=32) as display:
+            await display.serve(f"unix:{tmp_path / 'sock'}")
+            await scenario(display, tmp_path / "sock")
+    asyncio.run(run())
+
+
+def test_keyframe_on_connect(tmp_path):
+    async def scenario(display, path):
+        await present(display, frame((255, 0, 0, 255)))
+        viewer = await connect(path)
+        # A 100x70 screen is 4x3 tiles of 32
+        assert await read_frame(viewer) == [TILE_RAW]*12
+        assert shows(viewer, frame((255, 0, 0, 255)))
+        viewer.close()
+    stream(tmp_path, scenario)
+
+
+def test_changed_tiles_are_sent_as_xor(tmp_path):
+    async def scenario(display, path):
+        viewer = await connect(path)
+        await read_frame(viewer)
+        image = frame((0, 0, 0, 255))
+        image.paste((0, 255, 0, 255), (40, 40, 70, 50))
+        await present(display, image, [Rect(40, 40, 70, 50)])
+        assert await read_frame(viewer) == [TILE_XOR]*2
+        assert shows(viewer, image)
+        # Presenting the same pixels again sends nothing new, so the next frame is the following change
+        await present(display, image, [Rect(40, 40, 70, 50)])
+        image.paste((0, 0, 255, 255), (96, 64, 100, 70))
+        await present(display, image, [Rect(96, 64, 100, 70)])
+        assert await read_frame(viewer) == [TILE_XOR]
+        assert shows(viewer, image)
+        viewer.close()
+    stream(tmp_path, scenario)
+
+
+def test_late_joiner_and_earlier_viewer_agree(tmp_path):
+    async def scenario(display, path):
+        first = await connect(path)
+        await read_frame(first)
+        await present(display, frame((255, 0, 0, 255)))
+        second = await connect(path)
+        await read_frame(second)
+        await read_frame(first)
+        assert shows(first, frame((255, 0, 0, 255)))
+        assert shows(second, frame((255, 0, 0, 255)))
+        await present(display, frame((0, 0, 255, 255)))
+        for viewer in (first, second):
+            await read_frame(viewer)
+            assert shows(viewer, frame((0, 0, 255, 255)))
+            viewer.close()
+    stream(tmp_path, scenario)
+
+
+def test_stale_viewer_gets_a_keyframe(tmp_path):
+    async def scenario(display, path):
+        (first, second) = (await connect(path), await connect(path))
+        await read_frame(first)
+        await read_frame(second)
+        # As if second stopped reading and was skipped
+        display._viewers[1].stale = True
+        image = frame((0, 0, 0, 255))
+        image.paste((255, 255, 0, 255), (0, 0, 10, 10))
+        await present(display, image, [Rect(0, 0, 10, 10)])
+        assert await read_frame(first) == [TILE_XOR]
+        assert await read_frame(second) == [TILE_RAW]*12
+        image.paste((255, 0, 255, 255), (96, 0, 100, 10))
+        await present(display, image, [Rect(96, 0, 100, 10)])
+        for viewer in (first, second):
+            assert await read_frame(viewer) == [TILE_XOR]
+            assert shows(viewer, image)
+            viewer.close()
+    stream(tmp_path, scenario)
+
+
+class KeyframeOnRelease:
+    """Lock which builds a keyframe, as a viewer connecting would, each time present() lets go of it."""
+
+    def __init__(self, display: StreamFB):
+        self._display = display
+        self._lock = display._lock
+        self._inside = False
+
+    def __enter__(self):
+        self._lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+        if not self._inside:
+            self._inside = True
+            with self:
+                self._display._keyframe()
+            self._inside = False
+
+
+def test_keyframe_between_frames_leaves_nothing_unsent(tmp_path):
+    # A keyframe taken between writing pixels and sending them used to leave the viewers behind for good
+    async def scenario(display, path):
+        viewer = await connect(path)
+        await read_frame(viewer)
+        display._lock = KeyframeOnRelease(display)
+        await present(display, frame((255, 0, 0, 255)))
+        assert await read_frame(viewer) == [TILE_XOR]*12
+        assert shows(viewer, frame((255, 0, 0, 255)))
+        viewer.close()
+    stream(tmp_path, scenario)
@@ -0,0 +1,79 @@
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from textcache import TextCache, GlyphAtlas, text_cache
+
+ANCHORS = ("la", "ma", "ra", "ls", "ms", "rs", "ld", "md", "rd")
+
+# Labels and clock faces as the widgets draw them, with odd and even numbers of characters
+ATLAS_TEXTS = ("12:34:56", "1.9M", "-6", "999K", "100%", "+5.25E", " 0 ", "7")
+
+
+def mono_font(size: int) -> ImageFont.FreeTypeFont:
+    """Get the default face, or another monospaced one where it isn't to hand."""
+    for face in ("inconsolata.ttf", "DejaVuSansMono.ttf"):
+        try:
+            return ImageFont.truetype(face, size)
+        except OSError:
+            pass
+    pytest.skip("no monospaced font")
+
+
+def drawn(draw) -> Image.Image:
+    """Get a mask with draw(drawable) drawn into it, around the middle."""
+    mask = Image.new("L", (300, 100))
+    draw(ImageDraw.Draw(mask))
+    return mask
+
+
+def same(a: Image.Image, b: Image.Image) -> bool:
+    return ImageChops.difference(a, b).getbbox() is None
+
+
+@pytest.mark.parametrize("anchor", ANCHORS)
+def test_cache_draws_as_imagedraw(anchor):
+    cache = TextCache()
+    for font in (ImageFont.load_default(size=24), mono_font(17)):
+        for text in ("Hello, World", "eth0.2:sent", "1.9M"):
+            expected = drawn(lambda d: d.text((150, 50), text, font=font, fill=255, anchor=anchor))
+            assert same(drawn(lambda d: cache.draw(d, (150, 50), text, font, 255, anchor)), expected)
+            assert cache.bbox(font, text, anchor) == font.getbbox(text, anchor=anchor)
+
+
+@pytest.mark.parametrize("size", (11, 14, 24, 31))
+@pytest.mark.parametrize("anchor", ANCHORS)
+def test_atlas_draws_as_imagedraw(size, anchor):
+    font = mono_font(size)
+    atlas = GlyphAtlas(font)
+    for text in ATLAS_TEXTS:
+        assert atlas.covers(text)
+        expected = drawn(lambda d: d.text((150, 50), text, font=font, fill=255, anchor=anchor))
+        assert same(drawn(lambda d: atlas.draw(d, (150, 50), text, 255, anchor)), expected), text
+        assert atlas.bbox(text, anchor) == font.getbbox(text, anchor=anchor), text
+
+
+def test_atlas_falls_back_to_the_cache():
+    font = mono_font(24)
+    atlas = GlyphAtlas(font)
+    assert not atlas.covers("now")
+    misses = text_cache.misses
+    expected = drawn(lambda d: d.text((150, 50), "now", font=font, fill=255, anchor="la"))
+    assert same(drawn(lambda d: atlas.draw(d, (150, 50), "now", 255, "la")), expected)
+    assert atlas.bbox("now") == font.getbbox("now")
+    # Rasterised once, then found in the cache
+    assert text_cache.misses == misses + 1
+
+
+def test_least_recently_used_are_evicted():
+    font = ImageFont.load_default(size=12)
+    cache = TextCache(3)
+    for text in ("a", "b", "c"):
+        cache.sprite(font, text)
+    cache.sprite(font, "a")
+    cache.sprite(font, "d")
+    assert len(cache) == 3
+    (hits, misses) = (cache.hits, cache.misses)
+    for text in ("a", "c", "d"):
+        cache.sprite(font, text)
+    assert (cache.hits, cache.misses) == (hits + 3, misses)
+    cache.sprite(font, "b")
+    assert (len(cache), cache.misses) == (3, misses + 1)
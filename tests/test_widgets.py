@@ -0,0 +1,274 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Tuple
+import pytest
+from PIL import Image, ImageChops, ImageFont
+from fb import MemoryFB
+from local_types import Dimension, Point, Rect
+from network import IfSampler, SeriesGraph, SeriesGraphDecorator, axis_label
+from sources import SyntheticHub, LineRate
+from widgets import Widget, Screen, BorderDecorator, BarGaugeWidget, CarouselWidget, ClockWidget, TextWidget, black
+
+FONT = ImageFont.load_default(size=24)
+
+
+def render(bake: bool, traffic, ticks: int = 20) -> list:
+    """Get the screen after each tick of a decorated graph fed with traffic."""
+    hub = SyntheticHub(traffic=traffic)
+    graph = SeriesGraph(IfSampler("eth0", "bytes_sent", 100, hub=hub), Dimension(200, 60))
+    widget = BorderDecorator(SeriesGraphDecorator(graph, FONT), border_width=8)
+    frames = []
+    # The samples wake the screen, which with no loop running schedules nothing, so the frames are drawn here
+    with MemoryFB(Dimension(400, 200)) as display:
+        screen = Screen(display, [(widget, Point(10, 10))], threaded=False, bake=bake)
+        for _ in range(ticks):
+            hub.tick()
+            screen._draw()
+            frames.append(screen._screen.copy())
+    return frames
+
+
+@pytest.mark.parametrize("rate", (1e6, 10e9))
+def test_baked_frames_match_composited_ones(rate):
+    # Baked decorations sit under the content, so any which overlap the graph would be hidden
+    traffic = LineRate(rate)
+    for (baked, composited) in zip(render(True, traffic), render(False, traffic)):
+        assert ImageChops.difference(baked, composited).getbbox(alpha_only=False) is None
+
+
+def test_axis_label_fits_its_space():
+    for value in (0, 999, 1000, 10*1024, 999.6*1024, 1.25e9, 2**63):
+        label = axis_label(value)
+        assert len(label) <= 4, label
+
+
+def composited(widget, background=(40, 80, 120, 255)) -> Image.Image:
+    """Get a screen with widget composited over background."""
+    with MemoryFB(Dimension(widget.size[0] + 8, widget.size[1] + 8)) as display:
+        screen = Screen(display, [(widget, Point(4, 4))], threaded=False)
+        screen.clear(background)
+        screen._draw()
+        return screen._screen.copy()
+
+
+def same_pixels(a: Image.Image, b: Image.Image) -> bool:
+    return ImageChops.difference(a, b).getbbox(alpha_only=False) is None
+
+
+@pytest.mark.parametrize("background", (black, None))
+def test_text_on_l_surface_matches_rgba(background):
+    (compact, full) = (TextWidget("Hi 42", FONT, background=background, foreground=(255, 200, 0, 255), mode=mode)
+                       for mode in ("L", "RGBA"))
+    assert compact.mode == "L"
+    assert same_pixels(composited(compact), composited(full))
+
+
+def test_translucent_background_falls_back_to_rgba():
+    assert TextWidget("Hi", FONT, background=(255, 0, 0, 128)).mode == "RGBA"
+    assert ClockWidget(FONT, background=(255, 0, 0, 128)).mode == "RGBA"
+    assert TextWidget("Hi", FONT, background=(255, 0, 0, 128), mode="1").mode == "RGBA"
+    # The screen shows through the background
+    assert composited(TextWidget("Hi", FONT, background=(255, 0, 0, 128))).getpixel((5, 5))[2] > 0
+
+
+@pytest.mark.parametrize("background", (black, None))
+def test_graph_on_1_surface_matches_rgba(background):
+    hub = SyntheticHub(seed=1)
+    sampler = IfSampler("eth0", "bytes_sent", 50, hub=hub)
+    for _ in range(50):
+        hub.tick()
+    (compact, full) = (SeriesGraph(sampler, Dimension(100, 40), background=background, color=(0, 255, 0, 255), mode=mode)
+                       for mode in ("1", "RGBA"))
+    assert compact.mode == "1"
+    assert same_pixels(composited(compact), composited(full))
+
+
+@pytest.mark.parametrize("value", (0.3, 0.8))
+def test_gauge_on_p_surface_matches_rgba(value):
+    (compact, full) = (BarGaugeWidget(lambda: value, size=Dimension(10, 40), mode=mode) for mode in ("P", "RGBA"))
+    assert compact.mode == "P"
+    assert same_pixels(composited(compact), composited(full))
+
+
+class Counter(Widget):
+    """Widget showing a number, which wakes the screen when it changes."""
+
+    def __init__(self):
+        super().__init__(Dimension(20, 10), background=black)
+        self.value = 0
+        self.renders = 0
+
+    def set(self, value: int) -> None:
+        self.value = value
+        self.invalidate()
+        self.wake()
+
+    def ddraw(self, drawable):
+        super().ddraw(drawable)
+        self.renders += 1
+        drawable.rectangle([0, 0, self.value, 9], fill=(255, 0, 0, 255))
+
+
+def test_frames_follow_changes():
+    widget = Counter()
+
+    async def run():
+        with MemoryFB(Dimension(40, 20)) as display:
+            screen = Screen(display, [(widget, Point(0, 0))], min_interval=0.01)
+            flips = display.flips
+            await screen.start()
+            await asyncio.sleep(0.05)
+            # Nothing changed since the screen was built
+            assert (screen.skipped, widget.renders, display.flips) == (1, 1, flips)
+            widget.set(5)
+            await asyncio.sleep(0.05)
+            assert (widget.renders, display.flips) == (2, flips + 1)
+            # Changes before the frame comes are rendered together
+            for value in (6, 7, 8):
+                widget.set(value)
+            await asyncio.sleep(0.05)
+            assert (widget.renders, display.flips, screen.skipped) == (3, flips + 2, 1)
+            await screen.stop()
+            return display.pixel_format.extract(display.buffer, Rect(0, 0, 40, 20))
+    assert asyncio.run(run()) == composited_bytes(8)
+
+
+def composited_bytes(value: int) -> bytes:
+    """Get what a MemoryFB holds after a Counter at value is rendered synchronously."""
+    widget = Counter()
+    widget.value = value
+    with MemoryFB(Dimension(40, 20)) as display:
+        Screen(display, [(widget, Point(0, 0))], threaded=False)
+        return bytes(display.buffer)
+
+
+def test_wake_without_a_loop_schedules_nothing():
+    with MemoryFB(Dimension(40, 20)) as display:
+        widget = Counter()
+        screen = Screen(display, [(widget, Point(0, 0))], threaded=False)
+        widget.set(3)
+        assert screen._frame_handle is None
+
+
+class RecordingFB(MemoryFB):
+    """MemoryFB which records the thread each frame is presented on."""
+
+    def __init__(self, size: Dimension, present_on_loop: bool = False):
+        super().__init__(size)
+        self.present_on_loop = present_on_loop
+        self.threads = []
+
+    def present(self, frame, regions=None) -> None:
+        self.threads.append(threading.current_thread())
+        super().present(frame, regions)
+
+
+@pytest.mark.parametrize("present_on_loop", (False, True))
+def test_threaded_frames_coalesce_and_match(present_on_loop):
+    widget = Counter()
+    in_flight = []
+
+    async def run():
+        with RecordingFB(Dimension(40, 20), present_on_loop) as display:
+            screen = Screen(display, [(widget, Point(0, 0))], min_interval=0)
+            render = screen._render
+
+            def slow_render():
+                in_flight.append(threading.current_thread())
+                assert len(in_flight) == 1
+                time.sleep(0.02)
+                try:
+                    return render()
+                finally:
+                    in_flight.pop()
+
+            screen._render = slow_render
+            await screen.start()
+            display.threads.clear()
+            for value in range(1, 21):
+                widget.set(value)
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(0.1)
+            await screen.stop()
+            return (bytes(display.buffer), display.threads)
+
+    (pixels, threads) = asyncio.run(run())
+    assert pixels == composited_bytes(20)
+    # Sets which came while a frame was rendering were picked up together
+    assert 2 <= widget.renders <= 10
+    loop_thread = threading.current_thread()
+    assert all((thread is loop_thread) == present_on_loop for thread in threads)
+
+
+CAROUSEL_SIZE = Dimension(30, 20)
+PAGE_DELAY = 5
+
+
+def carousel(values: list[int], max_surfaces: int = 2) -> Tuple[CarouselWidget, list[Counter]]:
+    """Get a carousel with a page for each value, showing a Counter at it, and the counters."""
+    counters = []
+    for value in values:
+        counters.append(Counter())
+        counters[-1].value = value
+    pages = [(PAGE_DELAY, [(counter, Point(i, i))]) for (i, counter) in enumerate(counters)]
+    (w, h) = CAROUSEL_SIZE
+    widget = CarouselWidget(pages, size=CAROUSEL_SIZE, max_bytes=w*h*4*max_surfaces)
+    # The first check turns to the second page and starts timing it
+    widget.update()
+    return (widget, counters)
+
+
+def fresh_page(values: list[int], page: int) -> Image.Image:
+    """Get a page rendered by a carousel which never showed any other."""
+    (widget, _) = carousel(values)
+    widget._page = page
+    return widget.draw().copy()
+
+
+def test_carousel_pages_match_a_fresh_render():
+    values = [1, 2, 3, 4]
+    (widget, counters) = carousel(values)
+    for turn in range(12):
+        # Nearly time to turn, so the next page warms
+        widget._last_displayed = datetime.now().timestamp() - PAGE_DELAY + 1
+        widget.update()
+        widget.draw()
+        assert widget._warm == (widget._page + 1) % 4
+        # Pages change whether they are showing, warming, kept or thrown away
+        for (i, counter) in enumerate(counters):
+            if (turn + i) % 3 == 0:
+                values[i] = (values[i] + 5) % 20
+                counter.set(values[i])
+        widget.update()
+        widget.draw()
+        assert len(widget._surfaces) <= 2
+        widget._last_displayed = 0
+        widget.update()
+        assert same_pixels(widget.draw(), fresh_page(values, widget._page))
+        assert len(widget._surfaces) <= 2
+
+
+def test_carousel_keeps_surfaces_within_the_cap():
+    (widget, _) = carousel([1, 2, 3, 4, 5], max_surfaces=3)
+    for _ in range(10):
+        widget._last_displayed = datetime.now().timestamp() - PAGE_DELAY + 1
+        widget.update()
+        widget.draw()
+        widget._last_displayed = 0
+        widget.update()
+        widget.draw()
+        assert len(widget._surfaces) <= 3
+        assert widget._page in widget._surfaces
+    # Enough pages have been shown to fill the cap
+    assert len(widget._surfaces) == 3
+
+
+@pytest.mark.parametrize("value, bound", ((-0.5, 0.0), (1.7, 1.0), (1e9, 1.0)))
+def test_gauge_clamps_to_its_bounds(value, bound):
+    (out, within) = (BarGaugeWidget(lambda reported=reported: reported, size=Dimension(10, 40)) for reported in (value, bound))
+    for widget in (out, within):
+        widget.update()
+    assert out._split == within._split == round(40 * bound)
+    assert same_pixels(composited(out), composited(within))
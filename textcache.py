@@ -0,0 +1,156 @@
+"""Caches of rasterised text so unchanged strings aren't rendered by FreeType again."""
+from __future__ import annotations
+import math
+from collections import OrderedDict
+from typing import Tuple
+from PIL import Image, ImageDraw, ImageFont
+from local_types import Color, Point
+
+# Number of strings kept rasterised by the shared cache
+MAX_SPRITES: int = 256
+
+# Characters the glyph atlases hold, enough for clocks and numeric labels with a unit
+ATLAS_CHARS: str = "0123456789:.-+% KMGTPE"
+
+Box = Tuple[int, int, int, int]
+
+
+class TextCache:
+    """LRU cache of strings rasterised as masks.
+
+    Sprites are coverage masks keyed by (font, text, anchor). The font object
+    carries the face and size, and the colour is applied when the mask is drawn,
+    so one sprite serves every colour a string is drawn in. Drawing a sprite
+    gives the same pixels as ImageDraw.text at a whole pixel position
+    """
+
+    def __init__(self, capacity: int = MAX_SPRITES):
+        """Create an empty cache holding at most capacity sprites."""
+        self._capacity = capacity
+        self._sprites: OrderedDict[tuple, Tuple[Image.Image, Box]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._sprites)
+
+    def clear(self) -> None:
+        """Throw away every sprite."""
+        self._sprites.clear()
+
+    def sprite(self, font: ImageFont, text: str, anchor: str = "la") -> Tuple[Image.Image, Box]:
+        """Get the mask for text and its box relative to the anchor point, rasterising it if it isn't cached."""
+        key = (font, text, anchor)
+        found = self._sprites.get(key)
+        if found is not None:
+            self._sprites.move_to_end(key)
+            self.hits += 1
+            return found
+        self.misses += 1
+        bbox = font.getbbox(text, anchor=anchor)
+        (x0, y0, x1, y1) = bbox
+        mask = Image.new("L", (max(x1 - x0, 0), max(y1 - y0, 0)))
+        if x1 > x0 and y1 > y0:
+            ImageDraw.Draw(mask).text((-x0, -y0), text, font=font, fill=255, anchor=anchor)
+        found = (mask, bbox)
+        self._sprites[key] = found
+        if len(self._sprites) > self._capacity:
+            self._sprites.popitem(last=False)
+        return found
+
+    def bbox(self, font: ImageFont, text: str, anchor: str = "la") -> Box:
+        """Get the box text covers when drawn at (0, 0), as font.getbbox() does."""
+        return self.sprite(font, text, anchor)[1]
+
+    def draw(self, drawable: ImageDraw, xy: Point, text: str, font: ImageFont, fill: Color, anchor: str = "la") -> None:
+        """Draw text as drawable.text() would."""
+        (mask, (x0, y0, _, _)) = self.sprite(font, text, anchor)
+        if mask.width and mask.height:
+            drawable.bitmap((round(xy[0]) + x0, round(xy[1]) + y0), mask, fill=fill)
+
+
+class GlyphAtlas:
+    """Masks for single characters of one font, so strings of them are composed rather than rasterised.
+
+    Each glyph is placed at the pen position rounded to a whole pixel, so a
+    string can be a pixel out from ImageDraw.text for proportional fonts. With
+    the monospaced fonts used for clocks and labels it matches. Strings with
+    characters outside the atlas fall back to the shared TextCache
+    """
+
+    def __init__(self, font: ImageFont, chars: str = ATLAS_CHARS):
+        """Rasterise chars in font."""
+        self._font = font
+        self._glyphs: dict[str, Tuple[Image.Image, Box, float]] = {}
+        for char in chars:
+            (mask, bbox) = TextCache(1).sprite(font, char, "ls")
+            self._glyphs[char] = (mask, bbox, font.getlength(char))
+        # Distances from the baseline to the ascender and descender lines, for the vertical anchors
+        (self._ascent, self._descent) = font.getmetrics()
+
+    def covers(self, text: str) -> bool:
+        """Check every character of text is in the atlas."""
+        return all(char in self._glyphs for char in text)
+
+    def length(self, text: str) -> float:
+        """Get the advance width of text."""
+        return sum(self._glyphs[char][2] for char in text)
+
+    def _origin(self, xy: Point, text: str, anchor: str) -> Tuple[float, float]:
+        """Get the pen position on the baseline for text drawn at xy with anchor."""
+        (x, y) = xy
+        (horizontal, vertical) = anchor
+        if horizontal == "r":
+            x -= self.length(text)
+        elif horizontal == "m":
+            # Half a pixel over goes left, as it does for ImageDraw.text
+            x = math.floor(x - self.length(text) / 2)
+        if vertical == "a":
+            y += self._ascent
+        elif vertical == "d":
+            y -= self._descent
+        elif vertical != "s":
+            raise ValueError(f"Unsupported vertical anchor {vertical}")
+        return (x, y)
+
+    def bbox(self, text: str, anchor: str = "la") -> Box:
+        """Get the box text covers when drawn at (0, 0)."""
+        if not self.covers(text):
+            return text_cache.bbox(self._font, text, anchor)
+        (pen, baseline) = self._origin((0, 0), text, anchor)
+        boxes = []
+        for char in text:
+            (_, (x0, y0, x1, y1), advance) = self._glyphs[char]
+            boxes.append((round(pen) + x0, round(baseline) + y0, round(pen) + x1, round(baseline) + y1))
+            pen += advance
+        if not boxes:
+            return (0, 0, 0, 0)
+        # Spaces widen the box as they do for font.getbbox(), but only the characters with ink set its height
+        inked = [box for box in boxes if box[3] > box[1]] or boxes
+        return (min(b[0] for b in boxes), min(b[1] for b in inked), max(b[2] for b in boxes), max(b[3] for b in inked))
+
+    def draw(self, drawable: ImageDraw, xy: Point, text: str, fill: Color, anchor: str = "la") -> None:
+        """Draw text by composing the glyph masks."""
+        if not self.covers(text):
+            text_cache.draw(drawable, xy, text, self._font, fill, anchor)
+            return
+        (pen, baseline) = self._origin(xy, text, anchor)
+        for char in text:
+            (mask, (x0, y0, _, _), advance) = self._glyphs[char]
+            if mask.width and mask.height:
+                drawable.bitmap((round(pen) + x0, round(baseline) + y0), mask, fill=fill)
+            pen += advance
+
+
+# Shared by all the widgets drawing text
+text_cache = TextCache()
+
+_atlases: dict[ImageFont, GlyphAtlas] = {}
+
+
+def glyph_atlas(font: ImageFont) -> GlyphAtlas:
+    """Get the shared atlas for font, creating it the first time."""
+    atlas = _atlases.get(font)
+    if atlas is None:
+        atlas = _atlases[font] = GlyphAtlas(font)
+    return atlas
@@ -1,30 +1,39 @@
 """Framebuffer using TK as a backend."""
 from __future__ import annotations
 from tkinter import Tk, Label
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from PIL import Image, ImageTk, ImageDraw
+import argparse
 import asyncio
+import logging
 import aiotkinter
-from typing import Tuple
-from framebuffer import Framebuffer
+from typing import Optional, Tuple
+from framebuffer import Framebuffer, Frame
+from pixelformat import PixelFormat
 
-from local_types import Color, Dimension, Point
+from local_types import Color, Dimension, Point, Rect
 from panel import panel, MAX_SAMPLES
-from widgets import Screen
+from widgets import Screen, TimingOverlayWidget
+from fonts import fonts
+import instrument
 
 from network import IfSampler
+from stream import StreamViewer
 
 
 class TkWindow(Framebuffer):
     """Create a fake framebuffer in a TK Window for development."""
 
-    def __init__(self):
+    # Tk may only be used from the thread running its event loop
+    present_on_loop = True
+
+    def __init__(self, size: Dimension = Dimension(1280, 720)):
         """Create a new instance of the TkWindow Framebuffer."""
-        super().__init__("tk", mode="RGBA", bpp=32, size=Dimension(1280, 720))
+        super().__init__("tk", mode="RGBA", bpp=32, size=size)
         self._root = Tk()
-        self._root.geometry("1280x720")
+        self._root.geometry(f"{size[0]}x{size[1]}")
 
         # Create a photoimage object of the image in the path
-        self.fb = Image.new("RGBA", (1280, 720))
+        self.fb = Image.new("RGBA", size)
         self._drawable = ImageDraw.Draw(self.fb)
         self._tk_bridge = ImageTk.PhotoImage(self.fb)
 
@@ -33,6 +42,16 @@ class TkWindow(Framebuffer):
         # Position image
         self._tk_host.place(x=0, y=0)
 
+    def resize(self, size: Dimension) -> None:
+        """Change the size of the window and clear it."""
+        self._size = size
+        self._pixel_format = PixelFormat(self._mode, size)
+        self._root.geometry(f"{size[0]}x{size[1]}")
+        self.fb = Image.new("RGBA", size)
+        self._drawable = ImageDraw.Draw(self.fb)
+        self._tk_bridge = ImageTk.PhotoImage(self.fb)
+        self._tk_host.configure(image=self._tk_bridge)
+
     def __enter__(self) -> Framebuffer:
         """Support python 'with' statement entry."""
         return self
@@ -49,22 +68,68 @@ class TkWindow(Framebuffer):
     def write_screen(self, some_bytes: list[bytes]) -> None:
         """Write an image as a raw stream of bytes to this Framebuffer."""
         new_image = Image.frombytes("RGBA", self.fb.size, some_bytes)
+        self.fb.paste(new_image)
         self._tk_bridge.paste(new_image)
 
+    def write_region(self, some_bytes: bytes, rect: Rect) -> None:
+        """Write the raw bytes for the pixels in rect to this Framebuffer."""
+        new_image = Image.frombytes("RGBA", (rect.x1 - rect.x0, rect.y1 - rect.y0), some_bytes)
+        self.fb.paste(new_image, (rect.x0, rect.y0))
+        self._tk_bridge.paste(self.fb)
+
+    def present(self, frame: Frame, regions: Optional[list[Rect]] = None) -> None:
+        """Show frame in the window.
+
+        Tk only takes whole images, so the regions make no difference and the
+        frame goes straight to the photo image, rather than through a copy of
+        the window. A packed frame is already RGBA and is wrapped as an image
+        without copying it
+        """
+        if not isinstance(frame, Image.Image):
+            frame = Image.frombuffer("RGBA", self._size, frame, "raw", "RGBA", self._pixel_format.line_length, 1)
+        self._tk_bridge.paste(frame)
+
+
+async def view(display: TkWindow, address: str) -> None:
+    """Show the screen streamed by a StreamFB at address until it goes away."""
+    viewer = StreamViewer()
+    await viewer.connect(address)
+    display.resize(viewer.size)
+    try:
+        while True:
+            display.present(viewer.image, await viewer.next_frame())
+    except asyncio.IncompleteReadError:
+        print(f"{address} closed the stream")
+    finally:
+        viewer.close()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the panel, or a remote screen, in a Tk window")
+    parser.add_argument("--connect", help="view the screen streamed from unix:/path or host:port instead")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    timing = instrument.from_environ()
+
     fb = TkWindow()
-    sent_sampler = IfSampler("eth0", "bytes_sent", MAX_SAMPLES)
-    recv_sampler = IfSampler("eth0", "bytes_recv", MAX_SAMPLES)
     with fb as display:
         display.clear(Color(128, 0, 128, 255))
 
-        screen = Screen(display, panel(sent_sampler, recv_sampler))
-
         asyncio.set_event_loop_policy(aiotkinter.TkinterEventLoopPolicy())
         loop = asyncio.new_event_loop()
         loop.set_debug(True)
-        loop.create_task(sent_sampler.start())
-        loop.create_task(recv_sampler.start())
-        loop.create_task(screen.start())
+        if args.connect:
+            loop.create_task(view(display, args.connect))
+        else:
+            sent_sampler = IfSampler("eth0", "bytes_sent", MAX_SAMPLES)
+            recv_sampler = IfSampler("eth0", "bytes_recv", MAX_SAMPLES)
+            widgets = panel(sent_sampler, recv_sampler)
+            if timing:
+                widgets.append((TimingOverlayWidget(Dimension(560, 120), font=fonts.get(14)),
+                                Point(40, 360)))
+            instrument.startup.mark("widgets built")
+            screen = Screen(display, widgets)
+            loop.create_task(sent_sampler.start())
+            loop.create_task(recv_sampler.start())
+            loop.create_task(screen.start())
         loop.run_forever()
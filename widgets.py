@@ -1,14 +1,23 @@
 """Set of trivial widgets for displaying information on a Framebuffer."""
-import sys
+from __future__ import annotations
+import asyncio
+import math
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import Tuple, Callable
+from typing import Tuple, Callable, Iterator, Optional
 from PIL import Image, ImageDraw, ImageFont
 from PIL.ImageColor import getrgb
-import PIL.features
 from periodic import Periodic
-from local_types import Color, Dimension, Point
+from local_types import Color, Dimension, Point, Rect
+from damage import Damage, intersect
 from framebuffer import Framebuffer
+from instrument import timings, startup
+from textcache import text_cache, glyph_atlas
+from fonts import fonts
 
 # Get the values for the default colors
 white: Color = getrgb("white")
@@ -16,21 +25,179 @@ black: Color = getrgb("black")
 green: Color = getrgb("green")
 red: Color = getrgb("red")
 
-# Bail if freetype isn't available
-if not PIL.features.check("freetype2"):
-    print("ERROR: freetype2 isn't available", file=sys.stderr)
-    sys.exit(1)
+# Fully transparent, used to clear widgets without a background
+transparent: Color = Color(0, 0, 0, 0)
 
-# Load a default font
-font = ImageFont.truetype("inconsolata.ttf", 24)
+# Kinds of layer a widget contributes to the screen. Content changes from frame
+# to frame, backgrounds and chrome only when invalidated so they are baked
+LAYER_CONTENT: str = "content"
+LAYER_BACKGROUND: str = "background"
+LAYER_CHROME: str = "chrome"
+
+# Modes a widget's surface can have. RGBA holds the pixels, P indexes a palette of RGBA colors,
+# 1 and L hold the coverage of a single ink color at one byte a pixel, as Pillow stores both
+SURFACE_MODES: tuple[str, ...] = ("RGBA", "P", "L", "1")
+
+# Seconds before a carousel turns the page that the next page starts being rendered
+CAROUSEL_PREWARM: float = 2.0
+
+# Memory a carousel's page surfaces may take
+CAROUSEL_MAX_BYTES: int = 4 * 1024 * 1024
+
+# One layer of the flattened widget tree, at origin in screen coordinates
+Layer = namedtuple("Layer", "widget kind origin")
+
+
+def compose_rect(img: Image,
+                 drawable: ImageDraw,
+                 rect: Rect,
+                 background: Optional[Color],
+                 layers: list[Tuple[Image, Point]],
+                 base: Optional[Image] = None) -> None:
+    """Rebuild one rectangle of img from its background and the layers over it.
+
+    Parameters
+    ----------
+    img: Image
+        the image to rebuild part of
+    drawable: ImageDraw
+        drawing surface for img
+    rect: Rect
+        the area of img to rebuild
+    background: Color
+        the color to clear rect to first, or None for transparent
+    layers: list[Tuple[Image, Point]]
+        (image, origin) pairs in left to right Z-order (left is lowest), widget surfaces in any of
+        the SURFACE_MODES
+    base: Image
+        an image the size of img to copy rect from instead of clearing it to background
+    """
+    if base is not None:
+        img.paste(base.crop(rect), (rect.x0, rect.y0))
+    else:
+        fill = transparent if background is None else background
+        drawable.rectangle([rect.x0, rect.y0, rect.x1 - 1, rect.y1 - 1], fill=fill)
+    for (layer, origin) in layers:
+        (ox, oy) = origin
+        (w, h) = layer.size
+        clip = intersect(rect, Rect(ox, oy, ox + w, oy + h))
+        if clip is not None:
+            composite(img, layer, clip, (clip.x0 - ox, clip.y0 - oy, clip.x1 - ox, clip.y1 - oy))
+
+
+def composite(img: Image, surface: Image, rect: Rect, box: Tuple[int, int, int, int]) -> None:
+    """Blend box of a widget surface over rect of img, expanding compact surfaces to RGBA on the way."""
+    mode = surface.mode
+    if mode == "RGBA":
+        img.alpha_composite(surface, (rect.x0, rect.y0), box)
+    elif mode == "P":
+        img.alpha_composite(surface.crop(box).convert("RGBA"), (rect.x0, rect.y0))
+    else:
+        # Coverage of the ink over the background, both opaque
+        background = surface.info.get("background")
+        if background is not None:
+            img.paste(background, rect)
+        img.paste(surface.info["ink"], rect, surface.crop(box))
+
+
+class OffsetDraw:
+    """Stand-in for ImageDraw which moves everything drawn by an offset.
+
+    Lets a widget draw straight into an image it doesn't own, such as its
+    parent's or the screen's, in its own coordinates. Only the drawing
+    operations the widgets use are provided
+    """
+
+    def __init__(self, drawable: ImageDraw, offset: Point):
+        """Draw through drawable, moving everything right and down by offset."""
+        self._drawable = drawable
+        self._offset = offset
+
+    def offset(self, origin: Point) -> OffsetDraw:
+        """Get a drawable whose (0, 0) is origin in this one's coordinates."""
+        return OffsetDraw(self._drawable, Point(self._offset[0] + origin[0], self._offset[1] + origin[1]))
+
+    def _shift(self, xy):
+        (dx, dy) = self._offset
+        if isinstance(xy[0], (int, float)):
+            return [v + (dy if i % 2 else dx) for (i, v) in enumerate(xy)]
+        return [(x + dx, y + dy) for (x, y) in xy]
+
+    def rectangle(self, xy, *args, **kwargs) -> None:
+        self._drawable.rectangle(self._shift(xy), *args, **kwargs)
+
+    def line(self, xy, *args, **kwargs) -> None:
+        self._drawable.line(self._shift(xy), *args, **kwargs)
+
+    def ellipse(self, xy, *args, **kwargs) -> None:
+        self._drawable.ellipse(self._shift(xy), *args, **kwargs)
+
+    def polygon(self, xy, *args, **kwargs) -> None:
+        self._drawable.polygon(self._shift(xy), *args, **kwargs)
+
+    def bitmap(self, xy, bitmap: Image, fill=None) -> None:
+        self._drawable.bitmap(tuple(self._shift(xy)), bitmap, fill=fill)
+
+    def text(self, xy, text: str, *args, **kwargs) -> None:
+        self._drawable.text(tuple(self._shift(xy)), text, *args, **kwargs)
+
+
+@contextmanager
+def clipped(img: Image, rect: Rect) -> Iterator[OffsetDraw]:
+    """Draw into img, in img's coordinates, changing nothing outside rect.
+
+    The drawing goes to a copy of rect which is pasted back on leaving, so
+    rect is the only scratch memory needed
+    """
+    scratch = img.crop(rect)
+    yield OffsetDraw(ImageDraw.Draw(scratch), Point(-rect.x0, -rect.y0))
+    img.paste(scratch, (rect.x0, rect.y0))
+
+
+def paint_rect(img: Image, rect: Rect, background: Optional[Color], layers: list[Layer]) -> None:
+    """Rebuild one rectangle of img from its background and static layers painted straight into it.
+
+    Parameters
+    ----------
+    img: Image
+        the image to rebuild part of
+    rect: Rect
+        the area of img to rebuild
+    background: Color
+        the color to clear rect to first, or None for transparent
+    layers: list[Layer]
+        background and chrome layers in Z-order, lowest first, painted with their widget's paint()
+    """
+    with clipped(img, rect) as drawable:
+        drawable.rectangle([rect.x0, rect.y0, rect.x1 - 1, rect.y1 - 1], fill=transparent if background is None else background)
+        for layer in layers:
+            (ox, oy) = layer.origin
+            (w, h) = layer.widget.size
+            if intersect(rect, Rect(ox, oy, ox + w, oy + h)) is None:
+                continue
+            try:
+                layer.widget.paint(drawable.offset(layer.origin), layer.kind)
+            except Exception as e:
+                traceback.print_tb(e.__traceback__)
+
+
+def _min_refresh(refreshes: list[Optional[float]]) -> Optional[float]:
+    """Get the shortest of some refresh intervals, ignoring widgets which don't need polling."""
+    return min((refresh for refresh in refreshes if refresh is not None), default=None)
 
 
 class Widget:
     """Base class for all widgets."""
 
+    # Mode of the surface the widget draws into, one of SURFACE_MODES, unless the mode argument says otherwise
+    MODE: str = "RGBA"
+
     def __init__(self,
                  size: Dimension,
-                 background: Color = None  # Set to None for no fill
+                 background: Color = None,  # Set to None for no fill
+                 refresh: Optional[float] = None,
+                 mode: Optional[str] = None,
+                 ink: Color = white
                  ):
         """Create a new widget.
 
@@ -40,11 +207,38 @@ class Widget:
              a formatted string to print out what the animal says
         background: Color
              the background color of the widget or None for transparent
+        refresh: float
+             seconds between checks of inputs which change without telling the widget,
+             e.g. the time, or None if the widget calls wake() when its inputs change
+        mode: str
+             mode of the surface the widget draws into, MODE if None. A P surface
+             holds up to 256 colors, 1 and L surfaces only how much of ink covers
+             the background, so they need it opaque or None and are RGBA otherwise.
+             The compact modes take a quarter of the memory of RGBA and are expanded
+             as they are composited
+        ink: Color
+             the color a 1 or L surface draws with
         """
         self._size = size
         self._background = background
-        self._img = Image.new("RGBA", size)
-        self._drawable = ImageDraw.Draw(self._img)
+        self._refresh = refresh
+        self._mode = mode or self.MODE
+        if self._mode not in SURFACE_MODES:
+            raise ValueError(f"Unsupported surface mode {self._mode}")
+        if self._mode in ("1", "L") and background is not None and len(background) == 4 and background[3] != 255:
+            # Coverage alone can't show what is behind a translucent background
+            self._mode = "RGBA"
+        self._ink = ink
+        # Created when the widget is first drawn, as widgets whose layers are baked never need one
+        self._img: Optional[Image] = None
+        self._drawable: Optional[ImageDraw] = None
+        # Everything needs to be rendered and reach the screen the first time the widget is drawn
+        self._damage = Damage(size)
+        self._damage.add()
+        self._dirty = True
+        self._parent: Optional[Widget] = None
+        # Set by the Screen on the widgets it holds directly
+        self._waker: Optional[Callable[[], None]] = None
 
     @property
     def size(self) -> Dimension:
@@ -53,18 +247,128 @@ class Widget:
 
     @property
     def img(self) -> Image:
-        """Get the PIL image backing this widget."""
+        """Get the PIL image backing this widget, creating it the first time."""
+        if self._img is None:
+            if self._mode == "P":
+                # Index 0 is transparent, the rest are added as they are drawn with
+                self._img = Image.new("P", self._size, 0)
+                self._img.putpalette(bytes(transparent), rawmode="RGBA")
+            else:
+                self._img = Image.new(self._mode, self._size, 0)
+                if self._mode != "RGBA":
+                    # Read back when the surface is composited
+                    self._img.info.update(ink=self._ink, background=self._background)
         return self._img
 
+    @property
+    def mode(self) -> str:
+        """Get the mode of the widget's surface."""
+        return self._mode
+
+    def _surface_color(self, color: Optional[Color]):
+        """Get the value which draws color on this widget's surface.
+
+        That is the color itself on an RGBA surface and its index, added to the
+        palette the first time, on a P surface. On 1 and L surfaces the ink is
+        full coverage and anything else, such as the background, none
+        """
+        if self._mode == "RGBA":
+            return transparent if color is None else color
+        if self._mode == "P":
+            return self.img.palette.getcolor(transparent if color is None else color, self.img)
+        return 255 if color == self._ink and color != self._background else 0
+
     @property
     def drawable(self) -> ImageDraw:
         """Get the widget's drawing surface."""
+        if self._drawable is None:
+            self._drawable = ImageDraw.Draw(self.img)
         return self._drawable
 
+    @property
+    def dirty(self) -> bool:
+        """Check if this widget needs to be rendered again."""
+        return self._dirty
+
+    @property
+    def name(self) -> str:
+        """Get a short name for this widget, used to label its timings."""
+        return type(self).__name__
+
+    @property
+    def refresh(self) -> Optional[float]:
+        """Get the seconds between checks this widget, or any widget it holds, needs, or None if it never needs polling."""
+        return self._refresh
+
+    def adopt(self, child: Widget) -> None:
+        """Make this widget the parent of child so it is redrawn when child changes."""
+        child._parent = self
+
+    def damage(self, rect: Optional[Rect] = None) -> None:
+        """Mark part of this widget, or all of it if rect is None, as changed since it was last drawn."""
+        self._damage.add(rect)
+
+    def take_damage(self) -> list[Rect]:
+        """Get the rectangles, in widget coordinates, which changed since this was last called."""
+        return self._damage.take()
+
+    def invalidate(self, rect: Optional[Rect] = None) -> None:
+        """Mark part of this widget, or all of it if rect is None, as needing to be rendered again."""
+        self.damage(rect)
+        self._set_dirty()
+
+    def wake(self) -> None:
+        """Ask the Screen for a frame soon because the inputs of this widget changed.
+
+        Only call this on the event loop
+        """
+        if self._parent is not None:
+            self._parent.wake()
+        elif self._waker is not None:
+            self._waker()
+
+    def _set_dirty(self) -> None:
+        """Flag this widget and all its parents for rendering on the next draw."""
+        self._dirty = True
+        if self._parent is not None:
+            self._parent._set_dirty()
+
+    def update(self) -> None:
+        """Check the inputs of this widget and invalidate() it if they changed.
+
+        Called once per frame before draw(), on the event loop. draw() may then run
+        on the render thread while the event loop carries on, so anything ddraw()
+        needs from outside the widget must be copied here. Containers must pass it
+        on to their children
+        """
+        pass
+
     def draw(self) -> Image:
-        """Draw this widget into the backing image."""
-        self.ddraw(self._drawable)
-        return self._img
+        """Draw this widget into the backing image if it has been invalidated.
+
+        Widgets are retained, so ddraw() is only called when something called invalidate()
+        """
+        if self._dirty:
+            self.ddraw(self.drawable)
+            self._dirty = False
+        return self.img
+
+    def layers(self, origin: Point) -> list[Layer]:
+        """Flatten this widget into the layers it contributes to a screen, lowest first, placed at origin."""
+        return [Layer(self, LAYER_CONTENT, origin)]
+
+    def draw_layer(self, kind: str) -> Optional[Image]:
+        """Draw one of the layers given by layers() and return its image.
+
+        Background and chrome layers have no image, they are painted into the
+        screen's base with paint() where it needs baking again. Drawing them only
+        brings their damage up to date
+        """
+        return self.draw()
+
+    def paint(self, drawable: OffsetDraw, kind: str) -> None:
+        """Draw a background or chrome layer through drawable, whose (0, 0) is the top left of this widget."""
+        pass
 
     def ddraw(self, drawable) -> None:
         """Draw the widget components into the widget's backing image using the drawing surface.
@@ -73,15 +377,26 @@ class Widget:
         """
         if self._background is not None:
             (w, h) = self._size
-            drawable.rectangle([0, 0, w, h], fill=self._background)
+            drawable.rectangle([0, 0, w, h], fill=self._surface_color(self._background))
 
 
 class CarouselWidget(Widget):
-    """Widget to cycle through a set of pages of other widgets."""
+    """Widget to cycle through a set of pages of other widgets.
+
+    Each page is composited into a surface of its own which is kept between
+    frames and only recomposited where the widgets on it changed. The page due
+    next is warmed, its widgets checked and its surface brought up to date,
+    prewarm seconds before it is shown, so turning the page costs one blit of
+    a surface which is ready. Pages which aren't showing stay up to date while
+    their surface is retained. Surfaces past max_bytes are thrown away, least
+    recently shown first, and rendered from cold if the page comes round again
+    """
 
     def __init__(self,
                  pages: list[Tuple[int, list[Tuple[Widget, Point]]]],
                  background: Color = black,
+                 prewarm: float = CAROUSEL_PREWARM,
+                 max_bytes: int = CAROUSEL_MAX_BYTES,
                  **kwargs):
         """Create a new CarouselWidget.
 
@@ -91,36 +406,122 @@ class CarouselWidget(Widget):
             a list of pages (delay, widgets) where widgets is list of (widget, origin)
         background: Color
             The background color for the entire text widget
+        prewarm: float
+            seconds before a page is shown to start keeping its surface up to date,
+            at least refresh so the page is noticed in time
+        max_bytes: int
+            memory the page surfaces may take. The page showing and the page warming
+            are kept even past it
         **kwargs: map of arguments
             Passed to the superclass (Widget)
         """
+        kwargs.setdefault("refresh", 1.0)  # To check whether it is time to turn the page
         super().__init__(**kwargs)
         self._last_displayed: int = 0
         self._pages: list[Tuple[int, list[Tuple[Widget, Point]]]] = pages
         self._page: int = 0
         self._delay: int = 0
+        self._prewarm = prewarm
+        # The page due next while it is being warmed
+        self._warm: Optional[int] = None
+        (w, h) = self._size
+        self._max_surfaces = max(max_bytes // (w * h * 4), 1)
+        # Page surfaces by page, least recently shown first, with the areas of each still to composite
+        self._surfaces: OrderedDict[int, Tuple[Image, ImageDraw, Damage]] = OrderedDict()
+        for (_, page) in pages:
+            for (widget, _) in page:
+                self.adopt(widget)
 
     def _check_page(self):
-        """Rotate the page if sufficient time has passed."""
+        """Rotate the page if sufficient time has passed, and warm the next page when it is nearly due."""
         now = datetime.now().timestamp()
         if now - self._last_displayed > self._delay:
             self._last_displayed = now
             self._page = (self._page + 1) % len(self._pages)
             (self._delay, _) = self._pages[self._page]
+            self._warm = None
+            self.invalidate()
+        elif self._warm is None and len(self._pages) > 1 and now - self._last_displayed > self._delay - self._prewarm:
+            self._warm = (self._page + 1) % len(self._pages)
+            # Nothing on screen changes but draw() has to run to render the page
+            self._set_dirty()
 
-    def ddraw(self, drawable):
-        """Draw the widgets from the current page."""
-        super().ddraw(drawable)
+    @property
+    def img(self) -> Image:
+        """Get the surface of the page showing."""
+        return self._surface(self._page)[0]
+
+    @property
+    def refresh(self) -> Optional[float]:
+        """Get the shortest refresh of the carousel and the widgets on its pages."""
+        return _min_refresh([self._refresh] + [widget.refresh for (_, page) in self._pages for (widget, _) in page])
+
+    def update(self) -> None:
+        """Rotate the page if it is time and check the widgets on the pages kept up to date."""
         self._check_page()
-        (delay, page) = self._pages[self._page]
+        for index in self._live():
+            (delay, page) = self._pages[index]
+            for (widget, _) in page:
+                widget.update()
+
+    def _live(self) -> list[int]:
+        """Get the pages to keep up to date, the one showing first."""
+        live = [self._page]
+        if self._warm is not None and self._warm != self._page:
+            live.append(self._warm)
+        live.extend(index for index in self._surfaces if index not in live)
+        return live
+
+    def _surface(self, index: int) -> Tuple[Image, ImageDraw, Damage]:
+        """Get the surface of a page, creating it wholly damaged and evicting the least recently shown if there are too many."""
+        found = self._surfaces.get(index)
+        if found is not None:
+            return found
+        img = Image.new("RGBA", self._size, transparent if self._background is None else self._background)
+        damage = Damage(self._size)
+        damage.add()
+        found = self._surfaces[index] = (img, ImageDraw.Draw(img), damage)
+        for stale in list(self._surfaces):
+            if len(self._surfaces) <= self._max_surfaces:
+                break
+            if stale not in (self._page, self._warm):
+                del self._surfaces[stale]
+        return found
+
+    def _render_page(self, index: int) -> list[Rect]:
+        """Composite the parts of a page's surface its widgets changed and return them."""
+        (img, drawable, damage) = self._surface(index)
+        (delay, page) = self._pages[index]
+        layers = []
         for (widget, origin) in page:
-            img = widget.draw()
-            self._img.alpha_composite(img, origin)
+            layers.append((widget.draw(), origin))
+            damage.add_all(widget.take_damage(), origin)
+        rects = damage.take()
+        for rect in rects:
+            compose_rect(img, drawable, rect, self._background, layers)
+        return rects
+
+    def draw(self) -> Image:
+        """Bring the surfaces of the live pages up to date and return the one showing."""
+        if self._dirty:
+            self._dirty = False
+            page = self._page
+            if page in self._surfaces:
+                self._surfaces.move_to_end(page)
+            self._damage.add_all(self._render_page(page))
+            for index in self._live()[1:]:
+                (_, widgets) = self._pages[index]
+                if index not in self._surfaces or any(widget.dirty for (widget, _) in widgets):
+                    self._render_page(index)
+        return self._surface(self._page)[0]
 
 
 class ClockWidget(Widget):
     """Simple clock widget."""
 
+    # Only the coverage of the foreground is kept
+    MODE: str = "L"
+
     @classmethod
     def _get_size(cls, text: str, font: ImageFont) -> Dimension:
         """Calculate the size of this widget based on the text."""
@@ -128,7 +529,7 @@ class ClockWidget(Widget):
         return Dimension(w, h)
 
     def __init__(self,
-                 font: ImageFont = font,
+                 font: Optional[ImageFont] = None,
                  background: Color = black,
                  foreground: Color = white,
                  **kwargs):
@@ -138,6 +539,7 @@ class ClockWidget(Widget):
         ----------
         font: ImageFont
             The PIL font (truetype) to render the text with. Includes font size!
+            Defaults to the shared default font
         background: Color
             The background color for the entire text widget
         foreground: Color
@@ -145,18 +547,34 @@ class ClockWidget(Widget):
         **kwargs: map of arguments
             Passed to the superclass (Widget)
         """
+        kwargs.setdefault("refresh", 1.0)
+        font = font or fonts.get()
         super().__init__(size=ClockWidget._get_size("XX:XX:XX", font),
                          background=background,
+                         ink=foreground,
                          **kwargs)
         self._font: ImageFont = font
         self._foreground: Color = foreground
+        self._text: str = ClockWidget._now()
+
+    @classmethod
+    def _now(cls) -> str:
+        """Get the current local time as displayed by the clock."""
+        now = datetime.now(timezone.utc)
+        return now.astimezone().strftime("%H:%M:%S")
+
+    def update(self) -> None:
+        """Invalidate the clock when the displayed time changes."""
+        now_str = ClockWidget._now()
+        if now_str != self._text:
+            self._text = now_str
+            self.invalidate()
 
     def ddraw(self, drawable: ImageDraw) -> None:
-        """Render the text into this widget."""
+        """Render the text into this widget, right aligned, from the cached digits."""
         super().ddraw(drawable)
-        now = datetime.now(timezone.utc)
-        now_str: str = now.astimezone().strftime("%H:%M:%S")
-        drawable.text((0, 0), now_str, font=self._font, fill=self._foreground, anchor="ra")
+        glyph_atlas(self._font).draw(drawable, (self._size[0], 0), self._text, fill=self._surface_color(self._foreground),
+                                     anchor="ra")
 
 
 class BarGaugeWidget(Widget):
@@ -168,30 +586,47 @@ class BarGaugeWidget(Widget):
             a function which returns a value between 0 and 1 when called
     """
 
+    # Three colors, so a palette
+    MODE: str = "P"
+
     def __init__(self,
                  value_reporter: Callable[[None], float],
                  **kwargs):
-        """Create a new bar graph widget."""
+        """Create a new bar graph widget, polling value_reporter every second unless refresh says otherwise."""
+        kwargs.setdefault("refresh", 1.0)
         super().__init__(**kwargs)
         self._high_water = 0
         self._value_reporter = value_reporter
+        self._split: int = 0
 
-    def ddraw(self, drawable):
-        """Render the bar graph into this widget."""
+    def update(self) -> None:
+        """Invalidate the gauge when the reported value moves it by at least a pixel."""
         (w, h) = self._size
-        value: float = self._value_reporter()  # 0 .. 1
+        value: float = min(max(self._value_reporter(), 0), 1)  # 0 .. 1
         split: int = round(h * value)
         if split > self._high_water:
             self._high_water = split
+            self.invalidate()
+        if split != self._split:
+            self._split = split
+            self.invalidate()
 
-        drawable.rectangle([0, 0, w, split], fill=red)
-        drawable.rectangle([0, split, w, h - split - 1], fill=green)
-        drawable.line([0, h - self._high_water - 1, w, h - 1 - self._high_water], fill=white, width=2)
+    def ddraw(self, drawable):
+        """Render the bar graph into this widget."""
+        (w, h) = self._size
+        split = self._split
+        drawable.rectangle([0, 0, w, split], fill=self._surface_color(red))
+        if split < h:
+            drawable.rectangle([0, split, w, h - 1], fill=self._surface_color(green))
+        drawable.line([0, h - self._high_water - 1, w, h - 1 - self._high_water], fill=self._surface_color(white), width=2)
 
 
 class TextWidget(Widget):
     """Widget to draw a line of text."""
 
+    # Only the coverage of the foreground is kept
+    MODE: str = "L"
+
     @classmethod
     def _get_size(cls, text: str, font: ImageFont) -> Dimension:
         """Calculate the size of this widget based on the text."""
@@ -200,7 +635,7 @@ class TextWidget(Widget):
 
     def __init__(self,
                  text: str,
-                 font: ImageFont = font,
+                 font: Optional[ImageFont] = None,
                  background: Color = black,
                  foreground: Color = white,
                  **kwargs):
@@ -212,6 +647,7 @@ class TextWidget(Widget):
             The text to render
         font: ImageFont
             The PIL font (truetype) to render the text with. Includes font size!
+            Defaults to the shared default font
         background: Color
             The background color for the entire text widget
         foreground: Color
@@ -219,8 +655,10 @@ class TextWidget(Widget):
         **kwargs: map of arguments
             Passed to the superclass (Widget)
         """
+        font = font or fonts.get()
         super().__init__(size=TextWidget._get_size(text, font),
                          background=background,
+                         ink=foreground,
                          **kwargs)
         self._text = text
         self._font = font
@@ -229,13 +667,21 @@ class TextWidget(Widget):
     def ddraw(self, drawable: ImageDraw) -> None:
         """Render the text into this widget."""
         super().ddraw(drawable)
-        drawable.text((0, 0), self._text, font=self._font, fill=self._foreground, anchor="la")
+        text_cache.draw(drawable, (0, 0), self._text, self._font, fill=self._surface_color(self._foreground), anchor="la")
 
 
 class WidgetDecorator(Widget):
     """Class for a widget which wraps another widget and adds extra decoration.
 
-    Decorator widgets always draw on top of their client widgets unless ddraw() is overridden
+    Decorator widgets always draw on top of their client widgets unless ddraw() is overridden.
+    The decorations are drawn by _decorate() straight into whichever image holds the
+    decorator, clipped to the rectangles which changed: the Screen's baked base, or the
+    decorator's own image when it is composited whole. Nothing is cached in between,
+    _invalidate_chrome() marks where they need drawing again
+
+    A baked base goes below all the content, so _decorate() must keep clear of
+    the wrapped widget or what it draws there is hidden on screen. Anything whose
+    size varies, like a label, needs room kept for the widest it can be
     """
 
     def __init__(self,
@@ -255,20 +701,74 @@ class WidgetDecorator(Widget):
         super().__init__(size, **kwargs)
         self._origin = origin
         self._widget = widget
+        self.adopt(widget)
 
     @property
     def widget(self) -> Widget:
         """Get the wrapped widget."""
         return self._widget
 
+    @property
+    def refresh(self) -> Optional[float]:
+        """Get the shorter refresh of the decorator and the wrapped widget."""
+        return _min_refresh([self._refresh, self._widget.refresh])
+
+    def update(self) -> None:
+        """Check the wrapped widget."""
+        self._widget.update()
+
+    def _invalidate_chrome(self, rect: Optional[Rect] = None) -> None:
+        """Have the decorations drawn again within rect, or everywhere if rect is None."""
+        self.invalidate(rect)
+
+    def _update_chrome(self) -> None:
+        """Call _invalidate_chrome() if the decorations depend on the wrapped widget and are now stale."""
+        pass
+
+    def layers(self, origin: Point) -> list[Layer]:
+        """Flatten into the background, the layers of the wrapped widget, then the decorations.
+
+        The background and decorations only change when the chrome is
+        invalidated, so a Screen can bake them. Any damage this decorator
+        reports while drawn as layers is to them
+        """
+        (ox, oy) = origin
+        layers = [Layer(self, LAYER_BACKGROUND, origin)] if self._background is not None else []
+        layers.extend(self._widget.layers(Point(ox + self._origin[0], oy + self._origin[1])))
+        layers.append(Layer(self, LAYER_CHROME, origin))
+        return layers
+
+    def draw_layer(self, kind: str) -> Optional[Image]:
+        """Bring the damage to the background or decorations up to date, or draw the whole decorated widget for LAYER_CONTENT."""
+        if kind == LAYER_BACKGROUND:
+            return None
+        if kind == LAYER_CHROME:
+            # Checked after the wrapped widget was drawn, so decorations which follow it are current
+            self._update_chrome()
+            self._dirty = False
+            return None
+        return self.draw()
+
+    def paint(self, drawable: OffsetDraw, kind: str) -> None:
+        """Fill the background or draw the decorations."""
+        if kind == LAYER_BACKGROUND:
+            (w, h) = self._size
+            drawable.rectangle([0, 0, w - 1, h - 1], fill=self._background)
+        elif kind == LAYER_CHROME:
+            self._decorate(drawable)
+
     def ddraw(self, drawable: ImageDraw) -> None:
-        """Draw the wrapped widget and decorate it."""
-        super().ddraw(drawable)
+        """Draw the parts of the wrapped widget which changed and decorate them."""
         widget_img = self._widget.draw()
-        self._img.alpha_composite(widget_img, self._origin)
-        self._decorate(drawable)
-
-    def _decorate(self, drawable: ImageDraw) -> None:
+        self._update_chrome()
+        self._damage.add_all(self._widget.take_damage(), self._origin)
+        layers = [(widget_img, self._origin)]
+        for rect in self._damage:
+            compose_rect(self._img, drawable, rect, self._background, layers)
+            with clipped(self._img, rect) as clip:
+                self._decorate(clip)
+
+    def _decorate(self, drawable: OffsetDraw) -> None:
         """Draw the decorators on top of the wrapped widget."""
         pass
 
@@ -284,7 +784,7 @@ class TitleDecorator(WidgetDecorator):
     def __init__(self,
                  widget: Widget,
                  title: str,
-                 font: ImageFont = font,
+                 font: Optional[ImageFont] = None,
                  foreground: Color = white,
                  background: Color = black,
                  loc: str = "top_left",
@@ -298,37 +798,42 @@ class TitleDecorator(WidgetDecorator):
         title: str
               the title to display
         font: ImageFont
-              font for the title
+              font for the title, defaults to the shared default font
         """
         super().__init__(widget,
                          widget.size,
                          background=background,
                          **kwargs)
         self._title = title
-        self._font = font
+        self._font = font or fonts.get()
         self._foreground = foreground
         self.loc = loc  # Currently ignored, will be e.g. top_left etc
 
+    @property
+    def name(self) -> str:
+        """Get the title as the name of the widget."""
+        return self._title
+
     def _decorate(self, drawable) -> None:
         """Draw the decorator on the widget.
 
         This method uses an explicit drawable
         """
-        bbox = self._font.getbbox(self._title, anchor="la")
+        bbox = text_cache.bbox(self._font, self._title, anchor="la")
         (x, y, w, h) = bbox
         drawable.rectangle([x + 24, 0, w + 24, h], fill=self._background)
-        drawable.text((24, 0),
-                      self._title,
-                      font=self._font,
-                      fill=self._foreground,
-                      anchor="la")
+        text_cache.draw(drawable,
+                        (24, 0),
+                        self._title,
+                        self._font,
+                        fill=self._foreground,
+                        anchor="la")
 
 
 class BorderDecorator(WidgetDecorator):
     """Decorator to render a border around another widget.
 
-    This decorator allocates a new Image with sufficient additional
-    space for the border
+    The decorator is larger than the wrapped widget by the border on each side
     """
 
     @classmethod
@@ -364,7 +869,7 @@ class BorderDecorator(WidgetDecorator):
         self._border_width = border_width
         self._line_width = line_width
 
-    def _decorate(self, drawable: ImageDraw) -> None:
+    def _decorate(self, drawable: OffsetDraw) -> None:
         """Draw the client widget and decorate it with the border."""
         (w, h) = self._size
         offset = self._border_width//2
@@ -374,56 +879,292 @@ class BorderDecorator(WidgetDecorator):
                                width=self._line_width)
 
 
+class TimingOverlayWidget(Widget):
+    """Widget showing the stages with the most time recorded in the shared timings.
+
+    Each line is the stage name followed by its p50, p99 and max in milliseconds.
+    The text is refreshed at most every refresh seconds so the overlay doesn't
+    dominate the timings it shows
+    """
+
+    def __init__(self,
+                 size: Dimension,
+                 font: Optional[ImageFont] = None,
+                 foreground: Color = white,
+                 background: Color = Color(0, 0, 0, 160),
+                 refresh: float = 1.0,
+                 **kwargs):
+        """Create a new TimingOverlayWidget.
+
+        Parameters
+        ----------
+        size: Dimension
+              the size of the overlay, as many stages are shown as fit
+        font: ImageFont
+              font for the text, defaults to the shared default font
+        foreground: Color
+              color for the text
+        background: Color
+              color behind the text, translucent by default so the widgets below show through
+        refresh: float
+              minimum seconds between refreshes of the text
+        """
+        super().__init__(size, background=background, refresh=refresh, **kwargs)
+        self._font = font = font or fonts.get()
+        self._foreground = foreground
+        (_, top, _, bottom) = font.getbbox("Ag", anchor="la")
+        self._line_height = bottom - top + 2
+        self._lines: list[str] = []
+        self._next_refresh = 0.0
+
+    def update(self) -> None:
+        """Format the slowest stages again if the refresh interval has passed."""
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + self._refresh
+        lines = [f"{name[:20]:20} {h.percentile(50)*1e3:6.2f} {h.percentile(99)*1e3:6.2f} {h.max*1e3:6.2f}"
+                 for (name, h) in timings.slowest(max(self._size[1] // self._line_height, 1))]
+        if lines != self._lines:
+            self._lines = lines
+            self.invalidate()
+
+    def ddraw(self, drawable: ImageDraw) -> None:
+        """Draw the timing lines."""
+        super().ddraw(drawable)
+        for (i, line) in enumerate(self._lines):
+            drawable.text((2, i * self._line_height), line, font=self._font, fill=self._foreground, anchor="la")
+
+
 class Screen:
-    """Screen widget which represents all the widgets on a screen."""
+    """Screen widget which represents all the widgets on a screen.
+
+    Each frame has three stages. The widgets check their inputs with update() on
+    the event loop, then a render thread draws them and composites the damaged
+    parts of the screen, then presents those regions of the screen image, which
+    the display converts straight into its own memory. Displays which have to be
+    driven from the event loop, like Tk, are presented there instead. Only
+    one frame renders at a time; a tick which comes while the renderer is busy
+    is put off until it finishes, and a frame is always presented before the
+    next starts rendering, so the screen image is never drawn while it is
+    being presented.
+
+    Frames are driven by change rather than a fixed rate. Widgets call wake()
+    when their inputs change, e.g. when a sampler takes a sample, and a frame
+    follows as soon as min_interval allows. Widgets whose inputs change without
+    telling them, like clocks, are polled at their refresh interval. When
+    nothing changes nothing is rendered
+
+    The widgets are flattened into layers. The backgrounds and decorations of
+    decorators are baked into a base image along with the screen background,
+    and a frame starts each damaged rectangle from a copy of the base and only
+    blends the content layers over it. Baked layers go below all the content,
+    so decorations must not overlap the widget they decorate
+    """
 
     def __init__(self,
                  display: Framebuffer,
                  widgets: list[tuple[Widget, Point]],
-                 interval: int = 1):
+                 interval: Optional[float] = None,
+                 threaded: bool = True,
+                 min_interval: float = 0.05,
+                 bake: bool = True):
         """Create a new screen for the specific display.
 
         display: Framebuffer
                 a simple python wrapper around the Linux framebuffer device
         widgets: list[Widget]
                 a list of widgets in left to right Z-order (left is lowest)
-        interval: int
-                interval in seconds between screen refreshes
+        interval: float
+                if set, seconds between checks of every widget on top of their own refresh
+        threaded: bool
+                render on a worker thread, or on the event loop if False
+        min_interval: float
+                minimum seconds between the start of two frames
+        bake: bool
+                bake the static layers into a base image, or composite every widget whole if False
         """
         self._display: Framebuffer = display
         self._widgets = widgets
-        self._periodic = Periodic(self._draw, interval)
+        self._threaded = threaded
+        self._min_interval = min_interval
+        # One polling job for each distinct refresh interval of the widgets
+        refreshes = {widget.refresh for (widget, _) in widgets if widget.refresh}
+        if interval:
+            refreshes.add(interval)
+        self._polls = [Periodic(self.wake, refresh) for refresh in sorted(refreshes)]
+        for (widget, _) in widgets:
+            widget._waker = self.wake
+        self._frame_handle: Optional[asyncio.TimerHandle] = None
+        self._last_frame = -math.inf
+        self._wake_pending = False
+        self._stopped = False
         self._screen = Image.new(mode="RGBA", size=display.size)
         self._screen_drawable = ImageDraw.Draw(self._screen)
+        self._background: Color = black
+        # Areas of the screen which need recompositing and writing to the display
+        self._damage = Damage(display.size)
+        if bake:
+            self._layers = [layer for (widget, viewport) in widgets for layer in widget.layers(viewport)]
+        else:
+            self._layers = [Layer(widget, LAYER_CONTENT, viewport) for (widget, viewport) in widgets]
+        # The screen background and the static layers, and the areas of it which need baking again
+        self._base = Image.new(mode="RGBA", size=display.size)
+        self._base_drawable = ImageDraw.Draw(self._base)
+        self._base_damage = Damage(display.size)
+        self._static = [layer for layer in self._layers if layer.kind != LAYER_CONTENT]
+        # Built once so naming the timings costs nothing per frame
+        self._timing_names = [f"{'widget' if layer.kind == LAYER_CONTENT else layer.kind}.{i}.{layer.widget.name}"
+                              for (i, layer) in enumerate(self._layers)]
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render") if threaded else None
+        self._rendering = False
+        self.skipped = 0  # Frames skipped as nothing changed
+        self._presented = False
         self.clear()
         self._draw()
 
     def clear(self, color: Color = black) -> None:
-        """Clear the screen."""
+        """Clear the screen. Only call this while no frame is rendering."""
         (w, h) = self._display.size
+        self._background = color
         self._screen_drawable.rectangle([0, 0, w, h], fill=color)
-        self._display.write_screen(self._screen.tobytes())
-
-    def _draw(self) -> None:
-        """Draw all the widgets into the screen Image and send it to the Framebuffer."""
-        for (widget, viewport) in self._widgets:
+        self._display.present(self._screen)
+        # The widgets have to be composited again over the new background
+        self._base_damage.add()
+        self._damage.add()
+
+    def _update(self) -> None:
+        """Let the widgets check their inputs. Runs on the event loop."""
+        with timings.time("frame.update"):
+            for (widget, _) in self._widgets:
+                try:
+                    widget.update()
+                except Exception as e:
+                    traceback.print_tb(e.__traceback__)
+
+    def _render(self) -> list[Rect]:
+        """Draw the layers which changed, bake the static ones and composite the parts of the screen they cover."""
+        content = []
+        for (layer, name) in zip(self._layers, self._timing_names):
+            is_content = layer.kind == LAYER_CONTENT
             try:
-                img = widget.draw()
-                self._screen.alpha_composite(img, viewport)
+                with timings.time(name):
+                    img = layer.widget.draw_layer(layer.kind)
+                damage = layer.widget.take_damage()
+                self._damage.add_all(damage, layer.origin)
+                if not is_content:
+                    self._base_damage.add_all(damage, layer.origin)
             except Exception as e:
                 traceback.print_tb(e.__traceback__)
-        if self._display.mode == "BGRA":
-            # Nasty trick to swap two of the channels for the specific
-            # ordering of the framebuffer
-            (r, g, b, a) = self._screen.split()
-            im_bgr = Image.merge('RGBA', (b, g, r, a))
-        else:
-            im_bgr = self._screen
-        self._display.write_screen(im_bgr.tobytes())
+                img = layer.widget.img
+            if is_content:
+                content.append((img, layer.origin))
+        with timings.time("frame.bake"):
+            for rect in self._base_damage.take():
+                paint_rect(self._base, rect, self._background, self._static)
+        rects = self._damage.take()
+        with timings.time("frame.compose"):
+            for rect in rects:
+                compose_rect(self._screen, self._screen_drawable, rect, self._background, content, base=self._base)
+        return rects
+
+    def _present(self, rects: list[Rect]) -> None:
+        """Have the Framebuffer show the rectangles of the screen which changed.
+
+        The screen image is handed over as it is, leaving the display to convert
+        it in one pass to wherever it goes. It isn't touched again until the next
+        frame renders
+        """
+        if rects:
+            with timings.time("frame.present"):
+                self._display.present(self._screen, rects)
+        if not self._presented:
+            self._presented = True
+            startup.mark("first frame")
+            if startup.enabled:
+                startup.dump()
+
+    def _draw(self) -> None:
+        """Render and present a frame on the calling thread."""
+        with timings.time("frame.total"):
+            self._update()
+            self._present(self._render())
+
+    def wake(self) -> None:
+        """Schedule a frame as soon as min_interval allows, unless one is already on its way.
+
+        Only call this on the event loop. With no loop running, e.g. while a
+        sampler is ticked by hand, nothing is scheduled and start() draws the
+        first frame instead
+        """
+        if self._frame_handle is not None or self._stopped:
+            return
+        if self._rendering:
+            # Picked up when the frame being rendered is done
+            self._wake_pending = True
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        delay = max(self._last_frame + self._min_interval - loop.time(), 0)
+        self._frame_handle = loop.call_later(delay, self._frame)
+
+    def _frame(self) -> None:
+        """Check the widgets and render a frame if any of them changed."""
+        self._frame_handle = None
+        loop = asyncio.get_running_loop()
+        self._last_frame = loop.time()
+        if not self._threaded:
+            self._draw()
+            return
+        self._update()
+        if not self._damage and not any(layer.widget.dirty for layer in self._layers):
+            self.skipped += 1
+            return
+        self._rendering = True
+        loop.run_in_executor(self._executor, self._render_frame, loop)
+
+    def _render_frame(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Render and present a frame, or leave presenting it to the event loop if the display needs that. Runs on the render thread."""
+        rects: Optional[list[Rect]] = None
+        try:
+            with timings.time("frame.render"):
+                rects = self._render()
+            if not self._display.present_on_loop:
+                self._present(rects)
+                rects = None
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
+        finally:
+            loop.call_soon_threadsafe(self._rendered, rects)
+
+    def _rendered(self, rects: Optional[list[Rect]]) -> None:
+        """Present the frame just rendered if it hasn't been, and start the next if anything woke the screen meanwhile."""
+        self._rendering = False
+        if rects is not None:
+            self._present(rects)
+        if self._wake_pending:
+            self._wake_pending = False
+            self.wake()
 
     async def start(self):
-        """Start periodically rendering the screen."""
-        await self._periodic.start()
+        """Start rendering the screen whenever it changes."""
+        for poll in self._polls:
+            await poll.start()
+        self.wake()
+
+    async def stop(self):
+        """Stop rendering and wait for the render thread to finish."""
+        # Samplers carry on waking the widgets after this
+        self._stopped = True
+        for poll in self._polls:
+            await poll.stop()
+        if self._frame_handle is not None:
+            self._frame_handle.cancel()
+            self._frame_handle = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":